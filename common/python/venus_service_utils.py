@@ -72,3 +72,59 @@ class expfilter(object):
             self.value = min(self.maxvalue, self.value)
 
 
+class ItemsChangedPublisher(object):
+    """
+    Collects the value changes of a VeDbusService and emits them as one
+    ItemsChanged signal, instead of one PropertiesChanged signal per item.
+
+    The changes are flushed at the end of the current main loop iteration
+    (window=0) or after a window of <window> ms.
+    mainloop: GLib or a replacement with idle_add/timeout_add.
+    """
+
+    def __init__(self, dbusservice, window=0, mainloop=None):
+
+        if mainloop is None:
+            from gi.repository import GLib
+            mainloop = GLib
+        self.glib = mainloop
+
+        self.dbusservice = dbusservice
+        self.window = window
+        self.changes = {}
+        self.flushsource = None
+
+        # Statistics
+        self.itemsout = 0 # number of changed items, one signal each without batching
+        self.signalsout = 0 # number of ItemsChanged signals sent
+
+    def signalsSaved(self):
+        return self.itemsout - self.signalsout
+
+    def __getitem__(self, path):
+        return self.dbusservice[path]
+
+    def __contains__(self, path):
+        return path in self.dbusservice
+
+    def __setitem__(self, path, newvalue):
+        c = self.dbusservice._dbusobjects[path]._local_set_value(newvalue)
+        if c is None:
+            return
+
+        self.changes[path] = c
+        self.itemsout += 1
+
+        if self.flushsource is None:
+            if self.window:
+                self.flushsource = self.glib.timeout_add(self.window, self.flush)
+            else:
+                self.flushsource = self.glib.idle_add(self.flush)
+
+    def flush(self):
+        self.flushsource = None
+        if self.changes:
+            self.dbusservice._dbusnodes['/'].ItemsChanged(self.changes)
+            self.signalsout += 1
+            self.changes = {}
+        return False
@@ -0,0 +1,210 @@
+"""
+Incremental reducers to aggregate the values of multiple batteries into
+the values of the virtual battery.
+
+Each reducer keeps the last value of every battery in a slot and updates
+its cached aggregate when one slot changes, so a value change costs O(1)
+(amortized for min/max) instead of a loop over all batteries.
+"""
+
+from fnmatch import fnmatchcase
+
+# Recompute running sums from the slots every n updates to
+# bound the accumulated floating point error.
+RESUM_INTERVAL = 1000
+
+def isnumber(v):
+    return isinstance(v, (int, float))
+
+# Invalid values are None or an empty array (dbus-invalid on the sender side)
+def isvalid(v):
+    return v is not None and not (isinstance(v, list) and len(v) == 0)
+
+class reducer(object):
+
+    def __init__(self):
+        super(reducer, self).__init__()
+        self.slots = {}
+
+    def update(self, service, value):
+        old = self.slots.get(service, None)
+        self.slots[service] = value
+        self.replace(service, old, value)
+        return self.value()
+
+    def remove(self, service):
+        if service in self.slots:
+            old = self.slots.pop(service)
+            self.replace(service, old, None)
+        return self.value()
+
+    def replace(self, service, old, new):
+        raise NotImplementedError()
+
+    def value(self):
+        raise NotImplementedError()
+
+class sumreducer(reducer):
+    """
+    Sum of numeric values. Arrays and strings are concatenated
+    in battery order (this is the rare case, it loops over the slots).
+    """
+
+    def __init__(self):
+        super(sumreducer, self).__init__()
+        self.total = 0
+        self.nnum = 0 # number of numeric slots
+        self.nother = 0 # number of valid, non-numeric slots
+        self.nupdates = 0
+
+    def replace(self, service, old, new):
+        if isnumber(old):
+            self.total -= old
+            self.nnum -= 1
+        elif isvalid(old):
+            self.nother -= 1
+
+        if isnumber(new):
+            self.total += new
+            self.nnum += 1
+        elif isvalid(new):
+            self.nother += 1
+
+        self.nupdates += 1
+        if self.nupdates == RESUM_INTERVAL:
+            self.nupdates = 0
+            self.total = sum(v for v in self.slots.values() if isnumber(v))
+
+    def value(self):
+        if self.nother:
+            res = None
+            for v in self.slots.values():
+                if isvalid(v) and not isnumber(v):
+                    res = v if res is None else res + v
+            return res
+        if self.nnum:
+            return self.total
+        return None
+
+class avgreducer(sumreducer):
+
+    def value(self):
+        if not self.nnum:
+            return None
+        return round(self.total / self.nnum, 3)
+
+class extremereducer(reducer):
+    """
+    Min/max with per-battery slots. The extreme value and the battery
+    holding it are cached, the slots are only scanned if the holder
+    moves away from the extreme.
+    """
+
+    def __init__(self, better):
+        super(extremereducer, self).__init__()
+        self.better = better # better(a, b): a is more extreme than b
+        self.best = None
+        self.holder = None
+
+    def replace(self, service, old, new):
+        if isnumber(new) and (self.best is None or not self.better(self.best, new)):
+            self.best = new
+            self.holder = service
+        elif service == self.holder:
+            self.rescan()
+
+    def rescan(self):
+        self.best = None
+        self.holder = None
+        for service, v in self.slots.items():
+            if isnumber(v) and (self.best is None or self.better(v, self.best)):
+                self.best = v
+                self.holder = service
+
+    def value(self):
+        return self.best
+
+class maxreducer(extremereducer):
+    def __init__(self):
+        super(maxreducer, self).__init__(lambda a, b: a > b)
+
+class minreducer(extremereducer):
+    def __init__(self):
+        super(minreducer, self).__init__(lambda a, b: a < b)
+
+class allsetreducer(reducer):
+    """ 1 if the value of all batteries is set (true), else 0. """
+
+    def __init__(self):
+        super(allsetreducer, self).__init__()
+        self.nset = 0
+
+    def replace(self, service, old, new):
+        self.nset += bool(new) - bool(old)
+
+    def value(self):
+        return 1 if self.nset == len(self.slots) else 0
+
+class onesetreducer(allsetreducer):
+    """ 1 if the value of at least one battery is set (true), else 0. """
+
+    def value(self):
+        return 1 if self.nset else 0
+
+REDUCERS = {
+    "sum": sumreducer,
+    "avg": avgreducer,
+    "min": minreducer,
+    "max": maxreducer,
+    "allset": allsetreducer,
+    "oneset": onesetreducer,
+    }
+
+class mirrorspec(object):
+    """
+    Which battery paths are monitored and how they are mirrored to the
+    virtual battery, see MIRROR in config.py.
+
+    spec: iterable of (mode, paths) or (mode, paths, min. interval [s]),
+    paths without leading slash. Modes: a reducer name (see REDUCERS),
+    "copy", "input" (monitored for the charge algorithm, not mirrored)
+    and "drop" (fnmatch patterns).
+    default: mode of the paths not in the spec, "drop" or "copy".
+    """
+
+    def __init__(self, spec, default="drop"):
+        super(mirrorspec, self).__init__()
+
+        assert default in ("drop", "copy")
+        self.default = default
+
+        self.modes = {} # path -> mode
+        self.intervals = {} # path -> min. publish interval [s]
+        self.drop = []
+
+        for entry in spec:
+            mode, paths = entry[:2]
+            assert mode in REDUCERS or mode in ("copy", "input", "drop"), f"mirror: unknown mode {mode}"
+            if mode == "drop":
+                self.drop += [ "/" + p for p in paths ]
+                continue
+            for path in paths:
+                self.modes["/" + path] = mode
+                if len(entry) > 2:
+                    self.intervals["/" + path] = entry[2]
+
+    def mode(self, path):
+        mode = self.modes.get(path, None)
+        if mode is not None:
+            return mode
+        if self.default == "copy" and not any(fnmatchcase(path, p) for p in self.drop):
+            return "copy"
+        return "drop"
+
+    def reducers(self):
+        """ Build the path -> reducer registry of the aggregated paths. """
+        return { path: REDUCERS[mode]() for path, mode in self.modes.items() if mode in REDUCERS }
+
+    def select(self, paths):
+        """ The paths to monitor of a battery exporting paths (with leading slash). """
+        return [ path for path in paths if self.mode(path) != "drop" ]
@@ -0,0 +1,156 @@
+"""
+DbusMonitor with a dynamic tree.
+"""
+
+from gi.repository import GLib
+import logging
+
+from dbusmonitor import DbusMonitor, MonitoredValue, Service, VE_INTERFACE
+from ve_utils import exit_on_error, unwrap_dbus_value
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class MyDbusMonitor(DbusMonitor):
+    """
+    DbusMonitor that monitors the paths of its (per class) tree for all services
+    and additional paths of single services added at runtime with
+    add_service_paths().
+
+    One instance shares the bus-wide PropertiesChanged/ItemsChanged receivers
+    for all services, changes are routed by the sender id of the signal.
+    The valueChangedCallback is only called for the services with additional
+    paths (or watched with watch_service()).
+
+    Only the initial scan uses blocking calls, services appearing later are
+    scanned with an asynchronous GetValue on their root.
+    ignoreServices: prefixes of service names not to scan (e.g. our own service).
+    """
+
+    def __init__(self, dbusTree, ignoreServices=(), **kwargs):
+        # service name -> { path: options }, added at runtime
+        self.serviceTree = {}
+        self.ignoreServices = tuple(ignoreServices)
+        self.scanned = False
+        super(MyDbusMonitor, self).__init__(dbusTree, **kwargs)
+        self.scanned = True
+
+    def scan_dbus_service_inner(self, serviceName):
+        if serviceName.startswith(self.ignoreServices):
+            return False
+        return super(MyDbusMonitor, self).scan_dbus_service_inner(serviceName)
+
+    def scan_dbus_service_async(self, serviceName, serviceId):
+        """
+        Non-blocking version of scan_dbus_service(): fetches all values with
+        one asynchronous GetValue, the service is added (and the
+        deviceAddedCallback called) from the reply handler.
+        Paths missing in the reply are stored as None, texts are not fetched.
+        """
+
+        serviceName = str(serviceName)
+
+        paths = self.dbusTree.get('.'.join(serviceName.split('.')[0:3]), None)
+        if paths is None or serviceName.startswith(self.ignoreServices):
+            return
+
+        logger.info(f"Found: {serviceName}, scanning asynchronously")
+
+        def reply(values):
+            exit_on_error(self._add_scanned_service, serviceName, serviceId, paths, values)
+
+        def error(e):
+            logger.error(f"Ignoring {serviceName} because of error while scanning: {e}")
+
+        self.dbusConn.call_async(serviceName, '/', VE_INTERFACE, 'GetValue', '', [],
+                reply_handler=reply, error_handler=error)
+
+    def _add_scanned_service(self, serviceName, serviceId, paths, values):
+
+        if serviceName in self.servicesByName or serviceId in self.servicesById:
+            # Re-appeared while scanning
+            return
+
+        if serviceName == 'com.victronenergy.vebus.ttyO1' and self.vebusDeviceInstance0:
+            di = 0
+        elif serviceName == 'com.victronenergy.settings' or serviceName.startswith('com.victronenergy.vecan.'):
+            di = 0
+        elif 'DeviceInstance' in values:
+            di = int(values['DeviceInstance'])
+        else:
+            logger.info(f"       {serviceName} was skipped because it has no device instance")
+            return
+
+        service = Service(serviceId, serviceName, di)
+        for path, options in paths.items():
+            value = values.get(path[1:], None)
+            if value is not None:
+                service.set_seen(path)
+            service.paths[path] = MonitoredValue(unwrap_dbus_value(value), None, options)
+            if options['whenToLog']:
+                service[options['whenToLog']].append(path)
+
+        self.servicesByName[serviceName] = service
+        self.servicesById[serviceId] = service
+        self.servicesByClass[service.service_class].append(service)
+        logger.info(f"       {serviceName} has device instance {di}, {len(values)} values")
+
+        if self.deviceAddedCallback is not None:
+            self.deviceAddedCallback(serviceName, di)
+
+    def watch_service(self, serviceName):
+        """ Call the valueChangedCallback for the paths of the tree of this service, too. """
+        self.serviceTree.setdefault(serviceName, {})
+
+    def add_service_paths(self, serviceName, paths, values=None):
+        """
+        Start monitoring the additional paths of an already scanned service.
+        values: dict of all values of the service (GetValue on the root),
+        fetched here if not given.
+        """
+
+        service = self.servicesByName[serviceName]
+
+        if values is None:
+            values = self.dbusConn.call_blocking(serviceName, '/', VE_INTERFACE, 'GetValue', '', [])
+
+        for path, options in paths.items():
+            if path in service.paths:
+                continue
+            value = values.get(path[1:], None)
+            if value is not None:
+                service.set_seen(path)
+            service.paths[path] = MonitoredValue(unwrap_dbus_value(value), None, options)
+
+        self.serviceTree[serviceName] = paths
+        logger.info(f"monitoring {len(paths)} additional paths of {serviceName}")
+
+    def _process_name_owner_changed(self, name, oldowner, newowner):
+        if newowner == '':
+            # A re-appearing service is scanned with the paths of the tree only
+            self.serviceTree.pop(name, None)
+        elif self.scanned:
+            self.scan_dbus_service_async(name, newowner)
+            return
+        super(MyDbusMonitor, self)._process_name_owner_changed(name, oldowner, newowner)
+
+    def _handler_value_changes(self, service, path, value, text):
+        try:
+            a = service.paths[path]
+        except KeyError:
+            # path isn't there, which means it hasn't been scanned yet.
+            return
+
+        service.set_seen(path)
+
+        # First update our store to the new value
+        if a.value == value:
+            return
+
+        a.value = value
+        a.text = text
+
+        # And do the rest of the processing in on the mainloop
+        if self.valueChangedCallback is not None and service.name in self.serviceTree:
+            GLib.idle_add(exit_on_error, self._execute_value_changes, service.name, path, {
+                'Value': value, 'Text': text}, a.options)
@@ -0,0 +1,711 @@
+"""
+'SOC-Less' charge algorithm of dbus-ibr-bms, independent of dbus.
+
+The batteries read their inputs through a get_value(service, path) source,
+this is the dbus monitor in the service or a recorded trace in
+tools/replay.py.
+"""
+
+import logging
+import time, math
+
+from venus_service_utils import bound
+from history import timehistory
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+##################################################
+# Configuration:
+from config import *
+##################################################
+
+# Cell voltages
+cellfloat = 3.335
+cellpull = 3.380
+
+MAX_CHARGING_CELL_VOLTAGE = 3.55
+MAX_CHARGING_VOLTAGE = MAX_CHARGING_CELL_VOLTAGE*16 # XXX hardcoded number of cells
+vrange = MAX_CHARGING_CELL_VOLTAGE - cellpull
+
+# Max. time step of the integrators, longer gaps (e.g. a stalled
+# main loop) count as this
+MAX_DT = 5.0 # [s]
+
+# balancer
+BALANCER_CELLDIFF = 0.005 # [V]
+
+# delta bms soc to change from floating state to
+# bulk state
+DELTA_BMSSOC_BALANCE = 0.1 # [%]
+DELTA_BMSSOC_FLOAT = 2.5 # [%]
+
+minbalancesoc = 99 # Estimated SOC when to start balancing
+
+# Dynamic cutoff: the cutoff cell voltage drops from MIN_CELL_VOLTAGE
+# to DYN_CUTOFF_END at a discharge current of 1C
+DYN_CUTOFF_END = 2.6
+DYN_CUTOFF_RANGE = MIN_CELL_VOLTAGE - DYN_CUTOFF_END
+
+class State(object):
+
+    def __init__(self, id):
+        super(State, self).__init__()
+        self.id = id
+
+    def __repr__(self):
+        return self.id
+
+class ChargerStateMachine(object):
+    """
+    Table driven state machine of the charger: on each cycle() the guards
+    of the transitions from the current state are called in order, the
+    first one returning true fires. No transition is the normal case.
+    """
+
+    bulk = State("bulk")
+    balancing = State("balancing")
+    floating = State("floating")
+
+    # state -> ((target, guard), ...)
+    transitions = {
+        bulk: ((balancing, "ladeende"),),
+        balancing: ((floating, "balanced"), (bulk, "discharge")),
+        floating: ((bulk, "discharge"),),
+    }
+
+    # state -> enter hook
+    # Note: the 'on_enter_float' hook is not bound, as with python-statemachine
+    # (the state is called 'floating').
+    enterHooks = {
+        balancing: "on_enter_balancing",
+    }
+
+    def __init__(self):
+        super(ChargerStateMachine, self).__init__()
+        self.current_state = self.bulk
+        self.reset()
+
+    def cycle(self, battery):
+        """ Returns a description of the transition or None. """
+        for target, guard in self.transitions[self.current_state]:
+            if getattr(self, guard)(battery):
+                source = self.current_state
+                self.current_state = target
+                hook = self.enterHooks.get(target, None)
+                if hook:
+                    getattr(self, hook)(battery)
+                return f"cycle from {source.id} to {target.id}"
+        return None
+
+    def reset(self):
+        self.balancetimer = BALANCETIME
+        # self.balancetimer = 5 # BALANCETIME
+
+    def isBalanced(self):
+        assert(self.balancetimer >= 0)
+        return self.balancetimer == 0
+
+    def inBulk(self):
+        return self.current_state == self.bulk
+
+    def isBalancing(self):
+        return self.current_state == self.balancing
+
+    def isFloating(self):
+        return self.current_state == self.floating
+
+    def ladeende(self, battery):
+        logger.debug("    Batt %s, State %s: ladeende: estsoc: %.1f%%", battery.batt[-1], self.current_state, battery.estsoc)
+        
+        if not battery.bhistory.valid():
+            logger.debug("    Filling history %d / %d", battery.bhistory.n(), battery.bhistory.nhist)
+            return False
+
+        return battery.estsoc >= minbalancesoc
+
+    def balanced(self, battery):
+        logger.debug("    Batt %s, State %s: balanced: celldiff: %.3f, timer: %ds", battery.batt[-1], self.current_state, battery.voltagediff, self.balancetimer)
+        if self.balancetimer and (battery.voltagediff < BALANCER_CELLDIFF):
+            assert(self.balancetimer >= 0)
+            self.balancetimer = max(self.balancetimer - battery.dt, 0)
+        return self.balancetimer == 0
+
+    def discharge(self, battery):
+
+        logger.debug("    Batt %s, State %s, discharge: bmssoc: %.1f%%, start: %s%%", battery.batt[-1], self.current_state, battery.bmssoc, self.start_bmssoc)
+
+        if battery.bmssoc > self.start_bmssoc:
+            self.start_bmssoc = battery.bmssoc
+            return False
+
+        if self.isBalancing():
+            return battery.bmssoc < (self.start_bmssoc - DELTA_BMSSOC_BALANCE)
+
+        return battery.bmssoc < (self.start_bmssoc - DELTA_BMSSOC_FLOAT)
+
+    def on_enter_balancing(self, battery):
+        logger.info(f"enter balancing charging, Start soc: {battery.bmssoc:.1f}")
+        self.start_bmssoc = battery.bmssoc
+
+    def on_enter_float(self, battery):
+        logger.info(f"enter float charging, Start soc: {battery.bmssoc:.1f}")
+        self.start_bmssoc = battery.bmssoc
+
+    # def on_enter_bulk(self):
+        # logger.info("Bulk charging.")
+
+    # def on_enter_float(self):
+        # logger.info("float charging.")
+
+    # def on_exit_red(self):
+        # logger.info("Go ahead!")
+
+
+# umin = 3.35
+umin = cellfloat - 0.020
+def fu(u, bcv):
+    if u < umin:
+        return 0
+    return min((u-umin)/(bcv-umin), 1)
+
+# Todo: use common expfilter class
+class expfilter(object):
+    value = 0
+    k = 0
+
+    def __init__(self, iv, k):
+        super(expfilter, self).__init__()
+
+        self.value = iv
+        self.k = k
+
+    # k is the filter constant of a 1s step
+    def filter(self, value, dt=1.0):
+        k = 1.0 - math.pow(1.0-self.k, dt)
+        self.value = k*value + (1.0-k)*self.value
+
+class battery(object):
+
+    def __init__(self, dbusmon, servicename):
+        super(battery, self).__init__()
+
+        self.dbusmon = dbusmon
+        self.batt = servicename
+        self.id = servicename[-1]
+
+        self.bhistory = timehistory(30) # self.history.nhist), 1s buckets
+        self.ysum = 0
+        self.lastbcv = None
+
+        # self.kp = 1 # 1.25
+        # self.ki = 0.025
+        self.kp = 0.75 # 1 # 1.25
+        self.ki = 0.02 # 0.025
+
+        self.sm = ChargerStateMachine()
+
+        self.testdone = False
+
+        self.cellCutoff = 0
+        self.turnOff = False
+        self.start_emergency = 0
+        self.slowCharge = False
+
+        self.readInfo()
+
+    # Read the static values, again when a removed battery re-appears
+    def readInfo(self):
+        self.BATTERY_CAPACITY = self.get_value("/InstalledCapacity")
+        self.maxChargeCurrent = self.get_value("/Info/MaxChargeCurrent")
+
+        self.c100 = max(self.BATTERY_CAPACITY/100, 1)
+        logger.info(f"BATTERY_CAPACITY: {self.BATTERY_CAPACITY}, maxChargeCurrent: {self.maxChargeCurrent}")
+
+    def get_value(self, path):
+        return self.dbusmon.get_value(self.batt, path)
+
+    # State for a snapshot, see snapshot.py
+    def getstate(self):
+        return {
+            "state": self.sm.current_state.id,
+            "balancetimer": self.sm.balancetimer,
+            "start_bmssoc": getattr(self.sm, "start_bmssoc", None),
+            "bhistory": self.bhistory.values(),
+            "ysum": self.ysum,
+            "lastbcv": self.lastbcv,
+            "turnOff": self.turnOff,
+            "start_emergency": self.start_emergency,
+            "slowCharge": self.slowCharge,
+            }
+
+    def setstate(self, state):
+        # Raises KeyError, TypeError or ValueError on an invalid state,
+        # before anything is changed
+        states = [ st for st in ChargerStateMachine.transitions if st.id == state["state"] ]
+        if not states:
+            raise ValueError(f"unknown state {state['state']}")
+        bhistory = [ float(v) for v in state["bhistory"] ]
+        values = { key: state[key] for key in ("balancetimer", "start_bmssoc", "ysum", "lastbcv",
+                "turnOff", "start_emergency", "slowCharge") }
+
+        self.sm.current_state = states[0]
+        self.sm.balancetimer = values["balancetimer"]
+        if values["start_bmssoc"] is not None:
+            self.sm.start_bmssoc = values["start_bmssoc"]
+        for v in bhistory:
+            self.bhistory.update(v)
+        self.ysum = values["ysum"]
+        self.lastbcv = values["lastbcv"]
+        self.turnOff = values["turnOff"]
+        self.start_emergency = values["start_emergency"]
+        self.slowCharge = values["slowCharge"]
+        logger.info(f"Batt {self.batt}: restored state {state['state']}, ysum: {self.ysum:.3f}")
+
+    def resetDaily(self):
+        self.sm.reset()
+
+    def isBalanced(self):
+        return self.sm.isBalanced()
+
+    def inBulk(self):
+        return self.sm.inBulk()
+
+    def isBalancing(self):
+        return self.sm.isBalancing()
+
+    def isFloating(self):
+        return self.sm.isFloating()
+
+    def isThrottling(self):
+        if self.sm.current_state == self.sm.bulk:
+            return False
+        if self.isBalancing() or self.sm.current_state == self.sm.floating:
+            return True
+
+    def fi(self, i):
+        if i > self.maxChargeCurrent:
+            return 0
+        elif i < self.c100:
+            return 1
+        return (1-((i-self.c100)/(self.maxChargeCurrent-self.c100)))
+
+    # dt: time since the last update [s]
+    def update(self, cvavg, allfloat, dt=1.0):
+        """
+        One step of the charge algorithm of this battery. The phases are
+        separate methods, packcore.py runs target() and regulate() for all
+        batteries at once.
+        """
+        self.read(dt)
+        self.target(allfloat)
+        self.cycle()
+        self.regulate(cvavg)
+        self.protect()
+
+    # Read the inputs
+    def read(self, dt):
+
+        self.dt = dt
+
+        self.ubatt = self.dbusmon.get_value(self.batt, "/Dc/0/Voltage")
+        self.cbatt = self.dbusmon.get_value(self.batt, "/Dc/0/Current")
+        self.ucell = self.dbusmon.get_value(self.batt, "/System/MaxCellVoltage")
+        self.ucell_min = self.dbusmon.get_value(self.batt, "/System/MinCellVoltage")
+        self.voltagediff = self.dbusmon.get_value(self.batt, "/Voltages/Diff")
+        self.bmssoc = self.dbusmon.get_value(self.batt, "/Soc")
+
+        self.bhistory.add(self.cbatt, dt)
+        self.cavg = self.bhistory.As()
+
+    # Target cell voltage (self.nextbcv) and estimated soc
+    def target(self, allfloat):
+
+        cavg = self.cavg
+
+        if self.sm.current_state == self.sm.bulk:
+            bcv = max(
+                cellpull,
+                round( min( cellpull + vrange * (cavg-self.c100) / self.maxChargeCurrent, MAX_CHARGING_CELL_VOLTAGE ), 2)
+                )
+        elif self.sm.current_state == self.sm.balancing:
+            bcv = cellpull
+        else: # float
+            if allfloat:
+                bcv = cellfloat
+            else:
+                bcv = cellpull
+
+        self.nextbcv = bcv
+        self.f_u = fu(self.ucell, bcv)
+        self.f_i = self.fi(cavg)
+        self.estsoc = min( self.f_u * self.f_i * 100, 99 )
+
+        # yyyy debug
+        """
+        if not self.testdone:
+            if self.sm.current_state == self.sm.bulk:
+                self.estsoc = 99
+                self.debugtime = time.time()
+            if self.sm.current_state == self.sm.balancing:
+                if time.time() - self.debugtime < 10:
+                    self.estsoc = 99
+            elif self.sm.current_state == self.sm.floating:
+                self.testdone = True
+        """
+
+    def cycle(self):
+        res = self.sm.cycle(self)
+        if res != None:
+            logger.info(f"Batt {self.batt}: State Event: {res}")
+
+    # PI controller of the charge voltage and dynamic cutoff voltage
+    def regulate(self, cvavg):
+
+        bcv = self.nextbcv
+        ubatt = self.ubatt
+
+        if self.lastbcv and self.lastbcv != bcv:
+            dv = bcv - self.lastbcv
+            logger.debug("adjusting ysum: %s", 16*dv)
+            self.ysum -= 16*dv
+
+        self.lastbcv = self.bcv = bcv
+
+        diff = 0
+        if self.ucell > bcv:
+            #diff -= 16 * 2* (self.ucell - bcv)
+            diff -= 16 * (self.ucell - bcv)
+        else:
+            diff += 16 * min(bcv - self.ucell, 0.005)
+
+        logger.debug("    U: %.3fV, I: %.3fA, iavg: %.3fA, max: %.3fV, bcv: %.3fV, diff: %.3fV", ubatt, self.cbatt, self.cavg, self.ucell, bcv, diff)
+
+        diffvolt = max( min(cvavg - ubatt, 1), 0)
+
+        self.ysum += diff * self.ki * self.dt
+
+        if self.ysum > 0.75:
+            self.ysum = 0.75
+        elif self.ysum < -1.5:
+            self.ysum = -1.5
+
+        cv = 16*bcv + self.kp*diff + self.ysum + diffvolt
+        logger.debug("    CV: %.3fV + %.3f(P) + %.3f(ysum) + %.3f(cable) = %.3f", 16*bcv, self.kp*diff, self.ysum, diffvolt, cv)
+            
+        self.chargevoltage = cv
+        logger.debug("    fu: %.2f, fi: %.2f, estimsoc: %.1f%%", self.f_u, self.f_i, self.estsoc)
+
+        # Dynamic cut off voltage
+        # dynCutoffRange = 0.25 
+        if self.cbatt:
+            self.cellCutoff = bound(
+                    DYN_CUTOFF_END,
+                    MIN_CELL_VOLTAGE + DYN_CUTOFF_RANGE * (self.cbatt/self.BATTERY_CAPACITY),
+                    MIN_CELL_VOLTAGE)
+        else:
+            self.cellCutoff = MIN_CELL_VOLTAGE
+
+    # Turn off and slow charge at low cell voltages
+    def protect(self):
+
+        ucell_min = self.ucell_min
+
+        if ucell_min <= self.cellCutoff:
+            if not self.turnOff:
+                # Note soc where we started emergency mode
+                self.start_emergency = self.bmssoc
+                logger.info(f"Batt {self.batt}: turnoff, min cell voltage {ucell_min:.3f}V, emergency soc: {self.start_emergency}")
+            self.turnOff = True
+        else:
+            if self.turnOff and self.bmssoc >= self.start_emergency + 2.5:
+                logger.info(f"Batt {self.batt}: turnoff end, soc: {self.bmssoc}")
+                self.turnOff = False
+
+        # Handle slow charge when cell-voltages too low
+        if ucell_min <= 2.6:
+            if not self.slowCharge:
+                logger.info(f"Batt {self.batt}: start slow charge, min cell voltage {ucell_min:.3f}V")
+            self.slowCharge = True
+        elif ucell_min >= 2.9:
+            self.slowCharge = False
+
+        logger.debug("    minvolt: %.3fV, cellcutoff: %.3fV, turnoff: %s, slowcharge: %s.", ucell_min, self.cellCutoff, self.turnOff, self.slowCharge)
+
+
+class chargecontrol(object):
+    """
+    Control step of the virtual battery: runs the charge algorithm of all
+    batteries and combines it into the DVCC values (charge voltage and
+    current limit), the balancing/charge mode and the (fake) SOC.
+    """
+
+    def __init__(self, trace=None):
+        super(chargecontrol, self).__init__()
+
+        self.trace = trace # recorder.tracer or None
+
+        self.batteries = {}
+
+        # Removed batteries: service -> (battery, time of removal (mono of step()))
+        self.parked = {}
+        # Output limits while a battery is missing
+        self.heldcv = None
+        self.heldcc = None
+        self.lastcv = None
+        self.lastcc = None
+
+        self.turnedOff = False
+        self.turnOnSoc = 0
+        self.forceSoc = 0
+
+        # self.CGES = 0
+        self.CGES20 = 0
+        self.maxChargeCurrent = 0
+
+        self.chargevoltage = 16 * cellfloat # xxx hardcoded
+        self.maxccfilter = expfilter(10, 0.25)
+
+        self.lastTime = None
+
+        # Charge/discharge current per second (=throughput [As]), with minute and hour windows
+        self.history = timehistory(30, (60, 3600))
+
+        # Restored battery states of a snapshot: service -> state
+        self.restored = {}
+
+        # Batched update of many batteries, see packcore.py
+        self.core = None
+        if VECTORIZE_MIN_PACKS:
+            import packcore
+            if packcore.np is not None:
+                self.core = packcore.packcore()
+
+    def getstate(self):
+        """ State for a snapshot, see snapshot.py """
+        return {
+            "turnedOff": self.turnedOff,
+            "turnOnSoc": self.turnOnSoc,
+            "maxcc": self.maxccfilter.value,
+            "batteries": { batt: b.getstate() for batt, b in self.batteries.items() },
+            }
+
+    def setstate(self, state):
+        # Raises KeyError, TypeError or ValueError on an invalid state,
+        # before anything is changed
+        turnedOff, turnOnSoc, maxcc = state["turnedOff"], state["turnOnSoc"], state["maxcc"]
+        # Applied when the batteries are added
+        restored = dict(state["batteries"])
+
+        self.turnedOff = turnedOff
+        self.turnOnSoc = turnOnSoc
+        self.maxccfilter.value = maxcc
+        self.restored = restored
+
+    def addBattery(self, batt, battObj):
+        self.batteries[batt] = battObj
+
+        if batt in self.restored:
+            try:
+                battObj.setstate(self.restored.pop(batt))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Batt {batt}: invalid snapshot state ({e!r}), cold start")
+
+        # self.CGES += battObj.BATTERY_CAPACITY
+        self.CGES20 += max(battObj.BATTERY_CAPACITY/20, 1)
+        self.maxChargeCurrent += battObj.maxChargeCurrent
+        logger.info(f"newbatt: CGES20 {self.CGES20}, maxChargeCurrent: {self.maxChargeCurrent}")
+
+    def removeBattery(self, batt, now):
+        battObj = self.batteries.pop(batt)
+
+        self.CGES20 -= max(battObj.BATTERY_CAPACITY/20, 1)
+        self.maxChargeCurrent -= battObj.maxChargeCurrent
+
+        self.parked[batt] = (battObj, now)
+
+        # Hold the outputs at or below the current values until the battery is back
+        if self.lastcv is not None:
+            self.heldcv = min(self.lastcv, self.heldcv or self.lastcv)
+            self.heldcc = min(self.lastcc, self.heldcc if self.heldcc is not None else self.lastcc)
+
+        logger.info(f"removed batt {batt}: CGES20 {self.CGES20}, maxChargeCurrent: {self.maxChargeCurrent}, hold cv: {self.heldcv}, cc: {self.heldcc}")
+        return battObj
+
+    def unpark(self, batt):
+        """ Returns the battery object of a re-appeared battery, or None. """
+        if batt not in self.parked:
+            return None
+        battObj, t = self.parked.pop(batt)
+        battObj.readInfo()
+        logger.info(f"reusing state of batt {batt}")
+        return battObj
+
+    def expire(self, now):
+        for batt, (battObj, t) in list(self.parked.items()):
+            if now - t >= BATTERY_HOLD_TIME:
+                logger.info(f"batt {batt} did not re-appear, dropping its state")
+                del self.parked[batt]
+        if not self.parked:
+            self.heldcv = self.heldcc = None
+
+    def step(self, cvavg, loadcurrent, now, mono=None):
+        """
+        One control step.
+        cvavg: average charger voltage, loadcurrent: inverter dc current (<= 0),
+        now: wall clock time of the step [s] (daily reset, trace),
+        mono: monotonic time of the step [s] (elapsed time, removed
+        batteries, see removeBattery()), default: now.
+        Returns the values to publish: { path: value }.
+        """
+
+        if mono is None:
+            mono = now
+
+        # Time since the last step, the integrators use the elapsed
+        # time (1s steps in timer mode, irregular in event mode).
+        dt = bound(0.0, mono - self.lastTime, MAX_DT) if self.lastTime is not None else 1.0
+        self.lastTime = mono
+
+        self.expire(mono)
+
+        if not self.batteries:
+            if self.parked:
+                # Keep the last outputs until the battery is back
+                return {}
+            # No battery: stop charging
+            return { "/Info/MaxChargeCurrent": 0 }
+
+        allbulk = not (False in map(lambda b: b.inBulk(), self.batteries.values()))
+        allbalanced = not (False in map(lambda b: b.isBalanced(), self.batteries.values()))
+        allfloat = not (False in map(lambda b: b.isFloating(), self.batteries.values()))
+
+        balancing = set() # List of batteries to balance (top or bottom balancing (if turned off))
+        turnOff = [] # List of turned off batteries
+        throttling = False
+        chgmode = "bulk"
+        slowCharge = False # Slow charge flag
+        avgsoc = []
+        cellCutoff = []
+
+        if self.core and len(self.batteries) >= VECTORIZE_MIN_PACKS and not logger.isEnabledFor(logging.DEBUG):
+            self.core.update(self.batteries, cvavg, allfloat, dt)
+        else:
+            for batt in self.batteries.values():
+                batt.update(cvavg, allfloat, dt)
+
+        for batt in self.batteries.values():
+
+            battname = batt.batt.split(".")[-1]
+
+            avgsoc.append(batt.bmssoc)
+            cellCutoff.append(batt.cellCutoff)
+
+            # control balancers
+            if not (allbulk or allfloat or allbalanced):
+                if batt.isBalancing() or batt.isBalanced():
+                    balancing.add(battname)
+
+            # Reset balancing state at midnight
+            if batt.isBalanced() and time.localtime(now).tm_hour == 0:
+                batt.resetDaily()
+
+            if batt.isThrottling():
+                throttling = True
+
+            if batt.isBalancing():
+                chgmode = "balancing"
+            elif allfloat:
+                chgmode = "floating"
+
+            if batt.turnOff:
+                turnOff.append(battname)
+                balancing.add(battname)
+
+            if batt.slowCharge:
+                slowCharge = True
+
+        avgsoc = sum(avgsoc) / len(avgsoc)
+
+        outputs = {
+            '/Ess/Balancing': list(balancing),
+            '/Ess/Chgmode': chgmode,
+            '/Ess/Throttling': throttling,
+        }
+
+        currsum = sum(map(lambda b: b.cbatt, self.batteries.values()))
+        self.history.add(currsum, dt)
+
+        socs = map(lambda b: b.estsoc, self.batteries.values())
+        estsoc = sum(socs) / len(self.batteries)
+
+        self.maxccfilter.filter( min(self.maxChargeCurrent, self.CGES20 + self.maxChargeCurrent * (1 - math.pow(estsoc/99.0, 2)) - loadcurrent), dt )
+
+        chargevoltages = map(lambda b: b.chargevoltage, self.batteries.values())
+        self.chargevoltage = min(chargevoltages)
+
+        if self.chargevoltage > MAX_CHARGING_VOLTAGE:
+            logger.debug("    cap cv!: %.3fV to MAX_CHARGING_VOLTAGE: %.3fV", self.chargevoltage, MAX_CHARGING_VOLTAGE)
+            self.chargevoltage = MAX_CHARGING_VOLTAGE
+
+        logger.debug("batt current: %.3fA, 1h: %.1fAh, loadcurrent: %.3f, estsoc: %.1f%%", currsum, self.history.sum(3600)/3600, loadcurrent, estsoc)
+
+        v = round(self.chargevoltage, 3)
+        i = round(self.maxccfilter.value)
+        if self.parked and self.heldcv is not None:
+            logger.debug("    battery missing, hold cv: %.3fV, cc: %sA", self.heldcv, self.heldcc)
+            v = min(v, self.heldcv)
+            i = min(i, self.heldcc)
+        self.lastcv = v
+        self.lastcc = i
+        outputs[ "/Info/MaxChargeVoltage" ] = v
+        outputs[ "/Info/MaxChargeCurrent" ] = i
+
+        logger.debug("chargevoltage: %.3fV, charge current: %sA", v, i)
+
+        # turn on/off battery
+        essminsoc = 10 # xxx must match setting in ESS/inverter
+        if turnOff:
+            if not self.turnedOff:
+                self.turnedOff = True
+                self.turnOnSoc = max(avgsoc + 25, essminsoc + 25) # xxx make a setting "TurnOnThreshold" for this
+                logger.info(f"turned off: {turnOff}, avg-soc: {avgsoc:.1f}%, turnOnSoc: {self.turnOnSoc:.1f}%")
+        else:
+            if self.turnedOff and avgsoc >= self.turnOnSoc:
+                self.turnedOff = False
+                logger.info(f"turned on, avg-soc: {avgsoc:.1f}%")
+
+        outputs[ "/Info/TurnOnSoc" ] = self.turnOnSoc
+        outputs[ "/Info/RealSoc" ] = avgsoc
+        outputs[ "/Info/CutOffVoltage" ] = min(cellCutoff)
+
+        fakesoc = avgsoc
+        if self.turnedOff:
+            # # force batt off?
+            # fakesoc = min(avgsoc, essminsoc)
+            # # avoid victron ess charging start (starting at 5% soc?)
+            # fakesoc = max(fakesoc, 6) 
+
+            # force batt off?
+            # avoid victron ess charging start (starting at 5% soc?)
+            # fakesoc = bound(6, avgsoc, essminsoc)
+
+            if slowCharge:
+                fakesoc = 4
+            else:
+                fakesoc = bound(6, avgsoc, essminsoc)
+        else:
+            # keep batt alive?
+            fakesoc = max(avgsoc, essminsoc + 4) # SocSwitchOffset = 3.0
+
+        if self.forceSoc:
+            fakesoc = self.forceSoc
+
+        logger.debug("turnOff: %s, TurnedOff: %s, avg-soc: %.1f%%, fake-soc: %.1f%%, turnOnSoc: %.1f%%", turnOff, self.turnedOff, avgsoc, fakesoc, self.turnOnSoc)
+        outputs[ "/Soc" ] = fakesoc
+
+        if self.trace:
+            for batt in self.batteries.values():
+                self.trace.record(now, batt, cvavg, loadcurrent, outputs, self.turnedOff)
+
+        return outputs
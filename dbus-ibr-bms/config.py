@@ -8,6 +8,131 @@ BALANCETIME = 5 * 60 # [s]
 # lower cell voltage when dischargecurrent is 1C.
 MIN_CELL_VOLTAGE = 3.1
 
+# Value changes of the virtual battery are collected and sent
+# as one ItemsChanged signal. Window to collect the changes, 0 means
+# to send them at the end of the current main loop iteration.
+PUBLISH_WINDOW = 0 # [ms], 0 or 100...250
+
+# A removed battery (e.g. restart of its driver) is kept for this time,
+# if it re-appears its state is reused. While it is missing, the charge
+# voltage and current are held at or below the values at the removal.
+BATTERY_HOLD_TIME = 5 * 60 # [s]
+
+# In-memory trace of the charge algorithm, one record (~90 bytes)
+# per battery and second, e.g. 4 batteries for 3 hours.
+# Writing /Ibr/Trace/Dump dumps it to a csv file in TRACE_DIR, named
+# like the value written (a file name, no path) or by the time if empty.
+TRACE_RECORDS = 4 * 3 * 3600
+TRACE_DIR = "/data/log"
+
+# Retry of a failed GetValue of a new battery, the delay doubles
+# from ONBOARD_RETRY_MIN up to ONBOARD_RETRY_MAX.
+ONBOARD_RETRY_MIN = 1 # [s]
+ONBOARD_RETRY_MAX = 60 # [s]
+
+# Snapshot of the charger state (state machine, integrator, history),
+# written every SNAPSHOT_INTERVAL and on termination, restored on start
+# if not older than SNAPSHOT_MAXAGE.
+SNAPSHOT_FILE = "/data/ibrbms-state.json"
+SNAPSHOT_INTERVAL = 10 * 60 # [s]
+SNAPSHOT_MAXAGE = 30 * 60 # [s]
+
+# Control tick:
+# "timer": every second
+# "event": when the battery inputs of the algorithm (cell voltages, current)
+# change, at most every TICK_MIN_INTERVAL and at least every TICK_MAX_INTERVAL.
+TICK_MODE = "timer"
+TICK_MIN_INTERVAL = 250 # [ms]
+TICK_MAX_INTERVAL = 2000 # [ms]
+
+# Interval to publish the performance counters (/Ibr/Perf/*),
+# the latency percentiles cover this interval.
+PERF_INTERVAL = 10 # [s]
+
+# Mirroring of the battery paths to the virtual battery. Only the
+# paths listed here are monitored (signals in) and published (signals out).
+# Entries: (mode, paths) or (mode, paths, min. publish interval [s]).
+# Modes:
+# "sum", "avg", "min", "max": aggregate of all batteries
+# "allset", "oneset": 1 if the value of all/one of the batteries is set
+# "copy": the value of the battery that changed last
+# "input": read by the charge algorithm only, not published
+# "drop": not monitored (fnmatch patterns), see MIRROR_DEFAULT
+MIRROR = (
+    ("sum", (
+        "Info/MaxDischargeCurrent",
+        "Dc/0/Current",
+        "InstalledCapacity",
+        "System/NrOfModulesOnline",
+        "System/NrOfModulesOffline",
+        "System/NrOfModulesBlockingCharge",
+        "System/NrOfModulesBlockingDischarge",
+        "Alarms/CellImbalance",
+        "Alarms/HighCellVoltage",
+        "Alarms/HighChargeCurrent",
+        "Alarms/InternalFailure_alarm",
+        "Alarms/HighChargeTemperature",
+        "Alarms/HighDischargeCurrent",
+        "Alarms/HighTemperature",
+        "Alarms/HighVoltage",
+        "Alarms/InternalFailure",
+        "Alarms/LowCellVoltage",
+        "Alarms/LowChargeTemperature",
+        "Alarms/LowSoc",
+        "Alarms/LowTemperature",
+        "Alarms/LowVoltage",
+        "Alarms/BmsCable",
+        )),
+    ("sum", ("Dc/0/Power",), 5),
+    ("sum", ("ConsumedAmphours", "Capacity"), 10),
+    ("min", ("System/MinCellVoltage",)),
+    ("min", ("System/MinCellTemperature",), 10),
+    ("max", (
+        "Info/BatteryLowVoltage",
+        "Dc/0/Voltage",
+        "System/MaxCellVoltage",
+        "Voltages/Diff",
+        )),
+    ("max", ("Dc/0/Temperature", "System/MaxCellTemperature"), 10),
+    ("allset", ("Io/AllowToCharge", "Io/AllowToDischarge", "Io/AllowToBalance")),
+    ("input", ("Soc", "Info/MaxChargeCurrent")),
+    # Copied for older consumers of the virtual battery
+    ("copy", (
+        "System/MinVoltageCellId", "System/MaxVoltageCellId",
+        "System/MinTemperatureCellId", "System/MaxTemperatureCellId",
+        "CustomName", "Info/ChargeRequest",
+        )),
+    # Not meaningful for the virtual battery (per pack values like the
+    # cell arrays, own paths), only with MIRROR_DEFAULT = "copy"
+    ("drop", (
+        "Mgmt/*", "DeviceInstance", "ProductId", "ProductName", "FirmwareVersion",
+        "HardwareVersion", "Connected", "Dc/0/MidVoltage*", "History/*",
+        "System/NrOfCellsPerBattery", "Voltages/Cell*", "Balances/*",
+        "Info/MaxChargeVoltage", "Ess/*", "Ibr/*",
+        )),
+    )
+# Mode of the paths not in MIRROR: "drop" (only the paths in MIRROR) or
+# "copy" (mirror all other paths, as older versions did).
+MIRROR_DEFAULT = "drop"
+
+# Change suppression of the outputs, see outputpolicy.py:
+# deadband, hold [s], slew [1/s], refresh [s], immediatedown
+OUTPUT_POLICY = {
+    "/Info/MaxChargeVoltage": { "deadband": 0.01, "hold": 2, "slew": 0.1, "refresh": 60, "immediatedown": True },
+    "/Info/MaxChargeCurrent": { "deadband": 2, "hold": 5, "slew": 5, "refresh": 60, "immediatedown": True },
+    "/Soc": { "deadband": 0.5, "hold": 10, "refresh": 60, "immediatedown": True },
+    "/Info/RealSoc": { "deadband": 0.5, "hold": 10, "refresh": 60 },
+    "/Info/CutOffVoltage": { "deadband": 0.01, "hold": 10, "refresh": 60 },
+    }
+
+# Update the charge algorithm of all batteries in one NumPy pass
+# (packcore.py) from this number of batteries on, 0: disabled (default),
+# without NumPy the per battery update is used anyway.
+# tools/bench_packcore.py (speedup of the NumPy pass): 0.28x at 1, 0.51x
+# at 4, 0.81x at 16, 0.97x at 32, 1.06x at 48, 1.19x at 128 batteries;
+# the crossover is at about 40 batteries, no gain for real banks.
+VECTORIZE_MIN_PACKS = 0
+
 # Service name for debugging
 SERVICENAME="battery"
 
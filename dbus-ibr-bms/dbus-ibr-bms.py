@@ -7,17 +7,22 @@ to implement a 'SOC-Less' charging/discharging algorithm for them.
 
 from gi.repository import GLib
 import logging
-import sys, os, time, math
-import dbus
+import sys, os, time, math, signal
 import datetime
 
 sys.path.insert(1, '/data/ibr-venus-services/common/velib_python')
 sys.path.insert(1, '/data/ibr-venus-services/common/python')
 
 from vedbus import VeDbusService
-from dbusmonitor import DbusMonitor, Service, notfound, MonitoredValue
 from ve_utils import exit_on_error
 from venus_service_utils import *
+from aggregate import *
+from busmonitor import MyDbusMonitor
+from chargealgo import *
+from recorder import tracer
+import snapshot
+import perf
+from outputpolicy import outputpolicy
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -27,430 +32,65 @@ logger.setLevel(logging.INFO)
 from config import *
 ##################################################
 
-# Current
-
-
-# Cell voltages
-cellfloat = 3.335
-cellpull = 3.380
-
-MAX_CHARGING_CELL_VOLTAGE = 3.55
-MAX_CHARGING_VOLTAGE = MAX_CHARGING_CELL_VOLTAGE*16 # XXX hardcoded number of cells
-vrange = MAX_CHARGING_CELL_VOLTAGE - cellpull
-
-# balancer
-BALANCER_CELLDIFF = 0.005 # [V]
-
-# delta bms soc to change from floating state to
-# bulk state
-DELTA_BMSSOC_BALANCE = 0.1 # [%]
-DELTA_BMSSOC_FLOAT = 2.5 # [%]
-
 VERSION = "0.1"
 
-from statemachine import StateMachine, State
-from statemachine.exceptions import TransitionNotAllowed
-
-minbalancesoc = 99 # Estimated SOC when to start balancing
-
-class ChargerStateMachine(StateMachine):
-    bulk = State(initial=True)
-    balancing = State()
-    floating = State()
-
-    cycle = (
-        bulk.to(balancing, cond="ladeende")
-        | balancing.to(floating, cond="balanced")
-        | balancing.to(bulk, cond="discharge")
-        | floating.to(bulk, cond="discharge")
-    )
-
-    def __init__(self):
-        super(ChargerStateMachine, self).__init__()
-        self.reset()
-
-    def reset(self):
-        self.balancetimer = BALANCETIME
-        # self.balancetimer = 5 # BALANCETIME
-
-    def isBalanced(self):
-        assert(self.balancetimer >= 0)
-        return self.balancetimer == 0
-
-    def inBulk(self):
-        return self.current_state == self.bulk
-
-    def isBalancing(self):
-        return self.current_state == self.balancing
-
-    def isFloating(self):
-        return self.current_state == self.floating
-
-    def ladeende(self, battery):
-        logger.info(f"    Batt {battery.batt[-1]}, State {self.current_state}: ladeende: estsoc: {battery.estsoc:.1f}%")
-        
-        if not battery.bhistory.valid():
-            logger.info(f"    Filling history {battery.bhistory.n()} / {battery.bhistory.nhist}")
-            return False
-
-        return battery.estsoc >= minbalancesoc
-
-    def balanced(self, battery):
-        logger.info(f"    Batt {battery.batt[-1]}, State {self.current_state}: balanced: celldiff: {battery.voltagediff:.3f}, timer: {self.balancetimer}s")
-        if self.balancetimer and (battery.voltagediff < BALANCER_CELLDIFF):
-            assert(self.balancetimer >= 0)
-            self.balancetimer -= 1
-        return self.balancetimer == 0
-
-    def discharge(self, battery):
-
-        logger.info(f"    Batt {battery.batt[-1]}, State {self.current_state}, discharge: bmssoc: {battery.bmssoc:.1f}%, start: {self.start_bmssoc}%")
-
-        if battery.bmssoc > self.start_bmssoc:
-            self.start_bmssoc = battery.bmssoc
-            return False
-
-        if self.isBalancing():
-            return battery.bmssoc < (self.start_bmssoc - DELTA_BMSSOC_BALANCE)
-
-        return battery.bmssoc < (self.start_bmssoc - DELTA_BMSSOC_FLOAT)
-
-    def on_enter_balancing(self, battery):
-        logger.info(f"enter balancing charging, Start soc: {battery.bmssoc:.1f}")
-        self.start_bmssoc = battery.bmssoc
-
-    def on_enter_float(self, battery):
-        logger.info(f"enter float charging, Start soc: {battery.bmssoc:.1f}")
-        self.start_bmssoc = battery.bmssoc
-
-    def before_cycle(self, event: str, source: State, target: State, message: str = ""):
-        message = ". " + message if message else ""
-        return f"{event} from {source.id} to {target.id}{message}"
-
-    # def on_enter_bulk(self):
-        # logger.info("Bulk charging.")
-
-    # def on_enter_float(self):
-        # logger.info("float charging.")
-
-    # def on_exit_red(self):
-        # logger.info("Go ahead!")
-
-
-class MyDbusMonitor(DbusMonitor):
-
-    def scan_dbus_service_inner(self, *args, **kwargs):
-        exit_on_error(self._scan_dbus_service_inner, *args, **kwargs)
-
-    def _scan_dbus_service_inner(self, serviceName):
-        paths = self.dbusTree.get(serviceName, None)
-        if paths is None:
-            logger.debug("Ignoring service %s, not in the tree" % serviceName)
-            return False
-
-        logger.info("Found: %s, scanning and storing items" % serviceName)
-        serviceId = self.dbusConn.get_name_owner(serviceName)
-
-        # we should never be notified to add a D-Bus service that we already have. If this assertion
-        # raises, check process_name_owner_changed, and D-Bus workings.
-        assert serviceName not in self.servicesByName
-        assert serviceId not in self.servicesById
-
-        try:
-            di = self.dbusConn.call_blocking(serviceName,
-                '/DeviceInstance', None, 'GetValue', '', [])
-        except dbus.exceptions.DBusException:
-            logger.info("       %s was skipped because it has no device instance" % serviceName)
-            return False # Skip it
-
-        logger.info("       %s has device instance %s" % (serviceName, di))
-        service = Service(serviceId, serviceName, di)
-
-        # Let's try to fetch everything in one go
-        values = {}
-        try:
-            values.update(self.dbusConn.call_blocking(serviceName, '/', None, 'GetValue', '', []))
-        except:
-            pass
-
-        for path, options in paths.items():
-            # path will be the D-Bus path: '/Ac/ActiveIn/L1/V'
-            # options will be a dictionary: {'code': 'V', 'whenToLog': 'onIntervalAlways'}
-            # check that the whenToLog setting is set to something we expect
-            assert options['whenToLog'] is None or options['whenToLog'] in Service.whentologoptions
-
-            # Try to obtain the value we want from our bulk fetch. If we
-            # cannot find it there, do an individual query.
-            value = values.get(path[1:], notfound)
-            if value != notfound:
-                service.set_seen(path)
-            else:
-                try:
-                    value = self.dbusConn.call_blocking(serviceName, path, None, 'GetValue', '', [])
-                    service.set_seen(path)
-                except dbus.exceptions.DBusException as e:
-                    if e.get_dbus_name() in (
-                            'org.freedesktop.DBus.Error.ServiceUnknown',
-                            'org.freedesktop.DBus.Error.Disconnected'):
-                        raise # This exception will be handled below
-
-                    # TODO org.freedesktop.DBus.Error.UnknownMethod really
-                    # shouldn't happen but sometimes does.
-                    logger.info("%s %s does not exist (yet)" % (serviceName, path))
-                    value = None
-
-            service.paths[path] = MonitoredValue(value, None, options)
-
-            if options['whenToLog']:
-                service[options['whenToLog']].append(path)
-
-        logger.info(f"Finished scanning and storing items for {serviceName} id: {id(self)}")
-
-        # Adjust self at the end of the scan, so we don't have an incomplete set of
-        # data if an exception occurs during the scan.
-        self.servicesByName[serviceName] = service
-        self.servicesById[serviceId] = service
-        self.servicesByClass[service.service_class].append(service)
-        return True
-
-
-# umin = 3.35
-umin = cellfloat - 0.020
-def fu(u, bcv):
-    if u < umin:
-        return 0
-    return min((u-umin)/(bcv-umin), 1)
-
-# Todo: use common expfilter class
-class expfilter(object):
-    value = 0
-    k = 0
-
-    def __init__(self, iv, k):
-        super(expfilter, self).__init__()
-
-        self.value = iv
-        self.k = k
-
-    def filter(self, value):
-        self.value = self.k*value + (1.0-self.k)*self.value
-
-class battery(object):
-
-    def __init__(self, dbusmon, servicename):
-        super(battery, self).__init__()
-
-        self.dbusmon = dbusmon
-        self.batt = servicename
-        self.id = servicename[-1]
-
-        self.bhistory = history(30) # self.history.nhist)
-        self.ysum = 0
-        self.lastbcv = None
-
-        # self.kp = 1 # 1.25
-        # self.ki = 0.025
-        self.kp = 0.75 # 1 # 1.25
-        self.ki = 0.02 # 0.025
-
-        self.sm = ChargerStateMachine()
-
-        self.testdone = False
-
-        self.cellCutoff = 0
-        self.turnOff = False
-        self.start_emergency = 0
-        self.slowCharge = False
-
-        self.BATTERY_CAPACITY = self.get_value("/InstalledCapacity")
-        self.maxChargeCurrent = self.get_value("/Info/MaxChargeCurrent")
-
-        self.c100 = max(self.BATTERY_CAPACITY/100, 1)
-        logger.info(f"BATTERY_CAPACITY: {self.BATTERY_CAPACITY}, maxChargeCurrent: {self.maxChargeCurrent}")
-
-    def get_value(self, path):
-        return self.dbusmon.get_value(self.batt, path)
-
-    def resetDaily(self):
-        self.sm.reset()
-
-    def isBalanced(self):
-        return self.sm.isBalanced()
-
-    def inBulk(self):
-        return self.sm.inBulk()
-
-    def isBalancing(self):
-        return self.sm.isBalancing()
-
-    def isFloating(self):
-        return self.sm.isFloating()
-
-    def isThrottling(self):
-        if self.sm.current_state == self.sm.bulk:
-            return False
-        if self.isBalancing() or self.sm.current_state == self.sm.floating:
-            return True
-
-    def fi(self, i):
-        if i > self.maxChargeCurrent:
-            return 0
-        elif i < self.c100:
-            return 1
-        return (1-((i-self.c100)/(self.maxChargeCurrent-self.c100)))
-
-    def update(self, cvavg, allfloat):
-
-        ubatt = self.dbusmon.get_value(self.batt, "/Dc/0/Voltage")
-        self.cbatt = self.dbusmon.get_value(self.batt, "/Dc/0/Current")
-        self.ucell = self.dbusmon.get_value(self.batt, "/System/MaxCellVoltage")
-        ucell_min = self.dbusmon.get_value(self.batt, "/System/MinCellVoltage")
-        self.voltagediff = self.dbusmon.get_value(self.batt, "/Voltages/Diff")
-        self.bmssoc = self.dbusmon.get_value(self.batt, "/Soc")
-
-        self.bhistory.update(self.cbatt)
-        cavg = self.bhistory.As()
-
-        if self.sm.current_state == self.sm.bulk:
-            bcv = max(
-                cellpull,
-                round( min( cellpull + vrange * (cavg-self.c100) / self.maxChargeCurrent, MAX_CHARGING_CELL_VOLTAGE ), 2)
-                )
-        elif self.sm.current_state == self.sm.balancing:
-            bcv = cellpull
-        else: # float
-            if allfloat:
-                bcv = cellfloat
-            else:
-                bcv = cellpull
-
-        self.f_u = fu(self.ucell, bcv)
-        f_i = self.fi(cavg)
-        self.estsoc = min( self.f_u * f_i * 100, 99 )
-
-        # yyyy debug
-        """
-        if not self.testdone:
-            if self.sm.current_state == self.sm.bulk:
-                self.estsoc = 99
-                self.debugtime = time.time()
-            if self.sm.current_state == self.sm.balancing:
-                if time.time() - self.debugtime < 10:
-                    self.estsoc = 99
-            elif self.sm.current_state == self.sm.floating:
-                self.testdone = True
-        """
-
-        try:
-            res=self.sm.cycle(self)
-        except TransitionNotAllowed:
-            pass
-        else:
-            if res!=None:
-                logger.info(f"    State Event: {res}")
-
-        if self.lastbcv and self.lastbcv != bcv:
-            dv = bcv - self.lastbcv
-            logger.info(f"adjusting ysum: {16*dv}")
-            self.ysum -= 16*dv
-
-        self.lastbcv = bcv
-
-        diff = 0
-        if self.ucell > bcv:
-            #diff -= 16 * 2* (self.ucell - bcv)
-            diff -= 16 * (self.ucell - bcv)
-        else:
-            diff += 16 * min(bcv - self.ucell, 0.005)
-
-        logger.info(f"    U: {ubatt:.3f}V, I: {self.cbatt:.3f}A, iavg: {cavg:.3f}A, max: {self.ucell:.3f}V, bcv: {bcv:.3f}V, diff: {diff:.3f}V")
-
-        diffvolt = max( min(cvavg - ubatt, 1), 0)
-
-        self.ysum += diff * self.ki
-
-        if self.ysum > 0.75:
-            self.ysum = 0.75
-        elif self.ysum < -1.5:
-            self.ysum = -1.5
-
-        cv = 16*bcv + self.kp*diff + self.ysum + diffvolt
-        logger.info(f"    CV: {16*bcv:.3f}V + {self.kp*diff:.3f}(P) + {self.ysum:.3f}(ysum) + {diffvolt:.3f}(cable) = {cv:.3f}")
-            
-        self.chargevoltage = cv
-        logger.info(f"    fu: {self.f_u:.2f}, fi: {f_i:.2f}, estimsoc: {self.estsoc:.1f}%")
-
-        # Dynamic cut off voltage
-        # dynCutoffRange = 0.25 
-        dynCutoffEnd = 2.6
-        dynCutoffRange = MIN_CELL_VOLTAGE - dynCutoffEnd
-        if self.cbatt:
-            self.cellCutoff = bound(
-                    dynCutoffEnd,
-                    MIN_CELL_VOLTAGE + dynCutoffRange * (self.cbatt/self.BATTERY_CAPACITY),
-                    MIN_CELL_VOLTAGE)
-        else:
-            self.cellCutoff = MIN_CELL_VOLTAGE
-
-        if ucell_min <= self.cellCutoff:
-            if not self.turnOff:
-                # Note soc where we started emergency mode
-                self.start_emergency = self.bmssoc
-            logger.info(f"    turnoff emergency soc: {self.start_emergency}")
-            self.turnOff = True
-        else:
-            if self.bmssoc >= self.start_emergency + 2.5:
-                self.turnOff = False
-            logger.info(f"    turnoff emergency soc 2: {self.start_emergency}")
-
-        # Handle slow charge when cell-voltages too low
-        if ucell_min <= 2.6:
-            self.slowCharge = True
-        elif ucell_min >= 2.9:
-            self.slowCharge = False
-
-        logger.info(f"    minvolt: {ucell_min:.3f}V, cellcutoff: {self.cellCutoff:.3f}V, turnoff: {self.turnOff}, slowcharge: {self.slowCharge}.")
-
-
-class history(object):
+dummy = {"code": None, "whenToLog": "configChange", "accessLevel": None}
 
-    def __init__(self, nhist):
-        super(history, self).__init__()
-        self.nhist = nhist
-        self.aslist = []
+# Battery paths that trigger a control tick in event mode
+tickPaths = frozenset(("/System/MaxCellVoltage", "/System/MinCellVoltage", "/Dc/0/Current"))
 
-    def sum(self):
-        return abs(sum(self.aslist))
+# No pending value of a rate limited path (None is a valid value)
+notPending = object()
 
-    def update(self, As):
-        if len(self.aslist) == self.nhist:
-            self.aslist.pop(0)
-        self.aslist.append(As)
+class dbusbackend(object):
+    """
+    The bus, main loop and clock of DbusAggBatService, see fakebus.py
+    for the in-process fake.
+    """
 
-    def As(self):
-        if not len(self.aslist):
-            return 0
-        return sum(self.aslist) / len(self.aslist)
+    loop = GLib # timeout_add, idle_add, source_remove
+    clock = time # time(), monotonic(), perf_counter()
+    snapshotFile = SNAPSHOT_FILE
 
-    def n(self):
-        return len(self.aslist)
+    def monitor(self, dbusTree, **kwargs):
+        return MyDbusMonitor(dbusTree, **kwargs)
 
-    def valid(self):
-        return len(self.aslist) == self.nhist
+    def service(self, servicename):
+        return VeDbusService(servicename)
 
-dummy = {"code": None, "whenToLog": "configChange", "accessLevel": None}
+    def device_instance(self, dbusservice):
+        return get_device_instance(dbusservice.dbusconn, "ibrbms", 'battery:0')
 
 class DbusAggBatService(object):
 
-    def __init__(self, servicename=f"com.victronenergy.{SERVICENAME}.ibrbms"):
+    def __init__(self, servicename=f"com.victronenergy.{SERVICENAME}.ibrbms", backend=None):
         super(DbusAggBatService, self).__init__()
 
-        self.turnedOff = False
-        self.turnOnSoc = 0
-        # self.fakeSoc = None
-        self.forceSoc = 0
-
-        self.maindbusmon = DbusMonitor({
+        self.backend = backend or dbusbackend()
+        self.loop = self.backend.loop
+        self.clock = self.backend.clock
+
+        self.startTime = self.clock.time()
+        self.perf = perf.perfstats(self.clock)
+
+        # The charge algorithm, see chargealgo.py
+        self.trace = tracer(TRACE_RECORDS)
+        self.control = chargecontrol(self.trace)
+        self.policy = outputpolicy(OUTPUT_POLICY)
+
+        # Warm restart
+        state = self.backend.snapshotFile and snapshot.read(self.backend.snapshotFile, SNAPSHOT_MAXAGE)
+        if state:
+            try:
+                self.control.setstate(state)
+            except (KeyError, AttributeError, TypeError, ValueError) as e:
+                logger.warning(f"snapshot: invalid state ({e!r}), cold start")
+
+        # One monitor for all services, the paths of the batteries are
+        # added at runtime, see addBattery().
+        # XXX Dbusmonitor tries to scan OUR service, too. This leads to
+        # a unnessesary delay/timeout. So filter our own service out.
+        self.maindbusmon = self.backend.monitor({
                         "com.victronenergy.battery" : { "/Soc": dummy }, 
                         'com.victronenergy.inverter': {
                             "/Dc/0/Voltage": dummy,
@@ -468,15 +108,15 @@ class DbusAggBatService(object):
                             "/Dc/0/Voltage": dummy,
                         },
                     },
+                ignoreServices=(f"com.victronenergy.{SERVICENAME}.ibrbms",),
+                valueChangedCallback=self.value_changed_wrapper,
                 deviceAddedCallback=self.deviceAddedCb,
                 deviceRemovedCallback=self.deviceRemovedCb)
 
-        self.busmon_scan_dbus_service = self.maindbusmon.scan_dbus_service
-        self.maindbusmon.scan_dbus_service = self.scan_dbus_service
-
-        self._dbusservice = VeDbusService(servicename)
+        self._dbusservice = self.backend.service(servicename)
+        self.publisher = ItemsChangedPublisher(self._dbusservice, PUBLISH_WINDOW, self.loop)
 
-        devinst = get_device_instance(self._dbusservice.dbusconn, "ibrbms", 'battery:0')
+        devinst = self.backend.device_instance(self._dbusservice)
 
         # Create the mandatory objects
         self._dbusservice.add_mandatory_paths(
@@ -497,38 +137,10 @@ class DbusAggBatService(object):
         # self._dbusservice.add_path('/TimeToGo', 1)
         self._dbusservice.add_path('/Ibr/Debug/ForceSoc', 0, writeable=True,
                                    onchangecallback=self.forceSocChanged)
-
-        self.addPath = (
-            "Info/MaxDischargeCurrent",
-            "Dc/0/Current",
-            "Dc/0/Power",
-            "InstalledCapacity",
-            "ConsumedAmphours",
-            "Capacity",
-            "System/NrOfModulesOnline",
-            "System/NrOfModulesOffline",
-            "System/NrOfModulesBlockingCharge",
-            "System/NrOfModulesBlockingDischarge",
-            "Alarms/CellImbalance",
-            "Alarms/HighCellVoltage",
-            "Alarms/HighChargeCurrent",
-            "Alarms/InternalFailure_alarm",
-            "Alarms/HighChargeTemperature",
-            "Alarms/HighDischargeCurrent",
-            "Alarms/HighTemperature",
-            "Alarms/HighVoltage",
-            "Alarms/InternalFailure",
-            "Alarms/LowCellVoltage",
-            "Alarms/LowChargeTemperature",
-            "Alarms/LowSoc",
-            "Alarms/LowTemperature",
-            "Alarms/LowVoltage",
-            "Alarms/BmsCable",
-            )
-
-        self.avgPath = (
-            # "Soc",
-            )
+        self._dbusservice.add_path('/Ibr/Trace/Dump', "", writeable=True,
+                                   onchangecallback=self.traceDump)
+        self.traceDumping = None # file name of the running dump
+        self.traceRows = 0
 
         self.ownPath = (
             "Info/MaxChargeVoltage",
@@ -538,48 +150,20 @@ class DbusAggBatService(object):
             "Ess/Throttling",
             "Soc",
             "Ibr/Debug/ForceSoc",
+            "Ibr/Trace/Dump",
+            "Ibr/Perf/SignalsSaved",
+            "Ibr/Perf/StartupTime",
             # "TimeToGo",
             )
 
-        self.minPath = (
-            "System/MinCellTemperature",
-            "System/MinCellVoltage",
-            )
-
-        self.maxPath = (
-            "Info/BatteryLowVoltage",
-            "Dc/0/Voltage",
-            "Dc/0/Temperature",
-            "System/MaxCellTemperature",
-            "System/MaxCellVoltage",
-            "Voltages/Diff",
-            )
-
-        self.allsetPath = (
-            "Io/AllowToCharge",
-            "Io/AllowToDischarge",
-            "Io/AllowToBalance",
-        )
-
-        self.onesetPath = (
-            )
-            
-        self.ignorePath = (
-            'Mgmt/ProcessName',
-            'Mgmt/ProcessVersion',
-            'Mgmt/Connection',
-            'DeviceInstance',
-            'ProductId',
-            'ProductName',
-            'FirmwareVersion',
-            'HardwareVersion',
-            'Connected',
-            "Dc/0/MidVoltage",
-            "Dc/0/MidVoltageDeviation",
-            "History/ChargeCycles",
-            "History/TotalAhDrawn",
-            "System/NrOfCellsPerBattery",
-            )
+        # Which battery paths are monitored and how they are mirrored,
+        # see MIRROR in config.py. The reducers of the aggregated paths
+        # cache their aggregate and update it incrementally.
+        self.mirror = mirrorspec(MIRROR, MIRROR_DEFAULT)
+        self.reducers = self.mirror.reducers()
+        # Rate limited paths: path -> [time of the last publish, pending value or notPending]
+        self.ratelimited = { path: [0, notPending] for path in self.mirror.intervals }
+        self.ownPaths = frozenset(map(lambda p: "/"+p, self.ownPath)) | frozenset(perf.paths())
 
         self.getTextCallbacks = {
             '/Dc/0/Voltage': lambda a, x: "{:.2f}V".format(x),
@@ -588,17 +172,15 @@ class DbusAggBatService(object):
             '/ConsumedAmphours': lambda a, x: "{:.0f}Ah".format(x),
         }
 
-        self.batteries = {}
+        self.batteries = self.control.batteries
         self.monitorlist = {}
+        self.pendingBatteries = set() # waiting for a valid /Soc
+        self.onboarding = set() # waiting for the GetValue reply
+        self.onboardRetry = {} # delay [s] of the next GetValue retry
+        self.waitingLogged = None # last logged set of waiting batteries
 
         # charger
-        self.chargevoltage = 16 * cellfloat # xxx hardcoded
-        self._dbusservice.add_path('/Info/MaxChargeVoltage', self.chargevoltage, writeable=True, gettextcallback=lambda p, v: "{:2.2f}V".format(v))
-
-        self.lastchargevoltage = None
-        self.maxccfilter = expfilter(10, 0.25)
-
-        self.lastmaxcc = None
+        self._dbusservice.add_path('/Info/MaxChargeVoltage', self.control.chargevoltage, writeable=True, gettextcallback=lambda p, v: "{:2.2f}V".format(v))
         self._dbusservice.add_path('/Info/MaxChargeCurrent', 0, writeable=True, gettextcallback=lambda p, v: "{:2.2f}A".format(v))
 
         self._dbusservice.add_path('/Info/CutOffVoltage', 0, writeable=True, gettextcallback=lambda p, v: "{:1.3f}V".format(v))
@@ -607,9 +189,12 @@ class DbusAggBatService(object):
 
         self._dbusservice.add_path('/Soc', 33, writeable=True)
 
-        self.lastTime = time.time()
+        # Publishing statistics
+        for path in perf.paths():
+            self._dbusservice.add_path(path, 0)
+        self._dbusservice.add_path('/Ibr/Perf/SignalsSaved', 0)
+        self._dbusservice.add_path('/Ibr/Perf/StartupTime', None, gettextcallback=lambda p, v: "{:.3f}s".format(v))
 
-        self.history = history(30) # 120
         # end charger
 
         self.chargers = self.maindbusmon.get_service_list(classfilter="com.victronenergy.solarcharger") or {}
@@ -632,52 +217,156 @@ class DbusAggBatService(object):
             sys.exit(1)
             return
 
-        # self.CGES = 0
-        self.CGES20 = 0
-        self.maxChargeCurrent = 0
         for batt in battServices:
             logger.info(f"found initial batt: {batt}")
-            GLib.timeout_add(250, self.addBatteryWrapper, batt)
+            self.addBattery(batt)
+
+        self.eventTick = (TICK_MODE == "event")
+        self.tickPending = None # source of a requested tick
+        self.staleTimer = None # source of the max. interval timer
+        self.lastTick = 0
+        if self.eventTick:
+            self.staleTimer = self.loop.timeout_add(TICK_MAX_INTERVAL, self.staleWrapper)
+        else:
+            self.loop.timeout_add(1000, self.updateWrapper)
+        self.loop.timeout_add(SNAPSHOT_INTERVAL * 1000, self.snapshotWrapper)
 
-        GLib.timeout_add(1000, self.updateWrapper)
+        # Main loop lag: delay of a 1s timer
+        self.lagExpected = self.clock.monotonic() + 1
+        self.loop.timeout_add(1000, self.loopLag)
+        self.loop.timeout_add(PERF_INTERVAL * 1000, self.perfWrapper)
         return
 
     # #############################################################################################################
 
-    # XXX Dbusmonitor tries to scan OUR service, too. This leads to
-    # a unnessesary delay/timeout. So filter our own service out here:
-    def scan_dbus_service(self, serviceName):
-        logger.info("scan_service: " + serviceName)
-        if serviceName.startswith(f"com.victronenergy.{SERVICENAME}.ibrbms"):
-            return False
-        return self.busmon_scan_dbus_service(serviceName)
-
     # Calls value_changed with exception handling
     def value_changed_wrapper(self, *args, **kwargs):
-        exit_on_error(self.value_changed, *args, **kwargs)
+        self.perf.count("SignalsIn")
+        exit_on_error(self.perf.timed, "ValueChanged", self.value_changed, *args, **kwargs)
 
     def deviceAddedCb(self, service, instance):
 
         if service == "com.victronenergy.multi.rshack": # xxx filter out .multi.rshack
             return
 
-        logger.error(f"Error: dependent service {service} appeared, exiting!")
-        sys.exit(1)
+        logger.info(f"dependent service {service} appeared")
+
+        if service.startswith("com.victronenergy.battery."):
+            self.addBattery(service)
+        elif service.startswith("com.victronenergy.solarcharger."):
+            self.chargers[service] = instance
+        else:
+            self.inverters[service] = instance
 
     def deviceRemovedCb(self, service, instance):
 
         if service == "com.victronenergy.multi.rshack": # xxx filter out .multi.rshack
             return
 
-        logger.error(f"Error: dependent service {service} diappeared, exiting!")
-        sys.exit(1)
+        logger.info(f"dependent service {service} disappeared")
+
+        self.chargers.pop(service, None)
+        self.inverters.pop(service, None)
+        self.pendingBatteries.discard(service)
+        self.onboarding.discard(service)
+        self.onboardRetry.pop(service, None)
+
+        if service in self.batteries:
+            self.removeBattery(service)
+
+    def removeBattery(self, batt):
+
+        self.control.removeBattery(batt, self.clock.monotonic())
+
+        # Aggregate the remaining batteries
+        for path, reducer in self.reducers.items():
+            if path in self.publisher:
+                self.publisher[path] = reducer.remove(batt)
+                if path in self.ratelimited:
+                    self.ratelimited[path][1] = notPending
 
     def updateWrapper(self):
-        return exit_on_error(self.update)
+        return exit_on_error(self.perf.timed, "Update", self.update)
+
+    def loopLag(self):
+        now = self.clock.monotonic()
+        self.perf.record("LoopLag", max(now - self.lagExpected, 0))
+        self.lagExpected = now + 1
+        return True
+
+    def perfWrapper(self):
+        exit_on_error(self.publishPerf)
+        return True
+
+    def publishPerf(self):
+        self.perf.counters["SignalsOut"] = self.publisher.signalsout
+        self.perf.counters["OutputsSuppressed"] = self.policy.suppressed()
+        logger.debug("output policy (published, suppressed): %s", self.policy.stats())
+        for path, value in self.perf.values().items():
+            self.publisher[path] = value
+        self.publisher[ "/Ibr/Perf/SignalsSaved" ] = self.publisher.signalsSaved()
+
+    # Event mode: a control tick on input changes, see TICK_MODE
+    def requestTick(self):
+        if self.tickPending:
+            return
+        delay = TICK_MIN_INTERVAL - (self.clock.monotonic() - self.lastTick) * 1000
+        if delay <= 0:
+            self.tickPending = self.loop.idle_add(self.tickWrapper)
+        else:
+            self.tickPending = self.loop.timeout_add(int(delay) + 1, self.tickWrapper)
+
+    def tickWrapper(self):
+        self.tickPending = None
+        exit_on_error(self.tick)
+        return False
+
+    def staleWrapper(self):
+        self.staleTimer = None
+        exit_on_error(self.tick)
+        return False
+
+    def tick(self):
+        for source in (self.tickPending, self.staleTimer):
+            if source:
+                self.loop.source_remove(source)
+        self.tickPending = None
+        self.staleTimer = self.loop.timeout_add(TICK_MAX_INTERVAL, self.staleWrapper)
+        self.lastTick = self.clock.monotonic()
+        self.perf.timed("Update", self.update)
+
+    def snapshotWrapper(self):
+        exit_on_error(self.writeSnapshot)
+        return True
+
+    def writeSnapshot(self):
+        if not (self.batteries and self.backend.snapshotFile):
+            # Keep the last snapshot
+            return
+        try:
+            snapshot.write(self.backend.snapshotFile, self.control.getstate())
+        except OSError as e:
+            logger.error(f"snapshot: can't write {self.backend.snapshotFile}: {e}")
+
+    # SIGTERM handler
+    def terminate(self, mainloop):
+        logger.info("terminating, writing snapshot")
+        self.writeSnapshot()
+        mainloop.quit()
+        return False
 
     def update(self):
 
-        logger.info("--- update ---")
+        logger.debug("--- update ---")
+
+        if not self.batteries:
+            # Logged on changes only, not every tick
+            waiting = self.pendingBatteries | self.onboarding
+            if waiting != self.waitingLogged:
+                logger.info(f"waiting for batteries: {waiting}")
+                self.waitingLogged = waiting
+        else:
+            self.waitingLogged = None
 
         chargerVoltages = []
         for charger in self.chargers:
@@ -694,313 +383,183 @@ class DbusAggBatService(object):
         # cvavg = sum(chargerVoltages) / len(chargerVoltages)
         cvavg = saveAvg(chargerVoltages)
 
-        allbulk = not (False in map(lambda b: b.inBulk(), self.batteries.values()))
-        allbalanced = not (False in map(lambda b: b.isBalanced(), self.batteries.values()))
-        allfloat = not (False in map(lambda b: b.isFloating(), self.batteries.values()))
-
-        balancing = set() # List of batteries to balance (top or bottom balancing (if turned off))
-        turnOff = [] # List of turned off batteries
-        throttling = False
-        chgmode = "bulk"
-        slowCharge = False # Slow charge flag
-        avgsoc = []
-        cellCutoff = []
-
-        for batt in self.batteries.values():
-
-            battname = batt.batt.split(".")[-1]
-            batt.update(cvavg, allfloat)
-
-            avgsoc.append(batt.bmssoc)
-            cellCutoff.append(batt.cellCutoff)
-
-            # control balancers
-            if not (allbulk or allfloat or allbalanced):
-                if batt.isBalancing() or batt.isBalanced():
-                    balancing.add(battname)
-
-            # Reset balancing state at midnight
-            if batt.isBalanced() and time.localtime().tm_hour == 0:
-                batt.resetDaily()
-
-            if batt.isThrottling():
-                throttling = True
-
-            if batt.isBalancing():
-                chgmode = "balancing"
-            elif allfloat:
-                chgmode = "floating"
-
-            if batt.turnOff:
-                turnOff.append(battname)
-                balancing.add(battname)
-
-            if batt.slowCharge:
-                slowCharge = True
-
-        avgsoc = sum(avgsoc) / len(avgsoc)
-
-        self._dbusservice['/Ess/Balancing'] = list(balancing)
-        self._dbusservice['/Ess/Chgmode'] = chgmode
-        self._dbusservice['/Ess/Throttling'] = throttling
-
-        t = time.time()
-        dt = t - self.lastTime
-        self.lastTime = t
-
-        currsum = sum(map(lambda b: b.cbatt, self.batteries.values()))
-        As = currsum * dt
-
-        self.history.update(As)
-
-        socs = map(lambda b: b.estsoc, self.batteries.values())
-        estsoc = sum(socs) / len(self.batteries)
-
         loadcurrent = 0
         for inverter in self.inverters:
             loadcurrent += min(self.maindbusmon.get_value(inverter, "/Dc/0/Current") or 0, 0)
 
-        self.maxccfilter.filter( min(self.maxChargeCurrent, self.CGES20 + self.maxChargeCurrent * (1 - math.pow(estsoc/99.0, 2)) - loadcurrent) )
-
-        chargevoltages = map(lambda b: b.chargevoltage, self.batteries.values())
-        self.chargevoltage = min(chargevoltages)
-
-        if self.chargevoltage > MAX_CHARGING_VOLTAGE:
-            logger.info(f"    cap cv!: {self.chargevoltage:.3f}V to MAX_CHARGING_VOLTAGE: {MAX_CHARGING_VOLTAGE:.3f}V")
-            self.chargevoltage = MAX_CHARGING_VOLTAGE
-
-        logger.info(f"batt current: {currsum:.3f}A, loadcurrent: {loadcurrent:.3f}, estsoc: {estsoc:.1f}%")
+        # Wall clock time for the daily reset and the trace, monotonic
+        # time for the elapsed times (a clock step must not hold the outputs)
+        now = self.clock.monotonic()
+        outputs = self.policy.filter(self.control.step(cvavg, loadcurrent, self.clock.time(), now), now)
+        for path, value in outputs.items():
+            self.publisher[path] = value
 
-        v = round(self.chargevoltage, 3)
-        if v != self.lastchargevoltage:
-            self._dbusservice[ "/Info/MaxChargeVoltage" ] = v
-            self.lastchargevoltage = v
+        self.flushRateLimited()
 
-        i = round(self.maxccfilter.value)
-        if i != self.lastmaxcc:
-            self._dbusservice[ "/Info/MaxChargeCurrent" ] = i
-            self.lastmaxcc = i
-
-        logger.info(f"chargevoltage: {v:.3f}V, charge current: {i}A")
-
-        # turn on/off battery
-        essminsoc = 10 # xxx must match setting in ESS/inverter
-        if turnOff:
-            if not self.turnedOff:
-                self.turnedOff = True
-                self.turnOnSoc = max(avgsoc + 25, essminsoc + 25) # xxx make a setting "TurnOnThreshold" for this
-                self._dbusservice[ "/Info/TurnOnSoc" ] = self.turnOnSoc
-        else:
-            if self.turnedOff and avgsoc >= self.turnOnSoc:
-                self.turnedOff = False
-
-        self._dbusservice[ "/Info/RealSoc" ] = avgsoc
-        self._dbusservice[ "/Info/CutOffVoltage" ] = min(cellCutoff)
-
-        fakesoc = avgsoc
-        if self.turnedOff:
-            # # force batt off?
-            # fakesoc = min(avgsoc, essminsoc)
-            # # avoid victron ess charging start (starting at 5% soc?)
-            # fakesoc = max(fakesoc, 6) 
-
-            # force batt off?
-            # avoid victron ess charging start (starting at 5% soc?)
-            # fakesoc = bound(6, avgsoc, essminsoc)
-
-            if slowCharge:
-                fakesoc = 4
-            else:
-                fakesoc = bound(6, avgsoc, essminsoc)
-        else:
-            # keep batt alive?
-            fakesoc = max(avgsoc, essminsoc + 4) # SocSwitchOffset = 3.0
-
-        if self.forceSoc:
-            fakesoc = self.forceSoc
-
-        logger.info(f"turnOff: {turnOff}, TurnedOff: {self.turnedOff}, avg-soc: {avgsoc:.1f}%, fake-soc: {fakesoc:.1f}%, turnOnSoc: {self.turnOnSoc:.1f}%")
-        self._dbusservice[ "/Soc" ] = fakesoc
+        if self.batteries and self.publisher[ "/Ibr/Perf/StartupTime" ] is None:
+            startup = self.clock.time() - self.startTime
+            logger.info(f"first valid output {startup:.3f}s after start")
+            self.publisher[ "/Ibr/Perf/StartupTime" ] = startup
         return True
 
-    def addBatteryWrapper(self, batt):
-        return exit_on_error(self.addBattery, batt)
-
+    # Onboarding of a battery, without blocking calls:
+    # addBattery() waits for a valid /Soc (value change from the monitor),
+    # then fetches all values with one asynchronous GetValue and
+    # batteryScanned() adds the battery.
     def addBattery(self, batt):
 
-        logger.info(f"add battery, waiting for /Soc...")
-        soc = self.maindbusmon.get_value(batt, "/Soc")
+        if batt in self.batteries or batt in self.onboarding:
+            return
 
-        logger.info(f"got /Soc: {soc}")
+        soc = self.maindbusmon.get_value(batt, "/Soc")
 
         # Sometimes we get None and sometimes a "dbus.Array([], signature=dbus.Signature('i')"
         # value for a None-value on the sender side?
-        if soc == None or type(soc) == dbus.Array:
-            return True
+        if not isvalid(soc):
+            logger.info(f"add battery {batt}, waiting for /Soc...")
+            self.pendingBatteries.add(batt)
+            self.maindbusmon.watch_service(batt)
+            return
 
-        logger.info(f"newbatt: initializing new dbus monitor for {batt}")
+        logger.info(f"got /Soc: {soc}, newbatt: adding paths of {batt} to dbus monitor")
+        self.pendingBatteries.discard(batt)
+        self.onboarding.add(batt)
+
+        t = self.clock.perf_counter()
+
+        def reply(allvalues):
+            exit_on_error(self.batteryScanned, batt, allvalues)
+            self.perf.record("Scan", self.clock.perf_counter() - t)
+
+        def error(e):
+            if batt not in self.onboarding:
+                return # removed
+            # Back to pending, retried with increasing delay
+            delay = self.onboardRetry.get(batt, ONBOARD_RETRY_MIN)
+            self.onboardRetry[batt] = min(2 * delay, ONBOARD_RETRY_MAX)
+            logger.error(f"newbatt: GetValue of {batt} failed: {e}, retry in {delay}s")
+            self.onboarding.discard(batt)
+            self.pendingBatteries.add(batt)
+            self.loop.timeout_add(delay * 1000, lambda: self.retryBattery(batt))
+
+        self.maindbusmon.dbusConn.call_async(batt, '/', None, 'GetValue', '', [],
+                reply_handler=reply, error_handler=error)
+
+    def retryBattery(self, batt):
+        if batt in self.pendingBatteries:
+            exit_on_error(self.addBattery, batt)
+        return False
 
-        allvalues = self.maindbusmon.dbusConn.call_blocking(batt, '/', None, 'GetValue', '', [])
-        for key in allvalues:
-            fqnkey = "/"+key
-            if key in self.ignorePath or fqnkey in self.monitorlist:
-                continue
-            self.monitorlist[fqnkey] = dummy
+    def batteryScanned(self, batt, allvalues):
 
-        logger.info(f"newbatt: watching {len(self.monitorlist)} items of {batt}: {self.monitorlist.keys()}")
-        dbusmon = MyDbusMonitor({ batt: self.monitorlist },
-                valueChangedCallback=self.value_changed_wrapper)
+        # Removed while waiting for the reply
+        if batt not in self.onboarding:
+            return
+        self.onboarding.discard(batt)
+        self.onboardRetry.pop(batt, None)
+
+        for fqnkey in self.mirror.select("/"+key for key in allvalues):
+            self.monitorlist.setdefault(fqnkey, dummy)
 
-        battObj = battery(dbusmon, batt)
-        self.batteries[batt] = battObj
+        logger.info(f"newbatt: watching {len(self.monitorlist)} items of {batt}: {self.monitorlist.keys()}")
+        self.maindbusmon.add_service_paths(batt, dict(self.monitorlist), allvalues)
 
-        # self.CGES += battObj.BATTERY_CAPACITY
-        self.CGES20 += max(battObj.BATTERY_CAPACITY/20, 1)
-        self.maxChargeCurrent += battObj.maxChargeCurrent
-        logger.info(f"newbatt: CGES20 {self.CGES20}, maxChargeCurrent: {self.maxChargeCurrent}")
+        battObj = self.control.unpark(batt) or battery(self.maindbusmon, batt)
+        self.control.addBattery(batt, battObj)
 
         for fqnkey in self.monitorlist:
-            if fqnkey in self.ignorePath:
+            if self.mirror.mode(fqnkey) == "input":
                 continue
             if fqnkey not in self._dbusservice:
                 self._dbusservice.add_path(
                         fqnkey,
                         None,
                         gettextcallback=self.getTextCallbacks.get(fqnkey, None))
-            self.publishValue(batt, fqnkey, allvalues[fqnkey[1:]])
+            self.publishValue(batt, fqnkey, battObj.get_value(fqnkey))
 
-        return False
+        logger.info(f"newbatt: {batt} added {self.clock.time() - self.startTime:.3f}s after start")
 
     def value_changed(self, service, path, options, changes, deviceInstance):
+        if service in self.pendingBatteries:
+            if path == "/Soc":
+                self.addBattery(service)
+            return
         self.publishValue(service, path, changes["Value"])
+        if self.eventTick and path in tickPaths and service in self.batteries:
+            self.requestTick()
 
     def publishValue(self, service, path, value):
 
         # logger.info(f'publishValue: {service} {path} {value} {type(value)}')
 
         if service not in self.batteries:
-            logger.info(f"skipping publishValue: early notification...")
+            # Still onboarding (see addBattery()), every signal of it ends here
+            logger.debug("skipping publishValue: early notification of %s", service)
             return
 
-        spath = path[1:]
-
-        if spath in self.ownPath:
+        if path in self.ownPaths or self.mirror.mode(path) == "input":
             # skip
             return
 
-        iv = 0
-        lv = []
-        sv = ""
-        v = None
-        vt = type(value)
-        if spath in self.addPath:
-
-            for batt in self.batteries:
-
-                battvalue = self.batteries[batt].get_value(path)
-
-                if batt == service:
-                    # logger.info(f"add new value {batt} {path} {value}")
-                    v = value
-                else:
-                    # logger.info(f"add old value {batt} {path} {battvalue}")
-                    v = battvalue
-
-                if vt == int or vt == float or vt == dbus.Double or vt == dbus.Int32:
-                    iv += v
-                elif vt == dbus.Array:
-                    lv += v
-                elif vt == dbus.String:
-                    sv += v
-                else:
-                    logger.info(f"unknown type: {vt}")
-                    assert(0)
-
-            if vt == dbus.Array:
-                # logger.info(f"sum value {batt} {path} {lv}")
-                self._dbusservice[path] = lv
-            elif vt == dbus.String:
-                # logger.info(f"sum value {batt} {path} {sv}")
-                self._dbusservice[path] = sv
-            else: # vt == int or vt == float or vt == dbus.Double or vt == dbus.Int32:
-                # logger.info(f"sum value {batt} {path} {iv}")
-                self._dbusservice[path] = iv
-
-        elif spath in self.avgPath:
-
-            for batt in self.batteries:
-                if batt == service:
-                    iv += value
-                else:
-                    iv += self.batteries[batt].get_value(path)
-
-            iv /= len(self.batteries)
-            # logger.info(f"avg value {batt} {path} {round(iv, 3)}")
-            self._dbusservice[path] = round(iv, 3)
-
-        elif spath in self.maxPath:
-
-            for batt in self.batteries:
-                if batt == service:
-                    iv = max(iv, value)
-                else:
-                    iv = max(iv, self.batteries[batt].get_value(path))
-
-            # logger.info(f"max value {batt} {path} {iv}")
-            self._dbusservice[path] = iv
-
-        elif spath in self.minPath:
-
-            iv = 0xffffffff
-            for batt in self.batteries:
-                if batt == service:
-                    iv = min(iv, value)
-                else:
-                    iv = min(iv, self.batteries[batt].get_value(path))
-
-            # logger.info(f"min value {batt} {path} {iv}")
-            self._dbusservice[path] = iv
-
-        elif spath in self.allsetPath:
-
-            iv = 1
-            for batt in self.batteries:
-                if batt == service:
-                    if not value:
-                        iv = 0
-                else:
-                    if not self.batteries[batt].get_value(path):
-                        iv = 0
-
-            # logger.info(f"allset value {batt} {path} {iv}")
-            self._dbusservice[path] = iv
-
-        elif spath in self.onesetPath:
-
-            iv = 0
-            for batt in self.batteries:
-                if batt == service:
-                    if value:
-                        iv = 1
-                        break
-                else:
-                    if self.batteries[batt].get_value(path):
-                        iv = 1
-                        break
-
-            # logger.info(f"oneset value {batt} {path} {iv}")
-            self._dbusservice[path] = iv
-
-        else:
-            # logger.info(f"copy single value from {service}: {path} {value}")
-            self._dbusservice[path] = value
-
-        return
+        reducer = self.reducers.get(path, None)
+        if reducer is not None:
+            value = reducer.update(service, value)
+
+        limit = self.ratelimited.get(path, None)
+        if limit is not None:
+            now = self.clock.monotonic()
+            if now - limit[0] < self.mirror.intervals[path]:
+                # published by flushRateLimited()
+                limit[1] = value
+                return
+            limit[0] = now
+            limit[1] = notPending
+
+        self.publisher[path] = value
+
+    # Publish the pending values of the rate limited paths
+    def flushRateLimited(self):
+        now = self.clock.monotonic()
+        for path, limit in self.ratelimited.items():
+            if limit[1] is not notPending and now - limit[0] >= self.mirror.intervals[path]:
+                self.publisher[path] = limit[1]
+                limit[0] = now
+                limit[1] = notPending
 
     def forceSocChanged(self, path, force):
         logger.info(f"forcesoc: {path}, {force}, {type(force)}")
         self._dbusservice[path] = force
-        self.forceSoc = force
+        self.control.forceSoc = force
+
+    def traceDump(self, path, name):
+        # Only file names in TRACE_DIR, the item is writable from the LAN
+        # (mqtt, modbus-tcp).
+        if self.traceDumping is not None:
+            logger.warning(f"trace: dump to {self.traceDumping} still running")
+            return False
+        if not name:
+            name = time.strftime("ibrbms-trace-%Y%m%d-%H%M%S.csv")
+        elif not isinstance(name, str) or "/" in name or ".." in name:
+            logger.warning(f"trace: invalid file name {name!r}")
+            return False
+
+        filename = os.path.join(TRACE_DIR, name)
+        self.traceDumping = filename
+        # Written from a copy in chunks, the main loop keeps running
+        self.loop.idle_add(self.traceDumpStep, path, filename, self.trace.copy().dumper(filename))
+        return True
+
+    def traceDumpStep(self, path, filename, dumper):
+        try:
+            self.traceRows = next(dumper)
+            return True
+        except StopIteration:
+            logger.info(f"trace: dumped {self.traceRows} ticks to {filename}")
+            self._dbusservice[path] = filename
+        except OSError as e:
+            logger.error(f"trace: dump to {filename} failed: {e}")
+        self.traceDumping = None
+        return False
 
 
 # ################
@@ -1015,13 +574,14 @@ def main():
 
     DBusGMainLoop(set_as_default=True)
 
-    DbusAggBatService()
+    service = DbusAggBatService()
 
     logger.info(
         "%s: Connected to DBus, and switching over to GLib.MainLoop()"
         % (datetime.datetime.now()).strftime("%c")
     )
     mainloop = GLib.MainLoop()
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, service.terminate, mainloop)
     mainloop.run()
 
 
@@ -0,0 +1,304 @@
+"""
+In-process fake of the dbus backend of dbus-ibr-bms, to run the service
+without a dbus-daemon, e.g. against the physics of sim/ (sim/mod_ibrbms.py).
+
+ * virtualclock: replacement of the time module and of the GLib scheduling
+   functions (timeout_add, idle_add, source_remove), time only advances
+   with advance().
+ * fakebus: in-memory store of the services and their values, and the
+   backend of DbusAggBatService (see dbusbackend there).
+ * fakemonitor, fakeservice: the interfaces of MyDbusMonitor and
+   VeDbusService used by the service.
+
+Example:
+
+    bus = fakebus()
+    bus.add_service("com.victronenergy.battery.ttyUSB0", { "/Soc": 50, ... })
+    ...
+    bms = DbusAggBatService(backend=bus)
+    bus.clock.advance(3600)
+    cv = bms._dbusservice["/Info/MaxChargeVoltage"]
+"""
+
+import time, heapq, itertools, logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class virtualclock(object):
+    """
+    Virtual time and a GLib like scheduler. Other attributes (localtime,
+    strftime, perf_counter, ...) are those of the time module.
+    """
+
+    def __init__(self, start=None):
+        super(virtualclock, self).__init__()
+
+        # Default: a fixed, reproducible start time (local 06:00)
+        self.now = start if start is not None else time.mktime((2024, 6, 1, 6, 0, 0, 0, 0, -1))
+
+        self.queue = [] # (due, seq, source id)
+        self.sources = {} # source id -> (interval [s] or None for idle, callback, args)
+        self.seq = itertools.count()
+        self.ids = itertools.count(1)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    # GLib interface
+
+    def timeout_add(self, ms, callback, *args):
+        return self._add(ms / 1000.0, callback, args)
+
+    def timeout_add_seconds(self, s, callback, *args):
+        return self._add(float(s), callback, args)
+
+    def idle_add(self, callback, *args):
+        return self._add(None, callback, args)
+
+    def source_remove(self, sourceid):
+        return self.sources.pop(sourceid, None) is not None
+
+    def _add(self, interval, callback, args):
+        sourceid = next(self.ids)
+        self.sources[sourceid] = (interval, callback, args)
+        heapq.heappush(self.queue, (self.now + (interval or 0), next(self.seq), sourceid))
+        return sourceid
+
+    def advance(self, seconds):
+        """ Run the callbacks due in the next seconds, then set the time to now + seconds. """
+        self.run(self.now + seconds)
+
+    def run(self, until):
+        while self.queue and self.queue[0][0] <= until:
+            due, seq, sourceid = heapq.heappop(self.queue)
+            source = self.sources.get(sourceid, None)
+            if source is None:
+                # removed
+                continue
+            interval, callback, args = source
+            self.now = max(self.now, due)
+            if callback(*args):
+                if sourceid in self.sources:
+                    heapq.heappush(self.queue, (self.now + (interval or 0), next(self.seq), sourceid))
+            else:
+                self.sources.pop(sourceid, None)
+        self.now = max(self.now, until)
+
+class fakebus(object):
+    """
+    In-memory bus: services with their values. The simulation (device side)
+    uses add_service(), remove_service() and set_value(), DbusAggBatService
+    uses it as backend.
+    """
+
+    snapshotFile = None
+
+    def __init__(self, clock=None):
+        super(fakebus, self).__init__()
+        self.clock = clock or virtualclock()
+        self.loop = self.clock
+        self.services = {} # service name -> { path: value }
+        self.monitors = []
+        self.ownServices = {} # service name -> fakeservice
+
+    # Device side
+
+    def add_service(self, name, values):
+        self.services[name] = dict(values)
+        for monitor in self.monitors:
+            monitor.serviceAdded(name)
+
+    def remove_service(self, name):
+        del self.services[name]
+        for monitor in self.monitors:
+            monitor.serviceRemoved(name)
+
+    def set_value(self, name, path, value):
+        values = self.services[name]
+        if values.get(path, None) == value:
+            return
+        values[path] = value
+        for monitor in self.monitors:
+            monitor.valueChanged(name, path, value)
+
+    def get_value(self, name, path, default=None):
+        return self.services.get(name, {}).get(path, default)
+
+    # Backend of DbusAggBatService
+
+    def monitor(self, dbusTree, **kwargs):
+        monitor = fakemonitor(self, dbusTree, **kwargs)
+        self.monitors.append(monitor)
+        return monitor
+
+    def service(self, servicename):
+        service = fakeservice(servicename)
+        self.ownServices[servicename] = service
+        return service
+
+    def device_instance(self, dbusservice):
+        return 0
+
+class fakeconnection(object):
+    """ The asynchronous GetValue of the bus connection. """
+
+    def __init__(self, bus):
+        super(fakeconnection, self).__init__()
+        self.bus = bus
+
+    def call_async(self, name, path, interface, method, signature, args, reply_handler=None, error_handler=None):
+        assert method == 'GetValue' and path == '/'
+        if name in self.bus.services:
+            values = { p[1:]: v for p, v in self.bus.services[name].items() }
+            self.bus.loop.idle_add(reply_handler, values)
+        else:
+            self.bus.loop.idle_add(error_handler, KeyError(f"{name}: no such service"))
+
+class fakemonitor(object):
+    """ MyDbusMonitor on a fakebus. """
+
+    def __init__(self, bus, dbusTree, ignoreServices=(), valueChangedCallback=None,
+                 deviceAddedCallback=None, deviceRemovedCallback=None):
+        super(fakemonitor, self).__init__()
+
+        self.bus = bus
+        self.dbusConn = fakeconnection(bus)
+        self.dbusTree = dbusTree
+        self.ignoreServices = tuple(ignoreServices)
+        self.valueChangedCallback = valueChangedCallback
+        self.deviceAddedCallback = deviceAddedCallback
+        self.deviceRemovedCallback = deviceRemovedCallback
+
+        self.servicePaths = {} # service name -> { path: options } of the monitored paths
+        # service name -> { path: options }, added at runtime
+        self.serviceTree = {}
+
+        for name in self.bus.services:
+            self.scan(name)
+
+    def scan(self, name):
+        paths = self.dbusTree.get('.'.join(name.split('.')[0:3]), None)
+        if paths is None or name.startswith(self.ignoreServices):
+            return False
+        self.servicePaths[name] = dict(paths)
+        return True
+
+    def get_device_instance(self, name):
+        return self.bus.get_value(name, "/DeviceInstance", 0)
+
+    def get_value(self, name, path, default=None):
+        if path not in self.servicePaths.get(name, ()):
+            return default
+        return self.bus.get_value(name, path, default)
+
+    def get_service_list(self, classfilter=None):
+        return { name: self.get_device_instance(name) for name in self.servicePaths
+                 if classfilter is None or name.startswith(classfilter + ".") }
+
+    def add_service_paths(self, name, paths, values=None):
+        for path, options in paths.items():
+            self.servicePaths[name].setdefault(path, options)
+        self.serviceTree[name] = paths
+
+    def watch_service(self, name):
+        self.serviceTree.setdefault(name, {})
+
+    # Events of the bus
+
+    def serviceAdded(self, name):
+        # Scanned asynchronously, as MyDbusMonitor does
+        def added():
+            if name in self.bus.services and self.scan(name) and self.deviceAddedCallback:
+                self.deviceAddedCallback(name, self.get_device_instance(name))
+        self.bus.loop.idle_add(added)
+
+    def serviceRemoved(self, name):
+        self.serviceTree.pop(name, None)
+        if self.servicePaths.pop(name, None) is not None and self.deviceRemovedCallback:
+            self.deviceRemovedCallback(name, self.get_device_instance(name))
+
+    def valueChanged(self, name, path, value):
+        options = self.servicePaths.get(name, {}).get(path, None)
+        if options is None or name not in self.serviceTree or self.valueChangedCallback is None:
+            return
+        self.bus.loop.idle_add(self.valueChangedCallback, name, path, options,
+                { 'Value': value, 'Text': str(value) }, self.get_device_instance(name))
+
+class fakeitem(object):
+
+    def __init__(self, value, writeable=False, onchangecallback=None, gettextcallback=None):
+        super(fakeitem, self).__init__()
+        self._value = value
+        self._writeable = writeable
+        self._onchangecallback = onchangecallback
+        self._gettextcallback = gettextcallback
+
+    def GetText(self):
+        if self._gettextcallback is not None and self._value is not None:
+            return self._gettextcallback(None, self._value)
+        return str(self._value)
+
+    def _local_set_value(self, newvalue):
+        if self._value == newvalue:
+            return None
+        self._value = newvalue
+        return { 'Value': newvalue, 'Text': self.GetText() }
+
+    def local_get_value(self):
+        return self._value
+
+class fakeservice(object):
+    """ VeDbusService on a fakebus. """
+
+    def __init__(self, servicename):
+        super(fakeservice, self).__init__()
+        self.servicename = servicename
+        self.dbusconn = None
+        self._dbusobjects = {}
+        self._dbusnodes = { '/': self }
+        self.signals = 0 # number of ItemsChanged signals
+
+    def add_path(self, path, value, description="", writeable=False,
+                 onchangecallback=None, gettextcallback=None):
+        self._dbusobjects[path] = fakeitem(value, writeable, onchangecallback, gettextcallback)
+
+    def add_mandatory_paths(self, processname, processversion, connection,
+            deviceinstance, productid, productname, firmwareversion, hardwareversion, connected):
+        self.add_path('/Mgmt/ProcessName', processname)
+        self.add_path('/Mgmt/ProcessVersion', processversion)
+        self.add_path('/Mgmt/Connection', connection)
+        self.add_path('/DeviceInstance', deviceinstance)
+        self.add_path('/ProductId', productid)
+        self.add_path('/ProductName', productname)
+        self.add_path('/FirmwareVersion', firmwareversion)
+        self.add_path('/HardwareVersion', hardwareversion)
+        self.add_path('/Connected', connected)
+
+    def ItemsChanged(self, changes):
+        self.signals += 1
+
+    def SetValue(self, path, value):
+        """ A write of another process, returns 0 if accepted (see vedbus). """
+        item = self._dbusobjects[path]
+        if not item._writeable:
+            return 1
+        if item._onchangecallback is not None and not item._onchangecallback(path, value):
+            return 2
+        item._local_set_value(value)
+        return 0
+
+    def __getitem__(self, path):
+        return self._dbusobjects[path].local_get_value()
+
+    def __setitem__(self, path, newvalue):
+        self._dbusobjects[path]._local_set_value(newvalue)
+
+    def __contains__(self, path):
+        return path in self._dbusobjects
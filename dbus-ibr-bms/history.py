@@ -0,0 +1,107 @@
+"""
+Windowed statistics over the last n samples of a value.
+"""
+
+from array import array
+
+class history(object):
+    """
+    Ring buffer of the last samples with running sums, update() and the
+    statistics are O(1) per window and do not allocate.
+
+    nhist is the length of the main window, windows are additional window
+    lengths (shorter or longer) over the same samples, e.g. history(30, (60, 3600)).
+    """
+
+    def __init__(self, nhist, windows=()):
+        super(history, self).__init__()
+        self.nhist = nhist
+
+        self.capacity = max((nhist,) + tuple(windows))
+        self.samples = array('d', bytes(8 * self.capacity))
+        self.pos = 0 # index of the next sample
+        self.count = 0 # number of samples, up to capacity
+
+        # window length -> running sum
+        self.sums = { n: 0.0 for n in (nhist,) + tuple(windows) }
+
+    def update(self, value):
+        samples = self.samples
+        pos = self.pos
+        for n in self.sums:
+            if self.count >= n:
+                # drop sample that leaves this window
+                self.sums[n] += value - samples[pos - n]
+            else:
+                self.sums[n] += value
+
+        samples[pos] = value
+        pos += 1
+        if self.count < self.capacity:
+            self.count += 1
+
+        if pos == self.capacity:
+            self.pos = 0
+            # Recompute the sums once per round to avoid
+            # accumulating rounding errors.
+            for n in self.sums:
+                self.sums[n] = self._sum(n)
+        else:
+            self.pos = pos
+
+    # Sum of the last n samples, computed from the samples (O(n))
+    def _sum(self, n):
+        n = min(n, self.count)
+        pos = self.pos
+        if n <= pos:
+            return sum(self.samples[pos-n:pos])
+        return sum(self.samples[:pos]) + sum(self.samples[self.capacity-(n-pos):])
+
+    # The samples, oldest first
+    def values(self):
+        pos = self.pos
+        if self.count < self.capacity:
+            return self.samples[:pos].tolist()
+        return self.samples[pos:].tolist() + self.samples[:pos].tolist()
+
+    def sum(self, n=None):
+        return abs(self.sums[n or self.nhist])
+
+    def As(self, n=None):
+        n = n or self.nhist
+        count = min(n, self.count)
+        if not count:
+            return 0
+        return self.sums[n] / count
+
+    def n(self, n=None):
+        return min(n or self.nhist, self.count)
+
+    def valid(self, n=None):
+        return self.count >= (n or self.nhist)
+
+class timehistory(history):
+    """
+    history of a value sampled at irregular intervals: add(value, dt)
+    accumulates the time weighted value into buckets of 'bucket' seconds,
+    each full bucket is one sample (its average).
+    """
+
+    def __init__(self, nhist, windows=(), bucket=1.0):
+        super(timehistory, self).__init__(nhist, windows)
+        self.bucket = bucket
+        self.acc = 0.0 # value * time in the current bucket
+        self.acct = 0.0 # time in the current bucket
+
+    def add(self, value, dt):
+        # Older samples would be dropped anyway
+        dt = min(dt, self.capacity * self.bucket)
+        while dt > 0:
+            d = min(dt, self.bucket - self.acct)
+            self.acc += value * d
+            self.acct += d
+            dt -= d
+            if self.acct >= self.bucket - 1e-9:
+                self.update(self.acc / self.acct)
+                self.acc = 0.0
+                self.acct = 0.0
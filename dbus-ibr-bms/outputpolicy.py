@@ -0,0 +1,108 @@
+"""
+Change suppression of the outputs of dbus-ibr-bms (DVCC limits, SOC): small
+changes of the control loop are not published, every publish makes
+systemcalc and the chargers re-evaluate their limits.
+
+Per path (see OUTPUT_POLICY in config.py):
+
+ * deadband: changes smaller than this are suppressed
+ * hold: minimum time between two publishes [s]
+ * slew: maximum rate of change [1/s], the published value follows a step
+   with this rate
+ * refresh: a suppressed change is published after this time anyway [s]
+ * immediatedown: decreases beyond the deadband are published at once,
+   without hold and slew (the safe direction of a limit)
+
+The published value differs from the computed one by less than the
+deadband, except for up to 'hold' seconds after a publish and while it
+follows a step with the slew rate. Paths without a policy and
+non-numeric values are published unchanged.
+
+The times ('now') are monotonic, a step of the wall clock would hold
+back or release the changes.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class pathpolicy(object):
+
+    def __init__(self, deadband=0, hold=0, slew=None, refresh=None, immediatedown=False):
+        super(pathpolicy, self).__init__()
+
+        self.deadband = deadband
+        self.hold = hold
+        self.slew = slew
+        self.refresh = refresh
+        self.immediatedown = immediatedown
+
+        self.value = None # last published value
+        self.time = None # monotonic time of the last publish
+
+        # Statistics
+        self.published = 0
+        self.suppressed = 0
+
+    def filter(self, value, now):
+        """ Returns the value to publish or None to suppress the change. """
+
+        if self.value is None or value is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+            return self.publish(value, now)
+
+        delta = value - self.value
+        if delta == 0:
+            return None
+
+        if delta <= -self.deadband and self.immediatedown:
+            return self.publish(value, now)
+
+        age = now - self.time
+        if not (self.refresh is not None and age >= self.refresh):
+            if abs(delta) < self.deadband or age < self.hold:
+                self.suppressed += 1
+                return None
+
+        if self.slew is not None:
+            step = self.slew * max(age, 0)
+            if abs(delta) > step:
+                value = self.value + (step if delta > 0 else -step)
+
+        return self.publish(value, now)
+
+    def publish(self, value, now):
+        self.value = value
+        self.time = now
+        self.published += 1
+        return value
+
+class outputpolicy(object):
+    """
+    The policies of the outputs, policies: { path: { parameter: value } }.
+    """
+
+    def __init__(self, policies):
+        super(outputpolicy, self).__init__()
+        self.policies = { path: pathpolicy(**params) for path, params in policies.items() }
+
+    def filter(self, outputs, now):
+        """ Returns the values of outputs ({ path: value }) to publish. """
+
+        res = {}
+        for path, value in outputs.items():
+            policy = self.policies.get(path, None)
+            if policy is None:
+                res[path] = value
+                continue
+            value = policy.filter(value, now)
+            if value is not None:
+                res[path] = value
+        return res
+
+    def suppressed(self):
+        """ Number of suppressed changes of all paths. """
+        return sum(p.suppressed for p in self.policies.values())
+
+    def stats(self):
+        return { path: (p.published, p.suppressed) for path, p in self.policies.items() }
@@ -0,0 +1,143 @@
+"""
+Batched update of many batteries (packs): the target() and regulate()
+phases of chargealgo.battery for all packs in one NumPy pass over a
+structure of arrays, the per pack state machine, history and logging stay
+in Python.
+
+The results are bit-identical to the per pack code: the same float64
+operations in the same order, the bulk charge voltage is rounded with
+Python's round() (np.round rounds differently).
+
+NumPy is optional, without it (or with few packs, see VECTORIZE_MIN_PACKS,
+disabled by default) the per pack code is used.
+"""
+
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import chargealgo
+from chargealgo import MIN_CELL_VOLTAGE, DYN_CUTOFF_END, DYN_CUTOFF_RANGE
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# State codes in the arrays
+BULK, BALANCING, FLOATING = 0, 1, 2
+CODES = { "bulk": BULK, "balancing": BALANCING, "floating": FLOATING }
+
+class packcore(object):
+    """
+    Structure of arrays of the batteries of a chargecontrol. The static
+    values (capacity, max. charge current, gains) are gathered when the set
+    of batteries changes, the inputs and the controller state every update.
+    """
+
+    def __init__(self):
+        super(packcore, self).__init__()
+        self.key = None
+        self.packs = []
+
+    def rebuild(self, packs):
+        self.packs = packs
+        self.key = tuple(map(id, packs))
+
+        self.c100 = np.array([ b.c100 for b in packs ], dtype=np.float64)
+        self.maxcc = np.array([ b.maxChargeCurrent for b in packs ], dtype=np.float64)
+        self.capacity = np.array([ b.BATTERY_CAPACITY for b in packs ], dtype=np.float64)
+        self.kp = np.array([ b.kp for b in packs ], dtype=np.float64)
+        self.ki = np.array([ b.ki for b in packs ], dtype=np.float64)
+
+    def update(self, batteries, cvavg, allfloat, dt):
+        """ Same as battery.update(cvavg, allfloat, dt) for all batteries. """
+
+        packs = list(batteries.values())
+        if tuple(map(id, packs)) != self.key:
+            self.rebuild(packs)
+
+        for b in packs:
+            b.read(dt)
+
+        self.target(packs, allfloat)
+
+        for b in packs:
+            b.cycle()
+
+        self.regulate(packs, cvavg, dt)
+
+        for b in packs:
+            b.protect()
+
+    def target(self, packs, allfloat):
+
+        cellpull = chargealgo.cellpull
+        cellfloat = chargealgo.cellfloat
+        umin = chargealgo.umin
+
+        # Inputs and controller state, one row per pack
+        rows = np.array([ (CODES[b.sm.current_state.id], b.ucell, b.cavg, b.lastbcv or 0.0, b.ysum, b.ubatt, b.cbatt)
+                for b in packs ], dtype=np.float64)
+        states = rows[:, 0]
+        self.ucell = ucell = rows[:, 1]
+        cavg = rows[:, 2]
+        self.lastbcv = rows[:, 3]
+        self.ysum = rows[:, 4]
+        self.ubatt = rows[:, 5]
+        self.cbatt = rows[:, 6]
+
+        # Target cell voltage
+        bulk = (states == BULK)
+        bcv = np.full(len(packs), cellpull if (not allfloat) else cellfloat)
+        bcv[states == BALANCING] = cellpull
+        if bulk.any():
+            v = np.minimum(cellpull + chargealgo.vrange * (cavg[bulk] - self.c100[bulk]) / self.maxcc[bulk],
+                    chargealgo.MAX_CHARGING_CELL_VOLTAGE)
+            bcv[bulk] = np.maximum(cellpull, [ round(x, 2) for x in v.tolist() ])
+
+        # fu(), fi()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f_u = np.where(ucell < umin, 0.0, np.minimum((ucell - umin) / (bcv - umin), 1))
+            f_i = np.where(cavg > self.maxcc, 0.0,
+                    np.where(cavg < self.c100, 1.0, 1 - ((cavg - self.c100) / (self.maxcc - self.c100))))
+        estsoc = np.minimum(f_u * f_i * 100, 99)
+
+        self.bcv = bcv
+        for b, bcv_, fu_, fi_, soc in zip(packs, bcv.tolist(), f_u.tolist(), f_i.tolist(), estsoc.tolist()):
+            b.nextbcv = bcv_
+            b.f_u = fu_
+            b.f_i = fi_
+            b.estsoc = soc
+
+    def regulate(self, packs, cvavg, dt):
+
+        bcv = self.bcv
+        lastbcv = self.lastbcv
+        ysum = self.ysum
+        ucell = self.ucell
+        ubatt = self.ubatt
+        cbatt = self.cbatt
+
+        # Keep the charge voltage on a change of the target voltage
+        changed = (lastbcv != 0) & (lastbcv != bcv)
+        ysum = np.where(changed, ysum - 16*(bcv - lastbcv), ysum)
+
+        diff = np.where(ucell > bcv, 0 - 16 * (ucell - bcv), 0 + 16 * np.minimum(bcv - ucell, 0.005))
+        diffvolt = np.maximum(np.minimum(cvavg - ubatt, 1), 0)
+
+        ysum = ysum + diff * self.ki * dt
+        ysum = np.where(ysum > 0.75, 0.75, np.where(ysum < -1.5, -1.5, ysum))
+
+        cv = 16*bcv + self.kp*diff + ysum + diffvolt
+
+        cutoff = np.where(cbatt != 0,
+                np.maximum(DYN_CUTOFF_END, np.minimum(MIN_CELL_VOLTAGE + DYN_CUTOFF_RANGE * (cbatt/self.capacity), MIN_CELL_VOLTAGE)),
+                MIN_CELL_VOLTAGE)
+
+        for b, bcv_, ysum_, cv_, cutoff_ in zip(packs, bcv.tolist(), ysum.tolist(), cv.tolist(), cutoff.tolist()):
+            b.lastbcv = b.bcv = bcv_
+            b.ysum = ysum_
+            b.chargevoltage = cv_
+            b.cellCutoff = cutoff_
@@ -0,0 +1,105 @@
+"""
+Performance counters of dbus-ibr-bms: latency histograms and event
+counters, published as /Ibr/Perf/* paths.
+"""
+
+import time, math
+from bisect import bisect_left
+
+# Upper bounds of the histogram buckets [ms], 0.01ms...7.4s, factor sqrt(2)
+BOUNDS = tuple(0.01 * math.pow(2, i/2) for i in range(40))
+
+class histogram(object):
+    """ Latency histogram with fixed, logarithmic buckets. """
+
+    def __init__(self):
+        super(histogram, self).__init__()
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.n = 0
+        self.max = 0.0
+
+    # Record a latency [s]
+    def record(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect_left(BOUNDS, ms)] += 1
+        self.n += 1
+        if ms > self.max:
+            self.max = ms
+
+    # Percentile [ms], the upper bound of its bucket
+    def percentile(self, p):
+        if not self.n:
+            return 0
+        target = math.ceil(p / 100.0 * self.n)
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= target:
+                break
+        if i < len(BOUNDS):
+            return min(BOUNDS[i], self.max)
+        return self.max
+
+# Latencies
+HISTOGRAMS = ("Update", "ValueChanged", "Scan", "LoopLag")
+# Counters, published as count and rate
+COUNTERS = ("SignalsIn", "SignalsOut", "OutputsSuppressed")
+
+def paths():
+    """ The /Ibr/Perf paths. """
+    res = []
+    for name in HISTOGRAMS:
+        res += [ f"/Ibr/Perf/{name}P50Ms", f"/Ibr/Perf/{name}P99Ms", f"/Ibr/Perf/{name}MaxMs" ]
+    for name in COUNTERS:
+        res += [ f"/Ibr/Perf/{name}", f"/Ibr/Perf/{name}PerSec" ]
+    return res
+
+class perfstats(object):
+    """
+    The histograms cover one publish interval, they are reset by values().
+    clock: monotonic() for the rates, perf_counter() for the latencies
+    (the time module or the clock of the backend, see fakebus.py).
+    """
+
+    def __init__(self, clock=time):
+        super(perfstats, self).__init__()
+        self.clock = clock
+        self.histograms = { name: histogram() for name in HISTOGRAMS }
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.lastCounters = dict(self.counters)
+        self.lastTime = clock.monotonic()
+
+    def record(self, name, seconds):
+        self.histograms[name].record(seconds)
+
+    def timed(self, name, func, *args, **kwargs):
+        t = self.clock.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.histograms[name].record(self.clock.perf_counter() - t)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def values(self):
+        """ Returns { path: value } of the last interval. """
+
+        now = self.clock.monotonic()
+        dt = max(now - self.lastTime, 0.001)
+        self.lastTime = now
+
+        res = {}
+        for name, h in self.histograms.items():
+            res[f"/Ibr/Perf/{name}P50Ms"] = round(h.percentile(50), 3)
+            res[f"/Ibr/Perf/{name}P99Ms"] = round(h.percentile(99), 3)
+            res[f"/Ibr/Perf/{name}MaxMs"] = round(h.max, 3)
+            h.reset()
+        for name, n in self.counters.items():
+            res[f"/Ibr/Perf/{name}"] = n
+            res[f"/Ibr/Perf/{name}PerSec"] = round((n - self.lastCounters[name]) / dt, 1)
+        self.lastCounters = dict(self.counters)
+        return res
@@ -0,0 +1,146 @@
+"""
+In-memory trace of the charge algorithm: fixed size binary records in a
+preallocated ring buffer, dumped to a csv file on demand (in chunks, from
+a copy of the buffer, see dumper()).
+
+The csv has the columns of the trace input of tools/replay.py.
+"""
+
+import struct, csv, copy
+
+STATES = ("bulk", "balancing", "floating")
+
+# Digits of the values in the csv (records store float32)
+DIGITS = 4
+
+# Records written per step of dumper()
+DUMP_CHUNK = 1000
+
+# Values of a battery read by chargealgo.battery, in record order
+BATTERY_PATHS = ("/Dc/0/Voltage", "/Dc/0/Current", "/System/MaxCellVoltage", "/System/MinCellVoltage",
+        "/Voltages/Diff", "/Soc", "/InstalledCapacity", "/Info/MaxChargeCurrent")
+
+# Internal values of a battery, in record order
+BATTERY_STATE = ("bcv", "cavg", "ysum", "estsoc", "cv")
+
+# Output values of a tick, in record order
+OUTPUTS = ("cv", "ccl", "soc", "realsoc")
+
+# One record per battery and tick:
+# time, battery index, battery paths, state, battery state,
+# cvavg, loadcurrent, outputs, chgmode, flags
+RECORD = struct.Struct("<dH8fB5f2f4fBB")
+
+FLAG_TURNEDOFF = 1
+FLAG_THROTTLING = 2
+
+class tracer(object):
+
+    def __init__(self, nrecords):
+        super(tracer, self).__init__()
+
+        self.nrecords = nrecords
+        self.buf = bytearray(RECORD.size * nrecords)
+        self.pos = 0 # index of the next record
+        self.count = 0
+
+        self.services = [] # battery index -> service name
+        self.index = {} # service name -> battery index
+
+    def battindex(self, service):
+        i = self.index.get(service, None)
+        if i is None:
+            i = self.index[service] = len(self.services)
+            self.services.append(service)
+        return i
+
+    def record(self, now, battObj, cvavg, loadcurrent, outputs, turnedOff):
+
+        flags = (FLAG_TURNEDOFF if turnedOff else 0) | (FLAG_THROTTLING if outputs["/Ess/Throttling"] else 0)
+
+        RECORD.pack_into(self.buf, self.pos * RECORD.size,
+                now, self.battindex(battObj.batt),
+                battObj.ubatt, battObj.cbatt, battObj.ucell, battObj.ucell_min,
+                battObj.voltagediff, battObj.bmssoc, battObj.BATTERY_CAPACITY, battObj.maxChargeCurrent,
+                STATES.index(battObj.sm.current_state.id),
+                battObj.bcv, battObj.cavg, battObj.ysum, battObj.estsoc, battObj.chargevoltage,
+                cvavg, loadcurrent,
+                outputs["/Info/MaxChargeVoltage"], outputs["/Info/MaxChargeCurrent"], outputs["/Soc"], outputs["/Info/RealSoc"],
+                STATES.index(outputs["/Ess/Chgmode"]), flags)
+
+        self.pos += 1
+        if self.pos == self.nrecords:
+            self.pos = 0
+        if self.count < self.nrecords:
+            self.count += 1
+
+    def records(self):
+        """ The records, oldest first. """
+        if self.count < self.nrecords:
+            indices = range(self.count)
+        else:
+            indices = list(range(self.pos, self.nrecords)) + list(range(self.pos))
+        for i in indices:
+            yield RECORD.unpack_from(self.buf, i * RECORD.size)
+
+    def copy(self):
+        """ A copy of the trace, to dump it while the recording continues. """
+        res = copy.copy(self)
+        res.buf = bytes(self.buf)
+        res.services = list(self.services)
+        res.index = dict(self.index)
+        return res
+
+    def dump(self, filename):
+        """ Write the trace as csv, one row per tick. Returns the number of rows. """
+        nrows = 0
+        for nrows in self.dumper(filename):
+            pass
+        return nrows
+
+    def dumper(self, filename, chunk=DUMP_CHUNK):
+        """
+        Generator writing the trace as csv, one row per tick. Writes about
+        chunk records per step and yields the number of rows written so far.
+        """
+
+        header = ["time", "cvavg", "loadcurrent"] + list(OUTPUTS) + ["chgmode", "turnedoff", "throttling"]
+        for service in self.services:
+            header += [ f"{service}:{path}" for path in BATTERY_PATHS ]
+            header += [ f"{service}.state" ] + [ f"{service}.{v}" for v in BATTERY_STATE ]
+
+        nbp = len(BATTERY_PATHS)
+        nbs = len(BATTERY_STATE)
+        rowsize = 1 + len(BATTERY_PATHS) + len(BATTERY_STATE)
+        nrows = 0
+
+        with open(filename, "w", newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+
+            row = None
+            for n, rec in enumerate(self.records(), 1):
+                t = rec[0]
+                if row is None or row[0] != t:
+                    if row is not None:
+                        writer.writerow(row)
+                        nrows += 1
+                    cvavg, loadcurrent = rec[3+nbp+nbs:5+nbp+nbs]
+                    outputs = rec[5+nbp+nbs:9+nbp+nbs]
+                    chgmode, flags = rec[9+nbp+nbs:]
+                    row = [ t, round(cvavg, DIGITS), round(loadcurrent, DIGITS) ] + [ round(v, DIGITS) for v in outputs ] + [ STATES[chgmode], int(bool(flags & FLAG_TURNEDOFF)), int(bool(flags & FLAG_THROTTLING)) ]
+                    row += [ "" ] * (rowsize * len(self.services))
+
+                col = 10 + rec[1] * rowsize
+                row[col:col+nbp] = [ round(v, DIGITS) for v in rec[2:2+nbp] ]
+                row[col+nbp] = STATES[rec[2+nbp]]
+                row[col+nbp+1:col+rowsize] = [ round(v, DIGITS) for v in rec[3+nbp:3+nbp+nbs] ]
+
+                if n % chunk == 0:
+                    yield nrows
+
+            if row is not None:
+                writer.writerow(row)
+                nrows += 1
+
+        yield nrows
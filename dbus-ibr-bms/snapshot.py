@@ -0,0 +1,61 @@
+"""
+Versioned state snapshot of dbus-ibr-bms, written atomically to a file.
+"""
+
+import os, json, time, logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Increment if the content changes incompatibly, older
+# snapshots are ignored then.
+VERSION = 1
+
+def write(filename, state):
+    """ Write state (dict) to filename, atomically: the file has the old or the new content. """
+
+    data = json.dumps({ "version": VERSION, "time": time.time(), "state": state }, separators=(',', ':'))
+
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+    # Make the rename durable
+    fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read(filename, maxage):
+    """ Returns the state of the snapshot or None if there is none, it is older than maxage [s] or of another version. """
+
+    try:
+        with open(filename) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"snapshot: can't read {filename}: {e}")
+        return None
+
+    try:
+        if snapshot.get("version") != VERSION:
+            logger.info(f"snapshot: ignoring version {snapshot.get('version')} of {filename}")
+            return None
+
+        age = time.time() - snapshot["time"]
+        state = snapshot["state"]
+    except (KeyError, AttributeError, TypeError) as e:
+        logger.warning(f"snapshot: invalid {filename}: {e!r}")
+        return None
+
+    if age < 0 or age > maxage:
+        logger.info(f"snapshot: ignoring {filename}, age {age:.0f}s")
+        return None
+
+    logger.info(f"snapshot: restoring {filename}, age {age:.0f}s")
+    return state
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of the value aggregation in dbus-ibr-bms: the old
+loop-over-all-batteries aggregation against the incremental reducers
+from aggregate.py.
+
+Usage: python3 bench_aggregate.py [nchanges]
+"""
+
+import sys, os, time, random
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+
+from aggregate import *
+
+addPath = ("Dc/0/Current", "Dc/0/Power", "Capacity", "ConsumedAmphours")
+minPath = ("System/MinCellVoltage", "System/MinCellTemperature")
+maxPath = ("System/MaxCellVoltage", "Dc/0/Voltage", "Voltages/Diff")
+allsetPath = ("Io/AllowToCharge", "Io/AllowToDischarge")
+paths = addPath + minPath + maxPath + allsetPath
+
+class legacy(object):
+    """ The aggregation as done by publishValue() before the reducers. """
+
+    def __init__(self, values):
+        self.values = values # battery -> path -> value
+
+    def publish(self, service, path, value):
+        self.values[service][path] = value
+        spath = path[1:]
+        iv = 0
+        if spath in addPath:
+            for batt in self.values:
+                v = value if batt == service else self.values[batt][path]
+                if type(v) == int or type(v) == float:
+                    iv += v
+        elif spath in maxPath:
+            for batt in self.values:
+                iv = max(iv, value if batt == service else self.values[batt][path])
+        elif spath in minPath:
+            iv = 0xffffffff
+            for batt in self.values:
+                iv = min(iv, value if batt == service else self.values[batt][path])
+        elif spath in allsetPath:
+            iv = 1
+            for batt in self.values:
+                if not (value if batt == service else self.values[batt][path]):
+                    iv = 0
+        return iv
+
+class incremental(object):
+
+    def __init__(self, values):
+        self.reducers = mirrorspec((
+            ("sum", addPath),
+            ("min", minPath),
+            ("max", maxPath),
+            ("allset", allsetPath),
+            )).reducers()
+        for batt in values:
+            for path, v in values[batt].items():
+                self.reducers[path].update(batt, v)
+
+    def publish(self, service, path, value):
+        return self.reducers[path].update(service, value)
+
+def run(cls, nbatt, changes):
+    values = { f"com.victronenergy.battery.ttyUSB{b}": { "/"+p: random.random() for p in paths } for b in range(nbatt) }
+    agg = cls(values)
+    t = time.perf_counter()
+    for service, path, value in changes:
+        agg.publish(service, path, value)
+    return len(changes) / (time.perf_counter() - t)
+
+def main():
+    nchanges = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    print(f"{'batteries':>10} {'legacy [signals/s]':>20} {'reducers [signals/s]':>22} {'speedup':>8}")
+    for nbatt in (1, 2, 4, 8, 16):
+        random.seed(nbatt)
+        changes = [ (f"com.victronenergy.battery.ttyUSB{random.randrange(nbatt)}", "/"+random.choice(paths), random.random())
+                    for i in range(nchanges) ]
+        old = run(legacy, nbatt, changes)
+        new = run(incremental, nbatt, changes)
+        print(f"{nbatt:>10} {old:>20.0f} {new:>22.0f} {new/old:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
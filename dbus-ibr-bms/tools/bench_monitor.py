@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""
+Measure the signal handling cost of the battery monitoring of dbus-ibr-bms
+on a bus with simulated batteries.
+
+Starts <n> simulated batteries, each changing its values every 100 ms, and
+measures the cpu time spent to handle their signals with:
+
+ * old: one DbusMonitor per battery plus the main monitor
+ * new: one shared MyDbusMonitor with the battery paths added at runtime
+
+Needs a session bus, run it on a PC like this:
+
+    dbus-run-session -- python3 bench_monitor.py 4
+"""
+
+import sys, os, time, subprocess, random
+from argparse import ArgumentParser
+
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..', '..', 'common', 'velib_python'))
+
+from vedbus import VeDbusService
+from dbusmonitor import DbusMonitor
+from busmonitor import MyDbusMonitor
+
+dummy = {"code": None, "whenToLog": "configChange", "accessLevel": None}
+
+changingPaths = ( "/Dc/0/Voltage", "/Dc/0/Current", "/Dc/0/Power", "/System/MaxCellVoltage",
+        "/System/MinCellVoltage", "/Voltages/Diff", "/Soc", "/Capacity", "/ConsumedAmphours" )
+staticPaths = tuple(f"/Alarms/Alarm{i}" for i in range(20)) + tuple(f"/Info/Static{i}" for i in range(30))
+
+def simbattery(n):
+    """ A simulated serial battery, writes its values one by one like dbus-ibr-serialbat. """
+    service = VeDbusService(f"com.victronenergy.battery.sim{n}")
+    service.add_path('/DeviceInstance', 100+n)
+    for path in changingPaths + staticPaths:
+        service.add_path(path, 0.0)
+
+    def tick():
+        for path in changingPaths:
+            service[path] = round(random.random(), 3)
+        return True
+
+    GLib.timeout_add(100, tick)
+    GLib.MainLoop().run()
+
+class PerServiceMonitor(DbusMonitor):
+    """ Old layout: a monitor with bus-wide signal receivers for one battery. """
+
+    def __init__(self, serviceName, paths, **kwargs):
+        self.only = serviceName
+        super(PerServiceMonitor, self).__init__({ "com.victronenergy.battery": paths }, **kwargs)
+
+    def scan_dbus_service_inner(self, serviceName):
+        if serviceName != self.only:
+            return False
+        return super(PerServiceMonitor, self).scan_dbus_service_inner(serviceName)
+
+def measure(layout, nbatt, seconds):
+
+    paths = { p: dummy for p in changingPaths + staticPaths }
+    batteries = [ f"com.victronenergy.battery.sim{n}" for n in range(nbatt) ]
+    ncallbacks = [0]
+
+    def value_changed(service, path, options, changes, deviceInstance):
+        ncallbacks[0] += 1
+
+    maintree = { "com.victronenergy.battery": { "/Soc": dummy } }
+    if layout == "old":
+        mains = DbusMonitor(maintree)
+        monitors = [ PerServiceMonitor(batt, paths, valueChangedCallback=value_changed) for batt in batteries ]
+    else:
+        monitor = MyDbusMonitor(maintree, valueChangedCallback=value_changed)
+        for batt in batteries:
+            monitor.add_service_paths(batt, paths)
+
+    cpu = time.process_time()
+    GLib.timeout_add(seconds * 1000, mainloop.quit)
+    mainloop.run()
+    cpu = time.process_time() - cpu
+
+    print(f"{layout}: {nbatt} batteries, {ncallbacks[0]/seconds:.0f} changes/s, cpu: {100*cpu/seconds:.1f}%")
+
+def main():
+    global mainloop
+
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('nbatt', type=int, nargs='?', default=4)
+    parser.add_argument('--seconds', type=int, default=30)
+    parser.add_argument('--battery', type=int, default=None, help=ArgumentParser.SUPPRESS)
+    parser.add_argument('--layout', default=None, help=ArgumentParser.SUPPRESS)
+    args = parser.parse_args()
+
+    DBusGMainLoop(set_as_default=True)
+    mainloop = GLib.MainLoop()
+
+    if args.battery is not None:
+        simbattery(args.battery)
+        return
+
+    if args.layout:
+        measure(args.layout, args.nbatt, args.seconds)
+        return
+
+    sims = [ subprocess.Popen([sys.executable, __file__, "--battery", str(n)]) for n in range(args.nbatt) ]
+    time.sleep(2)
+    try:
+        for layout in ("old", "new"):
+            subprocess.run([sys.executable, __file__, str(args.nbatt), "--seconds", str(args.seconds), "--layout", layout])
+    finally:
+        for sim in sims:
+            sim.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the batched (NumPy) update of the charge algorithm of
+dbus-ibr-bms (packcore.py) against the per battery update.
+
+Runs chargecontrol.step() with 1 to 128 synthetic packs on the
+same inputs with both implementations, checks that the outputs and the
+battery states are bit-identical and prints the cost per tick.
+
+Usage: python3 bench_packcore.py [nticks]
+"""
+
+import sys, os, time, random, logging
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..', '..', 'common', 'python'))
+
+import chargealgo, packcore
+
+PACKS = (1, 4, 16, 32, 48, 64, 128)
+
+# Compared battery attributes
+ATTRS = ("bcv", "estsoc", "f_u", "f_i", "ysum", "chargevoltage", "cellCutoff", "turnOff", "slowCharge")
+
+class source(object):
+    """ get_value() source: synthetic charge/discharge cycles, per pack variations. """
+
+    def __init__(self, npacks, seed=1):
+        super(source, self).__init__()
+        self.rnd = random.Random(seed)
+        self.values = {}
+        self.offsets = {}
+        for n in range(npacks):
+            service = f"com.victronenergy.battery.ttyUSB{n}"
+            self.offsets[service] = (self.rnd.uniform(-0.03, 0.03), self.rnd.uniform(0.8, 1.2))
+            self.values[service] = {
+                "/InstalledCapacity": self.rnd.choice((100, 200, 280)),
+                "/Info/MaxChargeCurrent": self.rnd.choice((50, 100, 140)),
+                }
+
+    def services(self):
+        return list(self.values)
+
+    def tick(self, t):
+        # 3000 ticks per cycle: bulk, absorption (balancing, floating), discharge
+        phase = (t % 3000) / 3000.0
+        for service, (du, fi) in self.offsets.items():
+            v = self.values[service]
+            if phase < 0.3:
+                i = fi * 40 * (1 - phase / 0.3) + self.rnd.uniform(-1, 1)
+                ucell = 3.30 + 0.5 * phase + du + self.rnd.uniform(-0.002, 0.002)
+                soc = 20 + 250 * phase
+            elif phase < 0.6:
+                i = 0.3 + self.rnd.uniform(-0.2, 0.2)
+                ucell = 3.45 + du + self.rnd.uniform(-0.002, 0.002)
+                soc = 95 + 16 * (phase - 0.3)
+            else:
+                i = -fi * 20 + self.rnd.uniform(-1, 1)
+                ucell = 3.32 - 0.4 * (phase - 0.6) + du
+                soc = 100 - 150 * (phase - 0.6)
+            v["/Dc/0/Current"] = round(i, 2)
+            v["/System/MaxCellVoltage"] = round(ucell, 3)
+            v["/System/MinCellVoltage"] = round(ucell - 0.004, 3)
+            v["/Voltages/Diff"] = 0.004
+            v["/Dc/0/Voltage"] = round(16 * ucell - 0.01, 2)
+            v["/Soc"] = round(soc, 1)
+
+    def get_value(self, service, path):
+        return self.values[service].get(path, None)
+
+def setup(src, vectorize):
+    chargealgo.VECTORIZE_MIN_PACKS = 1 if vectorize else 0
+    control = chargealgo.chargecontrol()
+    for service in src.services():
+        control.addBattery(service, chargealgo.battery(src, service))
+    return control
+
+def run(npacks, ticks, check):
+    srcs = (source(npacks), source(npacks))
+    controls = (setup(srcs[0], False), setup(srcs[1], True))
+    costs = [0.0, 0.0]
+    mismatch = None
+
+    for t in range(ticks):
+        outputs = []
+        for k in (0, 1):
+            srcs[k].tick(t)
+            t0 = time.perf_counter()
+            outputs.append(controls[k].step(29 * 16 * 0.1 + 52, -5, 1e9 + t))
+            costs[k] += time.perf_counter() - t0
+
+        if check and mismatch is None:
+            if outputs[0] != outputs[1]:
+                mismatch = f"tick {t}: outputs {outputs[0]} != {outputs[1]}"
+            for a, b in zip(controls[0].batteries.values(), controls[1].batteries.values()):
+                for attr in ATTRS:
+                    if getattr(a, attr) != getattr(b, attr) and mismatch is None:
+                        mismatch = f"tick {t}, {a.batt}: {attr} {getattr(a, attr)!r} != {getattr(b, attr)!r}"
+                if a.sm.current_state is not b.sm.current_state and mismatch is None:
+                    mismatch = f"tick {t}, {a.batt}: state {a.sm.current_state} != {b.sm.current_state}"
+
+    return costs[0] / ticks, costs[1] / ticks, mismatch
+
+def main():
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+
+    logging.basicConfig()
+    chargealgo.logger.setLevel(logging.WARNING)
+
+    if packcore.np is None:
+        print("NumPy is not installed, nothing to compare")
+        return
+
+    print(f"{ticks} ticks")
+    print(f"{'packs':>5}  {'per pack':>10}  {'numpy':>10}  {'speedup':>7}  identical")
+    for npacks in PACKS:
+        scalar, vector, mismatch = run(npacks, ticks, True)
+        print(f"{npacks:5d}  {scalar*1e6:7.1f} us  {vector*1e6:7.1f} us  {scalar/vector:6.2f}x  "
+              + ("yes" if mismatch is None else f"NO: {mismatch}"))
+
+if __name__ == "__main__":
+    main()
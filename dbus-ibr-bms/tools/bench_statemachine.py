@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the charger state machine of dbus-ibr-bms: the built-in
+table driven ChargerStateMachine against the former implementation with
+python-statemachine (if installed).
+
+Measures the cost of one cycle() per tick on a charge cycle that spends
+most ticks without a transition, checks that both implementations run
+through the same states and measures the import time of both.
+
+Usage: python3 bench_statemachine.py [nticks]
+"""
+
+import sys, os, time, subprocess, logging
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..', '..', 'common', 'python'))
+
+import chargealgo
+from chargealgo import ChargerStateMachine
+
+try:
+    from statemachine import StateMachine, State
+    from statemachine.exceptions import TransitionNotAllowed
+except ImportError:
+    StateMachine = None
+
+if StateMachine:
+    class LegacyStateMachine(StateMachine):
+        """ The former ChargerStateMachine, guards and hooks are shared. """
+        bulk = State(initial=True)
+        balancing = State()
+        floating = State()
+
+        cycle = (
+            bulk.to(balancing, cond="ladeende")
+            | balancing.to(floating, cond="balanced")
+            | balancing.to(bulk, cond="discharge")
+            | floating.to(bulk, cond="discharge")
+        )
+
+        def __init__(self):
+            super(LegacyStateMachine, self).__init__()
+            self.reset()
+
+        reset = ChargerStateMachine.reset
+        isBalancing = ChargerStateMachine.isBalancing
+        ladeende = ChargerStateMachine.ladeende
+        balanced = ChargerStateMachine.balanced
+        discharge = ChargerStateMachine.discharge
+        on_enter_balancing = ChargerStateMachine.on_enter_balancing
+
+class fakehistory(object):
+    nhist = 30
+    def valid(self):
+        return True
+    def n(self):
+        return self.nhist
+
+class fakebattery(object):
+    """ Inputs of the guards, a charge/discharge cycle every 2000 ticks. """
+
+    def __init__(self):
+        self.batt = "com.victronenergy.battery.ttyUSB0"
+        self.bhistory = fakehistory()
+        self.dt = 1.0 # time since the last update [s], one tick per second
+
+    def set(self, tick):
+        t = tick % 2000
+        self.estsoc = 99 if 500 <= t < 510 else 50
+        self.voltagediff = 0.001 if t > 600 else 0.02
+        # charging up to t=1000, then discharging
+        self.bmssoc = 50 + min(t, 1000) / 100.0 - max(t - 1000, 0) / 100.0
+
+def run(sm, ticks, cycle):
+    battery = fakebattery()
+    states = []
+    t = time.perf_counter()
+    for tick in range(ticks):
+        battery.set(tick)
+        cycle(sm, battery)
+        states.append(sm.current_state.id)
+    return (time.perf_counter() - t) / ticks, states
+
+def cycle(sm, battery):
+    sm.cycle(battery)
+
+def legacycycle(sm, battery):
+    try:
+        sm.cycle(battery)
+    except TransitionNotAllowed:
+        pass
+
+def importtime(module):
+    code = ("import sys, time; sys.path[1:1] = %r; t = time.perf_counter(); import %s; print(time.perf_counter() - t)"
+            % (sys.path[1:3], module))
+    res = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    if res.returncode:
+        return None
+    return float(res.stdout)
+
+def main():
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    logging.basicConfig()
+    chargealgo.logger.setLevel(logging.WARNING)
+
+    builtin, states = run(ChargerStateMachine(), ticks, cycle)
+    transitions = sum(1 for a, b in zip(states, states[1:]) if a != b)
+    print(f"{ticks} ticks, {transitions} transitions")
+    print(f"built-in:             {builtin*1e6:8.2f} us/tick")
+
+    if StateMachine:
+        legacy, legacystates = run(LegacyStateMachine(), ticks, legacycycle)
+        print(f"python-statemachine:  {legacy*1e6:8.2f} us/tick ({legacy/builtin:.1f}x)")
+        print(f"same states: {legacystates == states}")
+    else:
+        print("python-statemachine:  not installed")
+
+    for module in ("chargealgo", "statemachine"):
+        t = importtime(module)
+        print(f"import {module}: " + (f"{t*1e3:.1f} ms" if t is not None else "failed"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Check of replay.py with a real dump of the in-memory trace (recorder.py):
+runs the charge algorithm with synthetic packs (see bench_packcore.py),
+the second pack is hot-plugged, removed and re-added, the ring buffer
+wraps mid-tick. The dump is replayed and the replay must run through all
+ticks with the same batteries present as recorded. The agreement of the
+charge mode and the charge voltage is printed (the trace stores float32
+values rounded to recorder.DIGITS, the replay is not bit-identical).
+
+Usage: python3 check_replay.py [nticks]
+"""
+
+import sys, os, csv, tempfile, logging
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..', '..', 'common', 'python'))
+
+import chargealgo, recorder, replay
+from bench_packcore import source
+
+def record(ticks, filename):
+    """ Runs the algorithm and dumps its trace to filename. """
+
+    src = source(2)
+    first, second = src.services()
+    # 1.7 records per tick: the buffer wraps at 20% of the ticks, mid-tick
+    trace = recorder.tracer(14 * ticks // 10 + 1)
+    control = chargealgo.chargecontrol(trace)
+
+    # The second pack: added at 10%, removed at 40%, back at 60% of the ticks
+    plug = { ticks // 10: True, 4 * ticks // 10: False, 6 * ticks // 10: True }
+
+    control.addBattery(first, chargealgo.battery(src, first))
+    for t in range(ticks):
+        now = 1e9 + t
+        src.tick(t)
+        if plug.get(t) is True:
+            control.addBattery(second, control.unpark(second) or chargealgo.battery(src, second))
+        elif plug.get(t) is False:
+            control.removeBattery(second, now)
+        control.step(29 * 16 * 0.1 + 52, -5, now)
+
+    trace.dump(filename)
+
+def check(ticks):
+    with tempfile.TemporaryDirectory() as tmp:
+        tracefile = os.path.join(tmp, "trace.csv")
+        timeline = os.path.join(tmp, "timeline.csv")
+
+        record(ticks, tracefile)
+        print(replay.replay(tracefile, timeline))
+
+        header, rows = replay.readtrace(tracefile)
+        with open(timeline, newline='') as f:
+            reader = csv.reader(f)
+            theader = next(reader)
+            trows = list(reader)
+
+    if len(trows) != len(rows):
+        return f"{len(trows)} replayed ticks, {len(rows)} recorded"
+
+    services = sorted(set(h.split(":", 1)[0] for h in header if ":" in h))
+    ichgmode, icv = header.index("chgmode"), header.index("cv")
+    tchgmode, tcv = theader.index("/Ess/Chgmode"), theader.index("/Info/MaxChargeVoltage")
+
+    samemode = samecv = 0
+    for row, trow in zip(rows, trows):
+        for service in services:
+            recorded = row[header.index(f"{service}.state")] != ""
+            replayed = trow[theader.index(f"{service.split('.')[-1]}:state")] != ""
+            if recorded != replayed:
+                return f"time {row[0]}: {service} recorded {recorded}, replayed {replayed}"
+        samemode += row[ichgmode] == trow[tchgmode]
+        samecv += trow[tcv] != "" and abs(float(row[icv]) - float(trow[tcv])) < 0.01
+
+    print(f"{len(rows)} ticks, same batteries, charge mode {samemode/len(rows):.1%}, "
+          f"charge voltage (10 mV) {samecv/len(rows):.1%} as recorded")
+    return None
+
+def main():
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 6000
+
+    logging.basicConfig()
+    chargealgo.logger.setLevel(logging.WARNING)
+
+    error = check(ticks)
+    if error:
+        print(f"FAILED: {error}")
+        sys.exit(1)
+    print("ok")
+
+if __name__ == "__main__":
+    main()
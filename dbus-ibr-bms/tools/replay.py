@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""
+Replay a recorded trace through the charge algorithm of dbus-ibr-bms,
+faster than realtime and without dbus.
+
+The trace is a csv file with one row per update tick (1s):
+
+    time,cvavg,loadcurrent,<battery service>:<path>,...
+
+e.g. "com.victronenergy.battery.ttyUSB0:/Dc/0/Voltage". Every battery
+needs the columns read by chargealgo.battery: /Dc/0/Voltage, /Dc/0/Current,
+/System/MaxCellVoltage, /System/MinCellVoltage, /Voltages/Diff, /Soc,
+/InstalledCapacity and /Info/MaxChargeCurrent. Empty cells keep the
+previous value. A battery is added with the first row that has values of
+it and removed (chargecontrol.removeBattery()) while all its columns are
+empty, like a hot-plugged battery of the service. A dump of the
+in-memory trace of the service (/Ibr/Trace/Dump, see recorder.py) has
+this format, tools/check_replay.py replays one.
+
+The output is a timeline csv with the published values (charge voltage,
+charge current limit, charge mode, soc) and the state of every battery.
+
+Parameter sweeps: --params takes a json file with a list of parameter sets,
+e.g. [{"kp": 0.75, "ki": 0.02}, {"kp": 1.0, "cellpull": 3.39}], the sets
+are replayed in parallel and written to <out>-<n>.csv. Known parameters:
+kp, ki, cellpull, cellfloat, minbalancesoc, BALANCETIME.
+
+Usage: python3 replay.py trace.csv [-o timeline.csv] [--params sweep.json]
+"""
+
+import sys, os, csv, json, time, logging
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..', '..', 'common', 'python'))
+
+import chargealgo
+
+# Module level parameters of chargealgo, restored before each run
+defaults = { k: getattr(chargealgo, k) for k in ("cellpull", "cellfloat", "minbalancesoc", "BALANCETIME") }
+
+outputPaths = ( "/Info/MaxChargeVoltage", "/Info/MaxChargeCurrent", "/Ess/Chgmode", "/Ess/Throttling",
+        "/Ess/Balancing", "/Soc", "/Info/RealSoc", "/Info/CutOffVoltage", "/Info/TurnOnSoc" )
+
+class tracesource(object):
+    """ get_value() source for the batteries, the values of the current row. """
+
+    def __init__(self):
+        super(tracesource, self).__init__()
+        self.values = {} # service -> path -> value
+
+    def update(self, columns, row):
+        """ Returns the services with values in this row. """
+        present = set()
+        for (service, path), v in zip(columns, row):
+            if v != "":
+                self.values.setdefault(service, {})[path] = float(v)
+                present.add(service)
+        return present
+
+    def get_value(self, service, path):
+        return self.values.get(service, {}).get(path, None)
+
+def readtrace(filename):
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    return header, rows
+
+def setparams(params):
+    for k, v in defaults.items():
+        setattr(chargealgo, k, params.get(k, v))
+    # derived values
+    chargealgo.vrange = chargealgo.MAX_CHARGING_CELL_VOLTAGE - chargealgo.cellpull
+    chargealgo.umin = chargealgo.cellfloat - 0.020
+
+def replay(filename, outfile, params={}):
+
+    setparams(params)
+
+    header, rows = readtrace(filename)
+    itime = header.index("time")
+    icvavg = header.index("cvavg")
+    iload = header.index("loadcurrent")
+
+    # battery values: (service, path) per column
+    battcols = [ i for i, h in enumerate(header) if ":" in h ]
+    columns = [ tuple(header[i].split(":", 1)) for i in battcols ]
+    services = sorted(set(service for service, path in columns))
+
+    source = tracesource()
+    control = chargealgo.chargecontrol()
+
+    t = time.perf_counter()
+    with open(outfile, "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(("time",) + outputPaths + tuple(f"{s.split('.')[-1]}:state" for s in services))
+
+        for row in rows:
+            now = float(row[itime])
+            present = source.update(columns, [ row[i] for i in battcols ])
+
+            for service in services:
+                if service in present and service not in control.batteries:
+                    battObj = control.unpark(service)
+                    if battObj is None:
+                        battObj = chargealgo.battery(source, service)
+                        battObj.kp = params.get("kp", battObj.kp)
+                        battObj.ki = params.get("ki", battObj.ki)
+                    control.addBattery(service, battObj)
+                elif service not in present and service in control.batteries:
+                    control.removeBattery(service, now)
+
+            outputs = control.step(float(row[icvavg] or 0), float(row[iload] or 0), now)
+
+            writer.writerow([ row[itime] ] +
+                    [ outputs.get(p, "") if p != "/Ess/Balancing" else " ".join(sorted(outputs.get(p, ()))) for p in outputPaths ] +
+                    [ control.batteries[s].sm.current_state.id if s in control.batteries else "" for s in services ])
+
+    t = time.perf_counter() - t
+    return f"{outfile}: {len(rows)} ticks in {t:.2f}s ({len(rows)/t:.0f}x realtime), params: {params}"
+
+def replaystar(args):
+    return replay(*args)
+
+def main():
+
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('trace', help='recorded trace (csv)')
+    parser.add_argument('-o', '--out', default='timeline.csv', help='timeline output (csv)')
+    parser.add_argument('--params', default=None, help='json file with a list of parameter sets')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of parallel replays')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log the algorithm details')
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    chargealgo.logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    if not args.params:
+        print(replay(args.trace, args.out))
+        return
+
+    with open(args.params) as f:
+        paramsets = json.load(f)
+
+    base, ext = os.path.splitext(args.out)
+    jobs = [ (args.trace, f"{base}-{n}{ext or '.csv'}", params) for n, params in enumerate(paramsets) ]
+    with Pool(args.jobs) as pool:
+        for res in pool.imap(replaystar, jobs):
+            print(res)
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ THTime = 60 # [s]
 
 from config import *
 from utils import *
+from transport import runblocking
 
 C50 = BATTERY_CAPACITY / 2
 CUTOFFCURR = BATTERY_CAPACITY*0.05 # [A]
@@ -86,6 +87,7 @@ class Cell:
     voltage = None
     balance = None
 
+    # balance: balancing state of the cell, None if the BMS does not report it
     def __init__(self, balance):
         self.balance = balance
 
@@ -96,7 +98,9 @@ class Battery(object):
         self.port = port
         self.baud_rate = baud
         self.type = 'Generic'
-        self.poll_interval = 1000 # mS # xxx overwritten in Battery subclass (Daliy)
+        self.poll_interval = 1000 # mS, period of the default poll command, see poll_commands()
+        self.ser = None # serial device handle
+        self.decoder = None # frame decoder, see framing.py
 
         self.hardware_version = None
         self.voltage = None
@@ -131,10 +135,27 @@ class Battery(object):
         self.cell_max_voltage = 0
         self.cell_min_voltage = 99
 
-    def test_connection(self):
-        # Each driver must override this function to test if a connection can be made
+    def test_connection(self, ser=None):
+        # Open the port (or use the open port ser) and run probe() with
+        # blocking reads
         # return false when fail, true if successful
+        self.ser = ser or open_serial_port(self.port, self.baud_rate)
+        if self.ser is not None:
+            return runblocking(self.ser, self.decoder, self.probe())
+
+        return False
+
+    def probe(self):
+        # Each driver must override this function to test if a connection can be made
+        # A poll generator (see transport.py): yields the requests, returns
+        # false when fail, true if successful
         return False
+        yield
+
+    def close(self):
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
 
     def get_settings(self):
         # Each driver must override this function to read/set the battery settings
@@ -147,8 +168,16 @@ class Battery(object):
     def refresh_data(self):
         # Each driver must override this function to read battery data and populate this class
         # It is called each poll just before the data is published to vedbus
-        # return false when fail, true if successful
+        # A poll generator (see transport.py): yields the requests, returns
+        # false when fail, true if successful
         return False
+        yield
+
+    def poll_commands(self):
+        # The commands of the poll scheduler (see pollsched.py): list of
+        # (name, poll generator function, period [ms], priority).
+        # Default: refresh_data every poll_interval.
+        return [ ("refresh", self.refresh_data, self.poll_interval, 0) ]
 
     def set_soc(self, soc):
         self.soc = round(soc, 2)
@@ -190,6 +219,20 @@ class Battery(object):
                 max_cell = c
         return max_cell
 
+    def get_cell_voltages(self):
+        """ Voltages of all cells, None until all cells are read. """
+        voltages = [ c.voltage for c in self.cells[:self.cell_count] ]
+        if not voltages or None in voltages:
+            return None
+        return voltages
+
+    def get_cell_balances(self):
+        """ Balance flags (1/0) of all cells, None if the BMS does not report them. """
+        balances = [ c.balance for c in self.cells[:self.cell_count] ]
+        if not balances or None in balances:
+            return None
+        return [ 1 if b else 0 for b in balances ]
+
     def get_min_cell_desc(self):
         cell_no = self.get_min_cell()
         return cell_no if cell_no is None else 'C' + str(cell_no + 1)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Protocol codec of the Daly and Felicity BMS: the message layouts as
+precompiled struct.Struct objects, the command frames prebuilt once per
+address and a table driven CRC16/Modbus.
+
+The layouts unpack from the reply buffers directly (memoryview slices, no
+copies), the multi-frame Daly cell voltage reply is parsed with
+iter_unpack().
+"""
+
+import struct
+from functools import lru_cache
+
+#
+# CRC16/Modbus (polynomial 0xA001 reflected, init 0xFFFF)
+#
+def _crc16_table():
+    table = []
+    for n in range(256):
+        crc = n
+        for i in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _crc16_table()
+
+def crc16_modbus(data):
+    crc = 0xFFFF
+    table = CRC16_TABLE
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
+
+CRC16 = struct.Struct("<H")
+
+#
+# Daly: [A5][Address][Command][Length=08][8 data bytes][Checksum]
+#
+DALY_FRAME_LENGTH = 13
+
+DALY_STATUS = struct.Struct(">bb??bhx")         # 0x94: cell count, temp. sensors, charger, load, state, cycles
+DALY_SOC = struct.Struct(">hhhh")               # 0x90: voltage, -, current, soc
+DALY_MINMAX_CELLS = struct.Struct(">hbhb")      # 0x91: max. voltage, cell, min. voltage, cell
+DALY_MINMAX_TEMP = struct.Struct(">bbbb")       # 0x92: max. temperature, sensor, min. temperature, sensor
+DALY_FET = struct.Struct(">b??BL")              # 0x93: state, charge fet, discharge fet, cycles, capacity
+DALY_ALARM = struct.Struct(">bbbbbbbb")         # 0x98: alarm bits
+# 0x95: one frame with frame number, 3 cell voltages and the last data
+# byte (compared over all frames by the driver), the checksum is skipped
+DALY_CELL_FRAME = struct.Struct(">BBBBBhhhBx")
+
+@lru_cache(maxsize=None)
+def daly_command(address, command):
+    """ Command frame to address (b"\\x40" or b"\\x80"). """
+    frame = bytearray(b"\xA5\x00\x00\x08" + 8 * b"\x00")
+    frame[1] = address[0]
+    frame[2] = command[0]
+    frame.append(sum(frame) & 0xFF)
+    return bytes(frame)
+
+@lru_cache(maxsize=None)
+def daly_cells_command(address, command):
+    """
+    Cell voltage command frame, followed by zero bytes. The checksum byte
+    is 0x82 for both addresses.
+    """
+    frame = bytearray(b"\xA5\x00\x00\x08" + 8 * b"\x00" + b"\x82" + 195 * b"\x00")
+    frame[1] = address[0]
+    frame[2] = command[0]
+    return bytes(frame)
+
+#
+# Felicity: Modbus RTU, [Address][03][Register (2 bytes)][Count (2 bytes)][CRC16]
+#
+FELICITY_U16 = struct.Struct(">H")
+FELICITY_S16 = struct.Struct(">h")
+FELICITY_HEADER = struct.Struct("BBB")          # address, function, byte count
+FELICITY_VOLTAGE_CURRENT = struct.Struct(">Hh")
+FELICITY_STATUS = struct.Struct(">HHH")         # status, -, fault
+FELICITY_SERIAL = struct.Struct(">HHHHH")
+FELICITY_TEMPERATURES = struct.Struct(">hhhhh")
+
+@lru_cache(maxsize=None)
+def felicity_cells(ncells):
+    return struct.Struct(f">{ncells}H")
+
+@lru_cache(maxsize=None)
+def modbus_command(address, function, command):
+    """ Request frame, command: register and count (4 bytes). """
+    frame = bytes(address) + function + command
+    return frame + CRC16.pack(crc16_modbus(frame))
@@ -31,6 +31,71 @@ BALANCETIME = 120 # [s]
 # Invert Battery Current. Default non-inverted. Set to -1 to invert
 INVERT_CURRENT_MEASUREMENT = -1
 
+# Poll scheduler (see pollsched.py): target period [ms] and priority
+# (lower first) of the battery commands
+DALY_POLL = {
+    "soc":          (500, 0),   # current, voltage, soc
+    "minmax_cells": (1000, 1),
+    "cells":        (5000, 2),
+    "alarm":        (10000, 3),
+    "fet":          (10000, 3),
+    "temperature":  (30000, 4),
+    }
+FELICITY_POLL = {
+    "soc":          (1000, 0),  # voltage, current, soc, status
+    "cells":        (2000, 1),
+    "temperature":  (30000, 2),
+    }
+# Felicity read planner (see registers.py): register blocks at most
+# FELICITY_MAX_GAP registers apart are read with one request of at most
+# FELICITY_MAX_REGS registers
+FELICITY_MAX_GAP = 8
+FELICITY_MAX_REGS = 64
+# A merged read is split into the reads of its blocks when the BMS rejects
+# it, or when it failed FELICITY_SPLIT_ERRORS times in a row and the
+# blocks can be read one by one (a BMS that does not answer it)
+FELICITY_SPLIT_ERRORS = 3
+# Interval of the achieved poll rates log [s]
+POLL_STATS_INTERVAL = 600
+# The port is restarted when one command failed POLL_MAX_ERRORS times in
+# a row and for at least POLL_ERROR_TIME seconds (about the 10 failed
+# full refreshes of older versions)
+POLL_MAX_ERRORS = 10
+POLL_ERROR_TIME = 20 # [s]
+
+# Multi-port mode (more than one port on the command line): delay of the
+# reconnect of a failed port [s]
+MULTIPORT_RECONNECT = 10
+
+# Publishing deadbands (path pattern -> deadband): a change of a value
+# smaller than the deadband is not published, unless the last publish of
+# the path is PUBLISH_REFRESH seconds ago. The first matching pattern
+# counts, None: no deadband. Max/MinCellVoltage and /Voltages/Diff have
+# no deadband, the cell voltage regulation and the balancer check
+# (BALANCER_CELLDIFF, 5 mV) of dbus-ibr-bms work on these.
+PUBLISH_DEADBANDS = {
+    "/Voltages/Diff":           None,
+    "/Voltages/*":              0.005,  # cell voltages, sum
+    "/Dc/0/Voltage":            0.02,
+    "/Dc/0/Current":            0.1,
+    "/Dc/0/Power":              5,
+    "/Soc":                     0.1,
+    "/Capacity":                0.1,
+    "/ConsumedAmphours":        0.1,
+    }
+# Forced refresh of the values within the deadband [s], also the update
+# interval of /Ibr/Perf/*
+PUBLISH_REFRESH = 60
+# The cell voltages and balance flags are published as arrays
+# (/Voltages/Cells, /Balances/Cells). True: also as single paths
+# /Voltages/Cell<n> and /Balances/Cell<n> (older consumers, n signals
+# more per poll)
+PUBLISH_CELL_PATHS = False
+
+# Detected battery type and address per serial adapter (udev serial ID),
+# probed first on the next start, see probecache.py
+PROBE_CACHE_DIR = "/data/var/lib/ibrserialbat-probe"
+
 # Service name for debugging
 SERVICENAME="battery"
 
@@ -2,7 +2,9 @@
 from battery import Battery, Cell
 from utils import *
 from config import *
-from struct import *
+from codec import *
+from transport import request
+from framing import dalydecoder
 
 import math
 
@@ -14,8 +16,6 @@ class Daly(Battery):
         self.cell_min_voltage = None
         self.cell_min_no = None
         self.cell_max_no = None
-        self.poll_interval = 2000
-        self.poll_step = 0
         self.type = "Daly"
 
         # SMOOTH_BMS_CURRENT
@@ -24,11 +24,9 @@ class Daly(Battery):
 
         # Mod erri
         self.capacity_remain = BATTERY_CAPACITY * 0.5 # initial value, don't know real capacity
-        self.ser = None # serial device handle
+        self.decoder = dalydecoder()
 
-    # command bytes [StartFlag=A5][Address=40][Command=94][DataLength=8][8x zero bytes][checksum]
-    command_base = b"\xA5\x40\x94\x08\x00\x00\x00\x00\x00\x00\x00\x00\x81"
-    cellvolt_buffer = b"\xA5\x40\x94\x08\x00\x00\x00\x00\x00\x00\x00\x00\x82\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+    # command bytes [StartFlag=A5][Address=40][Command=94][DataLength=8][8x zero bytes][checksum], see codec.py
     command_soc = b"\x90"
     command_minmax_cell_volts = b"\x91"
     command_minmax_temp = b"\x92"
@@ -38,19 +36,11 @@ class Daly(Battery):
     # command_temp = b"\x96"
     # command_cell_balance = b"\x97"
     command_alarm = b"\x98"
-    LENGTH_CHECK = 4
-    LENGTH_POS = 3
     CURRENT_ZERO_CONSTANT = 30000
     TEMP_ZERO_CONSTANT = 40
-    DALY_PACKET_LENGTH = 13
 
-    def test_connection(self):
-
-        self.ser = open_serial_port(self.port, self.baud_rate)
-        if self.ser is not None:
-            return self.read_status_data(self.ser)
-
-        return False
+    def probe(self):
+        return (yield from self.read_status_data())
 
     def get_settings(self):
         self.capacity = BATTERY_CAPACITY
@@ -60,30 +50,26 @@ class Daly(Battery):
         self.max_battery_discharge_current = MAX_BATTERY_DISCHARGE_CURRENT
         return True
 
-    def refresh_data(self):
-
-        if not self.read_cell_voltage_range_data(self.ser): return False
-        if not self.read_cells_volts(self.ser): return False
-        if not self.read_soc_data(self.ser): return False # read current und update current average frequently
-
-        read_methods = [ self.read_alarm_data, self.read_temperature_range_data, self.read_fed_data ]
-        result = read_methods[self.poll_step](self.ser)
-        if result:
-            self.poll_step += 1
-            if self.poll_step == len(read_methods):
-                self.poll_step = 0
-
-        return result
-
-    def read_status_data(self, ser):
-        status_data = self.read_serial_data_daly(ser, self.command_status)
+    def poll_commands(self):
+        methods = {
+            "soc": self.read_soc_data, # read current und update current average frequently
+            "minmax_cells": self.read_cell_voltage_range_data,
+            "cells": self.read_cells_volts,
+            "alarm": self.read_alarm_data,
+            "fet": self.read_fed_data,
+            "temperature": self.read_temperature_range_data,
+            }
+        return [ (name, methods[name], period, priority) for name, (period, priority) in DALY_POLL.items() ]
+
+    def read_status_data(self):
+        status_data = yield from self.read_serial_data_daly(self.command_status)
         # check if connection success
         if status_data is False:
             logger.info("error serial read in read_status_data")
             return False
 
         self.cell_count, _, _, _, \
-            state, self.cycles = unpack_from('>bb??bhx', status_data)
+            state, self.cycles = DALY_STATUS.unpack(status_data)
 
         # self.max_battery_voltage = MAX_CELL_VOLTAGE * self.cell_count
         # self.min_battery_voltage = MIN_CELL_VOLTAGE * self.cell_count
@@ -92,15 +78,15 @@ class Daly(Battery):
         logger.info(f"Fake hardware version: {self.hardware_version}")
         return True
 
-    def read_soc_data(self, ser):
+    def read_soc_data(self):
 
-        soc_data = self.read_serial_data_daly(ser, self.command_soc)
+        soc_data = yield from self.read_serial_data_daly(self.command_soc)
         # check if connection success
         if soc_data is False:
             logger.warning("read_soc_data(): error serial read")
             return False
 
-        voltage, tmp, current, soc = unpack_from('>hhhh', soc_data)
+        voltage, tmp, current, soc = DALY_SOC.unpack(soc_data)
         current = ((current - self.CURRENT_ZERO_CONSTANT) / -10 * INVERT_CURRENT_MEASUREMENT)
 
         if SMOOTH_BMS_CURRENT:
@@ -121,15 +107,15 @@ class Daly(Battery):
         self.capacity_remain = (self.capacity * self.soc)/100
         return True
 
-    def read_alarm_data(self, ser):
-        alarm_data = self.read_serial_data_daly(ser, self.command_alarm)
+    def read_alarm_data(self):
+        alarm_data = yield from self.read_serial_data_daly(self.command_alarm)
         # check if connection success
         if alarm_data is False:
             logger.warning("read_alarm_data(): error serial read")
             return False
 
         al_volt, al_temp, al_crnt_soc, al_diff, \
-            al_mos, al_misc1, al_misc2, al_fault = unpack_from('>bbbbbbbb', alarm_data)
+            al_mos, al_misc1, al_misc2, al_fault = DALY_ALARM.unpack(alarm_data)
 
         if al_volt & 48:
             # High voltage levels - Alarm
@@ -224,23 +210,20 @@ class Daly(Battery):
         
         return True
 
-    def read_cells_volts(self, ser):
+    def read_cells_volts(self):
 
         if self.cell_count is not None:
 
-            buffer = bytearray(self.cellvolt_buffer)
-            buffer[1] = self.command_address[0]   # Always serial 40 or 80
-            buffer[2] = self.command_cell_volts[0]
+            buffer = daly_cells_command(self.command_address, self.command_cell_volts)
 
             nFrame = math.ceil(self.cell_count / 3)
-            lenFixed = nFrame * self.DALY_PACKET_LENGTH
 
-            cells_volts_data = read_serialport_data_fixed(ser, buffer, lenFixed)
+            cells_volts_data = yield request(buffer, match=b"\xA5\x01\x95", frames=nFrame, timeout=1.0)
             if cells_volts_data is False:
                 # logger.warning("read_cells_volts(): error serial read")
                 return False
 
-            # logger.info(f"read {len(cells_volts_data)} of {lenFixed}")
+            # logger.info(f"read {len(cells_volts_data)} of {nFrame * DALY_FRAME_LENGTH}")
 
             # How to handle checksum?
             # * every frame has it's own checksum
@@ -249,16 +232,12 @@ class Daly(Battery):
             # * test if all checksums have the same value, for now
 
             cellVoltages = self.cell_count * [0] # temp. buffer, don't set cell voltages if not all values could be read
-            frameCell = [0, 0, 0]
 
             # ps = 0
             # logger.info(f"checksum op packet: {sum(cells_volts_data[:len(cells_volts_data)-1]) & 0xff}")
             cellno = 0
             checksum = None
-            for f in range(nFrame):
-
-                frameOfs = f * self.DALY_PACKET_LENGTH
-                sb, adr, cmd, leng, frame, frameCell[0], frameCell[1], frameCell[2], cs = unpack_from('>BBBBBhhhB', cells_volts_data, frameOfs)
+            for f, (sb, adr, cmd, leng, frame, *frameCell, cs) in enumerate(DALY_CELL_FRAME.iter_unpack(memoryview(cells_volts_data))):
 
                 if sb == 0xA5 and adr == 0x01 and cmd == 0x95 and leng == 0x08:
 
@@ -273,9 +252,9 @@ class Daly(Battery):
                     else:
                         checksum = cs # init checksum from first frame
 
-                    # ps += sum(cells_volts_data[frameOfs:frameOfs+self.DALY_PACKET_LENGTH-1])
-                    # logger.info(f"checksum from frame: {cs}, computed: {sum(cells_volts_data[frameOfs:frameOfs+self.DALY_PACKET_LENGTH-1]) & 0xFF}")
-                    # assert(cs == (sum(cells_volts_data[frameOfs:frameOfs+self.DALY_PACKET_LENGTH-1]) & 0xFF))
+                    # frameOfs = f * DALY_FRAME_LENGTH
+                    # ps += sum(cells_volts_data[frameOfs:frameOfs+DALY_FRAME_LENGTH-1])
+                    # logger.info(f"checksum from frame: {cs}, computed: {sum(cells_volts_data[frameOfs:frameOfs+DALY_FRAME_LENGTH-1]) & 0xFF}")
 
                     for fi in range(3):
                         cellVoltages[cellno] = frameCell[fi] / 1000.0
@@ -293,7 +272,7 @@ class Daly(Battery):
                 # init the numbers of cells
                 self.cells = []
                 for idx in range(self.cell_count):
-                    self.cells.append(Cell(True))
+                    self.cells.append(Cell(None))
 
             # s="cell voltages: "
             for cellno in range(self.cell_count):
@@ -308,14 +287,14 @@ class Daly(Battery):
 
         return True
 
-    def read_cell_voltage_range_data(self, ser):
-        minmax_data = self.read_serial_data_daly(ser, self.command_minmax_cell_volts)
+    def read_cell_voltage_range_data(self):
+        minmax_data = yield from self.read_serial_data_daly(self.command_minmax_cell_volts)
         # check if connection success
         if minmax_data is False:
             logger.warning("read_cell_voltage_range_data(): error serial read")
             return False
 
-        cell_max_voltage, self.cell_max_no, cell_min_voltage, self.cell_min_no = unpack_from('>hbhb', minmax_data)
+        cell_max_voltage, self.cell_max_no, cell_min_voltage, self.cell_min_no = DALY_MINMAX_CELLS.unpack_from(minmax_data)
         # Daly cells numbers are 1 based and not 0 based
         self.cell_min_no -= 1
         self.cell_max_no -= 1
@@ -324,53 +303,39 @@ class Daly(Battery):
         self.cell_min_voltage = cell_min_voltage / 1000
         return True
 
-    def read_temperature_range_data(self, ser):
-        minmax_data = self.read_serial_data_daly(ser, self.command_minmax_temp)
+    def read_temperature_range_data(self):
+        minmax_data = yield from self.read_serial_data_daly(self.command_minmax_temp)
         # check if connection success
         if minmax_data is False:
             logger.warning("read_temperature_range_data(): error serial read")
             return False
 
-        max_temp,max_no,min_temp, min_no = unpack_from('>bbbb', minmax_data)
+        max_temp,max_no,min_temp, min_no = DALY_MINMAX_TEMP.unpack_from(minmax_data)
         self.temperatures[0] = min_temp - self.TEMP_ZERO_CONSTANT
         self.temperatures[1] = max_temp - self.TEMP_ZERO_CONSTANT
         return True
 
-    def read_fed_data(self, ser):
-        fed_data = self.read_serial_data_daly(ser, self.command_fet)
+    def read_fed_data(self):
+        fed_data = yield from self.read_serial_data_daly(self.command_fet)
         # check if connection success
         if fed_data is False:
             logger.warning("read_fed_data(): error serial read")
             return False
 
-        status, self.charge_fet, self.discharge_fet, bms_cycles, capacity_remain = unpack_from('>b??BL', fed_data)
+        status, self.charge_fet, self.discharge_fet, bms_cycles, capacity_remain = DALY_FET.unpack_from(fed_data)
         # mod erri does not work?
         # self.capacity_remain = capacity_remain / 1000
         return True
 
     def generate_command(self, command):
-        buffer = bytearray(self.command_base)
-        buffer[1] = self.command_address[0]   # Always serial 40 or 80
-        buffer[2] = command[0]
-        buffer[12] = sum(buffer[:12]) & 0xFF   #checksum calc
-        return buffer
-
-    def read_serial_data_daly(self, ser, command):
-        data = read_serialport_data(
-                ser,
-                self.generate_command(command),
-                self.LENGTH_POS,
-                self.LENGTH_CHECK)
+        return daly_command(self.command_address, command) # prebuilt, address is always 40 or 80
+
+    def read_serial_data_daly(self, command):
+        # start byte, length and checksum are checked by the decoder
+        data = yield request(self.generate_command(command), match=b"\xA5\x01" + command)
         if data is False:
             return False
 
-        start, flag, command_ret, length = unpack_from('BBBB', data)
-        checksum = sum(data[:-1]) & 0xFF
-
-        if start == 165 and length == 8 and checksum == data[12]:
-            return data[4:length+4]
-        else:
-            logger.error(">>> ERROR: Incorrect Reply")
-            return False
+        return memoryview(data)[4:12]
 
 
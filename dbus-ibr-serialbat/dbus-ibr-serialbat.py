@@ -1,7 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from time import sleep
+from time import sleep, monotonic
 from dbus.mainloop.glib import DBusGMainLoop
 import sys
 
@@ -10,8 +10,10 @@ if sys.version_info.major == 2:
 else:
     from gi.repository import GLib as gobject
 
-from dbushelper import DbusHelper
-from utils import logger
+from dbushelper import DbusHelper, make_monitor
+from multiport import porthost
+import probecache
+from utils import logger, open_serial_port
 from config import DRIVER_VERSION, DRIVER_SUBVERSION
 import logging
 from daly import Daly
@@ -19,28 +21,62 @@ from felicity import Felicity
 
 logger.info('Starting dbus-ibrbattery')
 
+def battery_types(port):
+    # all the different batteries the driver support and need to test for
+    return [
+        Daly(port=port, baud=9600, address=b"\x40"),
+        Daly(port=port, baud=9600, address=b"\x80"),
+        Felicity(port=port, baud=9600, address=b"\x01"),
+    ]
+
+def main_multiport(ports):
+
+    logger.info('dbus-ibrbattery v' + str(DRIVER_VERSION) + DRIVER_SUBVERSION + ', ports: ' + " ".join(ports))
+
+    DBusGMainLoop(set_as_default=True)
+    mainloop = gobject.MainLoop()
+
+    dbusmon = make_monitor()
+    hosts = [ porthost(port, battery_types, dbusmon) for port in ports ]
+    for host in hosts:
+        host.start()
+
+    try:
+        mainloop.run()
+    except KeyboardInterrupt:
+        pass
+
 def main():
 
+    # More than one port: drive all ports from this process
+    if len(sys.argv) > 2:
+        main_multiport(sys.argv[1:])
+        return
+
     def get_battery_type(_port):
-        # all the different batteries the driver support and need to test for
-        battery_types = [
-            Daly(port=_port, baud=9600, address=b"\x40"),
-            Daly(port=_port, baud=9600, address=b"\x80"),
-            Felicity(port=_port, baud=9600, address=b"\x01"),
-        ]
+        # the cached battery of the adapter first
+        candidates = probecache.order(_port, battery_types(_port))
+
+        # one port handle for all tests
+        ser = open_serial_port(_port, candidates[0].baud_rate)
 
         # try to establish communications with the battery 3 times, else exit
         count = 3
         while count > 0:
             # create a new battery object that can read the battery and run connection test
-            for test in battery_types:
+            for test in candidates:
                 logger.info('Testing ' + test.__class__.__name__)
-                if test.test_connection() is True:
+                ser.baudrate = test.baud_rate
+                ser.reset_input_buffer()
+                if test.test_connection(ser) is True:
                     logger.info('Connection established to ' + test.__class__.__name__)
+                    probecache.store(_port, test)
                     return test
+                test.ser = None
 
             count -= 1
             sleep(0.5)
+        ser.close()
         return None
 
     def get_port():
@@ -55,6 +91,7 @@ def main():
     logger.info('dbus-ibrbattery v' + str(DRIVER_VERSION) + DRIVER_SUBVERSION)
 
     port = get_port()
+    started = monotonic()
     battery = get_battery_type(port)
 
     # exit if no battery could be found
@@ -71,14 +108,14 @@ def main():
     mainloop = gobject.MainLoop()
 
     # Get the initial values for the battery used by setup_vedbus
-    helper = DbusHelper(battery)
+    helper = DbusHelper(battery, mainloop.quit, started=started)
     
     if not helper.setup_vedbus():
         logger.error("ERROR >>> Problem with battery set up at " + port)
         sys.exit(1)
 
-    # Poll the battery at INTERVAL and run the main loop
-    gobject.timeout_add(battery.poll_interval, lambda: helper.publish_battery(mainloop))
+    # Poll the battery and run the main loop
+    helper.start_polling()
     try:
         mainloop.run()
     except KeyboardInterrupt:
@@ -2,7 +2,10 @@
 import sys
 import os
 import platform
+import time
+from fnmatch import fnmatchcase
 import dbus
+from gi.repository import GLib
 
 sys.path.insert(1, '/data/ibr-venus-services/common/python')
 sys.path.insert(1, '/data/ibr-venus-services/common/velib_python')
@@ -13,30 +16,67 @@ from dbusmonitor import DbusMonitor
 import battery
 from config import *
 from utils import logger
-from venus_service_utils import parse_batt_info, get_device_instance
-
-def get_bus():
-    return dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
+from transport import transport
+from pollsched import pollscheduler
+from venus_service_utils import parse_batt_info, get_device_instance, ItemsChangedPublisher
+
+def get_bus(private=False):
+    return dbus.SessionBus(private=private) if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus(private=private)
+
+def make_monitor():
+    dummy = {'code': None, 'whenToLog': 'configChange', 'accessLevel': None}
+    dbus_tree = {
+                    'com.victronenergy.ibrsystem': {
+                        "/Info/BattInfo": dummy,
+                    },
+                }
+    return DbusMonitor(dbus_tree)
 
 class DbusHelper:
 
-    def __init__(self, battery):
+    # onfailure(): called on a communication error, the battery has to be restarted.
+    # bus: the bus connection of the service, a private one to run several services in one process
+    #   (closed by the caller).
+    # dbusmon: a shared DbusMonitor for com.victronenergy.ibrsystem (see make_monitor()).
+    # started: time.monotonic() of the start of the probe, for the
+    # time to the first publish
+    def __init__(self, battery, onfailure, bus=None, dbusmon=None, started=None):
         self.battery = battery
+        self.onfailure = onfailure
+        self.started = started
         # +10 to be above virtual aggregate BMS's for
         # automatatic DVCC and Battery Monitor detection
         self.instance = int(self.battery.port[-1]) + 15
         devport = self.battery.port[self.battery.port.rfind('/') + 1:]
-        self._dbusservice = VeDbusService(f"com.victronenergy.{SERVICENAME}.{devport}", get_bus())
-
-        dummy = {'code': None, 'whenToLog': 'configChange', 'accessLevel': None}
-        dbus_tree = {
-                        'com.victronenergy.ibrsystem': {
-                            "/Info/BattInfo": dummy,
-                        },
-                    }
-        self.dbusmon = DbusMonitor(dbus_tree)
-
-        self.error_count = 0
+        self._dbusservice = VeDbusService(f"com.victronenergy.{SERVICENAME}.{devport}", bus or get_bus())
+
+        self.dbusmon = dbusmon or make_monitor()
+
+        self.transport = None # see transport.py
+        self.scheduler = None # see pollsched.py
+        self.timer = None
+        self.stopped = False
+
+        # Publishing, see publish()
+        self.publisher = ItemsChangedPublisher(self._dbusservice)
+        self.deadbands = {} # path -> deadband or None
+        self.published = {} # path -> time of the last publish
+        self.changes = 0 # number of changed values
+        self.suppressed = 0 # number of changes suppressed by the deadband
+        self.perfTime = 0
+
+    def stop(self):
+        # Remove the service from the bus and stop polling
+        self.stopped = True
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        if self.transport:
+            self.transport.close()
+        if self.publisher.flushsource:
+            GLib.source_remove(self.publisher.flushsource)
+            self.publisher.flushsource = None
+        self._dbusservice.__del__()
 
     def setup_vedbus(self):
 
@@ -139,128 +179,196 @@ class DbusHelper:
         self._dbusservice.add_path('/Alarms/HighTemperature', None, writeable=True)
         self._dbusservice.add_path('/Alarms/LowTemperature', None, writeable=True)
 
-        #cell voltages
-        # for i in range(1, self.battery.cell_count+1):
-            # cellpath = '/Voltages/Cell%s'
-            # self._dbusservice.add_path(cellpath%(str(i)), None, writeable=True, gettextcallback=lambda p, v: "{:0.3f}V".format(v))
+        # Cell voltages and balance flags as arrays (one item per poll), and
+        # the single paths of older versions if PUBLISH_CELL_PATHS
+        self._dbusservice.add_path('/Voltages/Cells', None, writeable=True, gettextcallback=lambda p, v: " ".join("{:0.3f}".format(c) for c in v))
+        self._dbusservice.add_path('/Balances/Cells', None, writeable=True, gettextcallback=lambda p, v: "".join(map(str, v)))
+        if PUBLISH_CELL_PATHS:
+            for i in range(1, self.battery.cell_count+1):
+                self._dbusservice.add_path('/Voltages/Cell%d'%i, None, writeable=True, gettextcallback=lambda p, v: "{:0.3f}V".format(v))
+                self._dbusservice.add_path('/Balances/Cell%d'%i, None, writeable=True)
         pathbase = 'Voltages'
-        # self._dbusservice.add_path('/%s/Sum'%pathbase, None, writeable=True, gettextcallback=lambda p, v: "{:2.2f}V".format(v))
+        self._dbusservice.add_path('/%s/Sum'%pathbase, None, writeable=True, gettextcallback=lambda p, v: "{:2.2f}V".format(v))
         self._dbusservice.add_path('/%s/Diff'%pathbase, None, writeable=True, gettextcallback=lambda p, v: "{:0.3f}V".format(v))
 
+        # Signal reduction of the deadband and ItemsChanged batching
+        self._dbusservice.add_path('/Ibr/Perf/ItemsSuppressed', 0)
+        self._dbusservice.add_path('/Ibr/Perf/SignalsSaved', 0)
+
         return True
 
-    def publish_battery(self, loop):
-        # This is called every battery.poll_interval milli second as set up per battery type to read and update the data
-        # logger.info("*** PUBLISH_BATTERY ***\n")
+    def start_polling(self):
+        # Poll the battery commands with the poll scheduler (see pollsched.py)
+        # and publish the data after every command.
+        self.transport = transport(self.battery.ser, self.battery.decoder, self.comm_error)
+        self.scheduler = pollscheduler(self.battery.poll_commands())
+        self.poll()
+
+    def poll(self):
+        self.timer = None
+        cmd, wait = self.scheduler.next()
+        if cmd is None:
+            self.timer = GLib.timeout_add(max(int(wait * 1000), 1), self.poll)
+            return False
+
+        self.transport.run(cmd.method(), lambda success: self.polled(cmd, success))
+        return False
+
+    def polled(self, cmd, success):
+        if self.stopped:
+            return
+        self.scheduler.finished(cmd, success)
+        if self.refreshed(cmd, success):
+            self.poll()
+
+    def refreshed(self, cmd, success):
         try:
-            # Call the battery's refresh_data function
-            success = self.battery.refresh_data()
-            if success:
-                self.error_count = 0
-            else:
-                self.error_count += 1
-                logger.info(f"publish_battery: errorcount = {self.error_count}")
-                # If the battery is offline for more than 10 polls (polled every second for most batteries)
-                if self.error_count >= 10: 
-                    logger.warning("publish_battery: to many comm. errors, restarting...")
-                    loop.quit()
+            if not success:
+                logger.info(f"publish_battery: {cmd.name} errorcount = {cmd.errors}")
+                # If a command fails for too long, see POLL_MAX_ERRORS
+                failed = self.scheduler.failing()
+                if failed:
+                    logger.warning(f"publish_battery: to many comm. errors ({failed.name}), restarting...")
+                    self.onfailure()
                     return False
 
             # publish all the data fro the battery object to dbus
             self.publish_dbus()
 
-        except OSError as e:
-            logger.exception(e)
-            if e.errno == 5:
-                logger.error("publish_battery(): caught OSError (Input/output error) exception, restarting...")
-                loop.quit()
-                return False
-            logger.error(f"publish_battery(): un-caught OSError exception, errno: {e.errno} restarting...")
-            loop.quit()
-            return False
         except Exception as e:
-            logger.exception(e)
-            logger.warning("publish_battery: un-caught exception, restarting...")
-            loop.quit()
+            self.comm_error(e)
             return False
 
-
-        # logger.info("*** end ***")
         return True
 
+    def comm_error(self, e):
+        logger.exception(e)
+        if isinstance(e, OSError):
+            if e.errno == 5:
+                logger.error("publish_battery(): caught OSError (Input/output error) exception, restarting...")
+            else:
+                logger.error(f"publish_battery(): un-caught OSError exception, errno: {e.errno} restarting...")
+        else:
+            logger.warning("publish_battery: un-caught exception, restarting...")
+        self.onfailure()
+
+    def publish(self, path, value):
+        # Publish a value through the deadband (see PUBLISH_DEADBANDS), all
+        # changes of a poll are sent as one ItemsChanged signal.
+        old = self._dbusservice[path]
+        if value == old:
+            return
+        self.changes += 1
+
+        deadband = self.deadbands.get(path, -1)
+        if deadband == -1:
+            deadband = self.deadbands[path] = next((d for p, d in PUBLISH_DEADBANDS.items() if fnmatchcase(path, p)), None)
+
+        now = time.monotonic()
+        if deadband is not None and self.withinDeadband(value, old, deadband) and \
+                now - self.published.get(path, 0) < PUBLISH_REFRESH:
+            self.suppressed += 1
+            return
+
+        self.published[path] = now
+        self.publisher[path] = value
+
+    @staticmethod
+    def withinDeadband(value, old, deadband):
+        # Numbers, or arrays of numbers of the same length (all elements).
+        # The tolerance keeps a change of exactly the deadband (e.g. 5 mV of
+        # mV/1000 values, 3.005 - 3.000 = 0.00499...) outside.
+        deadband -= 1e-9
+        if isinstance(value, list) and isinstance(old, list):
+            return len(value) == len(old) and all(abs(v - o) < deadband for v, o in zip(value, old))
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)):
+            return abs(value - old) < deadband
+        return False
+
     def publish_dbus(self):
 
         # Update SOC, DC and System items
-        self._dbusservice['/System/NrOfCellsPerBattery'] = self.battery.cell_count
-        self._dbusservice['/Soc'] = self.battery.soc
-        self._dbusservice['/Dc/0/Voltage'] = self.battery.voltage
-        self._dbusservice['/Dc/0/Current'] = self.battery.current
-        self._dbusservice['/Dc/0/Power'] = self.battery.voltage * self.battery.current
-        self._dbusservice['/Dc/0/Temperature'] = self.battery.get_temp()
-        self._dbusservice['/Capacity'] = self.battery.get_capacity_remain()
-        self._dbusservice['/ConsumedAmphours'] = 0 if self.battery.capacity is None or \
+        self.publish('/System/NrOfCellsPerBattery', self.battery.cell_count)
+        self.publish('/Soc', self.battery.soc)
+        self.publish('/Dc/0/Voltage', self.battery.voltage)
+        self.publish('/Dc/0/Current', self.battery.current)
+        self.publish('/Dc/0/Power', self.battery.voltage * self.battery.current)
+        self.publish('/Dc/0/Temperature', self.battery.get_temp())
+        self.publish('/Capacity', self.battery.get_capacity_remain())
+        self.publish('/ConsumedAmphours', 0 if self.battery.capacity is None or \
                                 self.battery.get_capacity_remain() is None else \
-                                self.battery.capacity - self.battery.get_capacity_remain()
+                                self.battery.capacity - self.battery.get_capacity_remain())
         
         # Update battery extras
-        self._dbusservice['/History/ChargeCycles'] = self.battery.cycles
-        self._dbusservice['/History/TotalAhDrawn'] = self.battery.total_ah_drawn
+        self.publish('/History/ChargeCycles', self.battery.cycles)
+        self.publish('/History/TotalAhDrawn', self.battery.total_ah_drawn)
 
         allow_charge =    self.battery.charge_fet and self.battery.control_allow_charge
         allow_discharge = self.battery.discharge_fet and self.battery.control_allow_discharge
 
-        self._dbusservice['/Io/AllowToCharge'] = 1 if allow_charge else 0
-        self._dbusservice['/Io/AllowToDischarge'] = 1 if allow_discharge else 0
-        # self._dbusservice['/TimeToGo'] = self.battery.timeToGo
+        self.publish('/Io/AllowToCharge', 1 if allow_charge else 0)
+        self.publish('/Io/AllowToDischarge', 1 if allow_discharge else 0)
+        # self.publish('/TimeToGo', self.battery.timeToGo)
 
-        self._dbusservice['/System/NrOfModulesBlockingCharge'] = 0 if allow_charge else 1
-        self._dbusservice['/System/NrOfModulesBlockingDischarge'] = 0 if allow_discharge else 1
+        self.publish('/System/NrOfModulesBlockingCharge', 0 if allow_charge else 1)
+        self.publish('/System/NrOfModulesBlockingDischarge', 0 if allow_discharge else 1)
 
-        self._dbusservice['/System/NrOfModulesOnline'] = 1 
-        self._dbusservice['/System/NrOfModulesOffline'] = 0 
-        self._dbusservice['/System/MinCellTemperature'] = self.battery.get_min_temp()
-        self._dbusservice['/System/MaxCellTemperature'] = self.battery.get_max_temp()
+        self.publish('/System/NrOfModulesOnline', 1)
+        self.publish('/System/NrOfModulesOffline', 0)
+        self.publish('/System/MinCellTemperature', self.battery.get_min_temp())
+        self.publish('/System/MaxCellTemperature', self.battery.get_max_temp())
 
         # Charge control
-        # self._dbusservice['/Info/MaxChargeCurrent'] = self.battery.control_charge_current
-        # self._dbusservice['/Info/MaxDischargeCurrent'] = self.battery.control_discharge_current
+        # self.publish('/Info/MaxChargeCurrent', self.battery.control_charge_current)
+        # self.publish('/Info/MaxDischargeCurrent', self.battery.control_discharge_current)
 
         # Voltage control
-        # self._dbusservice['/Info/BatteryLowVoltage'] = self.battery.min_battery_voltage
-        # self._dbusservice['/Info/MaxChargeVoltage'] = self.battery.control_voltage
+        # self.publish('/Info/BatteryLowVoltage', self.battery.min_battery_voltage)
+        # self.publish('/Info/MaxChargeVoltage', self.battery.control_voltage)
         
         # Updates from cells
-        self._dbusservice['/System/MinVoltageCellId'] = self.battery.get_min_cell_desc()
-        self._dbusservice['/System/MaxVoltageCellId'] = self.battery.get_max_cell_desc()
-        self._dbusservice['/System/MinCellVoltage'] = self.battery.get_min_cell_voltage()
-        self._dbusservice['/System/MaxCellVoltage'] = self.battery.get_max_cell_voltage()
-        self._dbusservice['/Ess/Throttling'] = self.battery.throttling
+        self.publish('/System/MinVoltageCellId', self.battery.get_min_cell_desc())
+        self.publish('/System/MaxVoltageCellId', self.battery.get_max_cell_desc())
+        self.publish('/System/MinCellVoltage', self.battery.get_min_cell_voltage())
+        self.publish('/System/MaxCellVoltage', self.battery.get_max_cell_voltage())
+        self.publish('/Ess/Throttling', self.battery.throttling)
 
         # Update the alarms
-        self._dbusservice['/Alarms/LowVoltage'] = self.battery.protection.voltage_low
-        self._dbusservice['/Alarms/LowCellVoltage'] = self.battery.protection.voltage_cell_low
-        self._dbusservice['/Alarms/HighVoltage'] = self.battery.protection.voltage_high
-        self._dbusservice['/Alarms/LowSoc'] = self.battery.protection.soc_low
-        self._dbusservice['/Alarms/HighChargeCurrent'] = self.battery.protection.current_over
-        self._dbusservice['/Alarms/HighDischargeCurrent'] = self.battery.protection.current_under
-        self._dbusservice['/Alarms/CellImbalance'] = self.battery.protection.cell_imbalance
-        self._dbusservice['/Alarms/InternalFailure'] = self.battery.protection.internal_failure
-        self._dbusservice['/Alarms/HighChargeTemperature'] = self.battery.protection.temp_high_charge
-        self._dbusservice['/Alarms/LowChargeTemperature'] = self.battery.protection.temp_low_charge
-        self._dbusservice['/Alarms/HighTemperature'] = self.battery.protection.temp_high_discharge
-        self._dbusservice['/Alarms/LowTemperature'] = self.battery.protection.temp_low_discharge
-
-        #cell voltages
-        # voltageSum = 0
-        # for i in range(self.battery.cell_count):
-            # voltage = self.battery.get_cell_voltage(i)
-            # cellpath = '/Voltages/Cell%s'
-            # self._dbusservice[cellpath%(str(i+1))] = voltage
-            # if voltage:
-                # voltageSum+=voltage
+        self.publish('/Alarms/LowVoltage', self.battery.protection.voltage_low)
+        self.publish('/Alarms/LowCellVoltage', self.battery.protection.voltage_cell_low)
+        self.publish('/Alarms/HighVoltage', self.battery.protection.voltage_high)
+        self.publish('/Alarms/LowSoc', self.battery.protection.soc_low)
+        self.publish('/Alarms/HighChargeCurrent', self.battery.protection.current_over)
+        self.publish('/Alarms/HighDischargeCurrent', self.battery.protection.current_under)
+        self.publish('/Alarms/CellImbalance', self.battery.protection.cell_imbalance)
+        self.publish('/Alarms/InternalFailure', self.battery.protection.internal_failure)
+        self.publish('/Alarms/HighChargeTemperature', self.battery.protection.temp_high_charge)
+        self.publish('/Alarms/LowChargeTemperature', self.battery.protection.temp_low_charge)
+        self.publish('/Alarms/HighTemperature', self.battery.protection.temp_high_discharge)
+        self.publish('/Alarms/LowTemperature', self.battery.protection.temp_low_discharge)
+
+        # Cell voltages
+        voltages = self.battery.get_cell_voltages()
+        balances = self.battery.get_cell_balances()
+        self.publish('/Voltages/Cells', voltages)
+        self.publish('/Balances/Cells', balances)
+        if PUBLISH_CELL_PATHS:
+            for i in range(self.battery.cell_count):
+                self.publish('/Voltages/Cell%d'%(i+1), voltages and voltages[i])
+                self.publish('/Balances/Cell%d'%(i+1), balances and balances[i])
         pathbase = 'Voltages'
-        # self._dbusservice['/%s/Sum'%pathbase] = voltageSum
-        self._dbusservice['/%s/Diff'%pathbase] = self.battery.get_max_cell_voltage() - self.battery.get_min_cell_voltage()
+        self.publish('/%s/Sum'%pathbase, voltages and round(sum(voltages), 3))
+        self.publish('/%s/Diff'%pathbase, self.battery.get_max_cell_voltage() - self.battery.get_min_cell_voltage())
+
+        now = time.monotonic()
+        if now - self.perfTime >= PUBLISH_REFRESH:
+            self.perfTime = now
+            self.publisher['/Ibr/Perf/ItemsSuppressed'] = self.suppressed
+            self.publisher['/Ibr/Perf/SignalsSaved'] = self.changes - self.publisher.signalsout
+
+        if self.started is not None:
+            logger.info(f"{self.battery.port}: first publish {now - self.started:.2f}s after the start of the probe")
+            self.started = None
 
         logger.debug("logged to dbus [%s]"%str(round(self.battery.soc, 2)))
         self.battery.log_cell_data()
@@ -7,9 +7,10 @@
 from battery import Battery, Cell, Protection
 from utils import *
 from config import *
-from struct import unpack
-import struct
-import sys
+from codec import *
+from transport import request
+from framing import modbusdecoder
+from registers import block, readplan
 
 
 class Felicity(Battery):
@@ -20,7 +21,7 @@ class Felicity(Battery):
         # should be 0x01
         self.command_address = address
 
-        self.ser = None # serial device handle
+        self.decoder = modbusdecoder(address)
 
         self.max_battery_current = MAX_BATTERY_CURRENT
         self.max_battery_discharge_current = MAX_BATTERY_DISCHARGE_CURRENT
@@ -29,61 +30,38 @@ class Felicity(Battery):
         self.cell_min_no = None
         self.cell_max_no = None
 
+        # Register map
+        self.registers = [
+            block("status", 4866, 3, self.decode_status), # battery status and fault informations
+            block("voltage_current", 4870, 2, self.decode_voltage_current),
+            block("bms_temperature", 4874, 1, self.decode_bms_temperature),
+            block("soc", 4875, 1, self.decode_soc),
+            block("cells", 4906, 16, self.decode_cells),
+            block("temperatures", 4929, 5, self.decode_temperatures), # tempsensor1-3 at 4930-4932
+            ]
+
     BATTERYTYPE = "Felicity"
-    LENGTH_CHECK = 4
-    LENGTH_POS = 2
+
+    # Register blocks read by the poll commands (see FELICITY_POLL)
+    poll_blocks = {
+        "soc": ("status", "voltage_current", "soc"),
+        "cells": ("cells",),
+        "temperature": ("bms_temperature", "temperatures"),
+        }
 
     # command bytes [Address field][Function code (03 = Read register)]
     #                   [Register Address (2 bytes)][Data Length (2 bytes)][CRC (2 bytes little endian)]
 
+    # The polled registers are read with read plans, see self.registers.
     command_read = b"\x03"
-    command_cell_voltages = b"\x13\x2a\x00\x10"  # Registers 4906
-    command_bms_temperature_1_3 = b"\x13\x39\x00\x05"  # Register  4929-4931 (tempsensor1-3)
-
-    command_dvcc = b"\x13\x1c\x00\x04"  # Registers  4892(charger and discharger informations)
-    command_status = b"\x13\x02\x00\x03"  # Registers 4866(battery status and fault informations)
-
-    command_total_voltage_current = b"\x13\x06\x00\x02"  # Register 4870-4871
-    command_bms_temperature_1 = b"\x13\x0a\x00\x01"  # Register  4874 (bms_temp)
-    command_soc = b"\x13\x0b\x00\x01"  # Registers 4875(soc)
     command_firmware_version = b"\xf8\x0b\x00\x01"  # Registers 63499 (1 byte string)
     command_serialnumber = b"\xf8\x04\x00\x05"  # Registers 63492 (1 byte string)
 
     # BMS warning and protection config
 
-    def test_connection(self):
-
-        self.ser = open_serial_port(self.port, self.baud_rate)
-        if self.ser is not None:
-
-            result = self.read_gen_data()
-            result = result and self.get_settings()
-
-            return result
-
-        return False
-
-        # call a function that will connect to the battery, send a command and retrieve the result.
-        # The result or call should be unique to this BMS. Battery name or version, etc.
-        # Return True if success, False for failure
-        result = False
-        try:
-            result = self.read_gen_data()
-            result = result and self.get_settings()
-            # get first data to show in startup log
-            result = result and self.refresh_data()
-        except Exception:
-            (
-                exception_type,
-                exception_object,
-                exception_traceback,
-            ) = sys.exc_info()
-            file = exception_traceback.tb_frame.f_code.co_filename
-            line = exception_traceback.tb_lineno
-            logger.error(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
-            result = False
-
-        return result
+    def probe(self):
+        result = yield from self.read_gen_data()
+        return result and self.get_settings()
 
     def get_settings(self):
         # After successful  connection get_settings will be call to set up the battery.
@@ -96,28 +74,26 @@ class Felicity(Battery):
 
         return True
 
-    def refresh_data(self):
-        # call all functions that will refresh the battery data.
-        # This will be called for every iteration (1 second)
-        # Return True if success, False for failure
-        result = self.read_soc_data()
-        result = result and self.read_cell_data()
-        result = result and self.read_temperature_data()
-
-        return result
+    def poll_commands(self):
+        commands = []
+        for name, (period, priority) in FELICITY_POLL.items():
+            plan = readplan(self.registers, self.poll_blocks[name], FELICITY_MAX_GAP, FELICITY_MAX_REGS)
+            logger.info(f"Felicity read plan {name}: {plan}")
+            commands.append((name, lambda plan=plan: self.read_plan(plan), period, priority))
+        return commands
 
     def read_gen_data(self):
 
-        firmware = self.read_serial_data_felicity(self.command_firmware_version)
-        if firmware is False:
+        firmware = yield from self.read_serial_data_felicity(self.command_firmware_version)
+        if not firmware:
             logger.error("read_gen_data(): error serial read")
             return False
 
-        self.version = str(unpack(">h", firmware)[0])
+        self.version = str(FELICITY_S16.unpack(firmware)[0])
         logger.info(">>> INFO: Battery Firmware: %s", self.version)
 
-        serialnumber = self.read_serial_data_felicity(self.command_serialnumber)
-        if serialnumber is False:
+        serialnumber = yield from self.read_serial_data_felicity(self.command_serialnumber)
+        if not serialnumber:
             logger.error("read_gen_data(): error serial read")
             return False
 
@@ -125,16 +101,11 @@ class Felicity(Battery):
             logger.error(">>> INFO: serialnumber Data size are wrong: %s", len(serialnumber))
             return False
 
-        s1 = str(unpack_from(">H", serialnumber, 0 * 2)[0])
-        s2 = str(unpack_from(">H", serialnumber, 1 * 2)[0])
-        s3 = str(unpack_from(">H", serialnumber, 2 * 2)[0])
-        s4 = str(unpack_from(">H", serialnumber, 3 * 2)[0])
-        s5 = str(unpack_from(">H", serialnumber, 4 * 2)[0])
-        serial_number = s1 + s2 + s3 + s4 + s5
+        serial_number = "".join(map(str, FELICITY_SERIAL.unpack(serialnumber)))
 
         self.cell_count = 16
         for c in range(self.cell_count):
-            self.cells.append(Cell(False))
+            self.cells.append(Cell(None))
 
         self.hardware_version = f"Felicity SN: {serial_number} " + str(self.cell_count) + " cells"
         logger.info(f"Fake hardware version: {self.hardware_version}")
@@ -143,65 +114,35 @@ class Felicity(Battery):
 
         return True
 
-    def read_soc_data(self):
-
-        soc_data = self.read_serial_data_felicity(self.command_soc)
-        if soc_data is False:
-            logger.error("read_soc_data(): error serial read")
-            return False
-
-        if len(soc_data) != 2:
-            logger.error(">>> INFO: soc Data size are wrong: %s", len(soc_data))
-            return False
-
-        self.set_soc(unpack_from(">H", soc_data)[0])
+    def decode_soc(self, data):
+        self.set_soc(FELICITY_U16.unpack(data)[0])
         logger.debug(">>> INFO: Battery SoC: %s", self.soc)
 
-        voltage_current_data = self.read_serial_data_felicity(self.command_total_voltage_current)
-        if voltage_current_data is False:
-            logger.error("read_soc_data(): error serial read voltage_current_data")
-            return False
-
-        if len(voltage_current_data) != 4:
-            logger.error(">>> INFO: voltage_current Data size are wrong: %s", len(voltage_current_data))
-            return False
-
-        self.voltage = unpack_from(">H", voltage_current_data)[0] / 100
+    def decode_voltage_current(self, data):
+        voltage, current = FELICITY_VOLTAGE_CURRENT.unpack(data)
+        self.voltage = voltage / 100
         logger.debug(">>> INFO: Battery voltage: %f V", self.voltage)
 
-        self.current = unpack_from(">h", voltage_current_data, 2)[0] / 10 * -1
+        self.current = current / 10 * -1
         logger.debug(">>> INFO: Battery current: %f A", self.current)
 
-        """
-        if USE_BMS_DVCC_VALUES is True:
-            dvcc_data = self.read_serial_data_felicity(self.command_dvcc)
-            if dvcc_data is False:
-                return False
+    """
+    Registers 4892-4895, charger and discharger informations, not used:
 
-            if len(dvcc_data) != 8:
-                logger.error(">>> INFO: dvcc Data size are wrong: %s", len(dvcc_data))
-            else:
-                self.max_battery_voltage = unpack_from(">H", dvcc_data, 0 * 2)[0] / 100
-                self.min_battery_voltage = unpack_from(">H", dvcc_data, 1 * 2)[0] / 100
-                self.max_battery_charge_current = unpack_from(">H", dvcc_data, 2 * 2)[0] / 10
-                self.max_battery_discharge_current = unpack_from(">H", dvcc_data, 3 * 2)[0] / 10
-
-                logger.debug(">>> INFO: Max Battery voltage: %f V", self.max_battery_voltage)
-                logger.debug(">>> INFO: Min Battery voltage: %f V", self.min_battery_voltage)
-                logger.debug(">>> INFO: Max Battery charge current: %f A", self.max_battery_charge_current)
-                logger.debug(">>> INFO: Max Battery discharge current: %f A", self.max_battery_discharge_current)
-        """
-
-        status_data = self.read_serial_data_felicity(self.command_status)
-        if status_data is False:
-            logger.error("read_soc_data(): error serial read status_data")
-            return False
+    def decode_dvcc(self, dvcc_data):
+        self.max_battery_voltage = unpack_from(">H", dvcc_data, 0 * 2)[0] / 100
+        self.min_battery_voltage = unpack_from(">H", dvcc_data, 1 * 2)[0] / 100
+        self.max_battery_charge_current = unpack_from(">H", dvcc_data, 2 * 2)[0] / 10
+        self.max_battery_discharge_current = unpack_from(">H", dvcc_data, 3 * 2)[0] / 10
 
-        if len(status_data) != 6:
-            logger.error(">>> INFO: Status Data size are wrong: %s", len(status_data))
-            return False
+        logger.debug(">>> INFO: Max Battery voltage: %f V", self.max_battery_voltage)
+        logger.debug(">>> INFO: Min Battery voltage: %f V", self.min_battery_voltage)
+        logger.debug(">>> INFO: Max Battery charge current: %f A", self.max_battery_charge_current)
+        logger.debug(">>> INFO: Max Battery discharge current: %f A", self.max_battery_discharge_current)
+    """
 
-        status_int = unpack_from(">H", status_data)[0]
+    def decode_status(self, data):
+        status_int, _, fault_int = FELICITY_STATUS.unpack(data)
 
         # Charge enable
         self.charge_fet = True if (status_int & 0b0000000000000001) > 0 else False
@@ -210,8 +151,6 @@ class Felicity(Battery):
 
         logger.debug(">>> INFO: Battery Status: %s", bin(status_int))
 
-        fault_int = unpack_from(">H", status_data, 2 * 2)[0]
-
         logger.debug(">>> INFO: Battery Fault: %s", bin(fault_int))
 
         self.protection = Protection()
@@ -232,23 +171,11 @@ class Felicity(Battery):
         # Cell Temperature low status
         self.protection.low_charge_temperature = 2 if (fault_int & 0b0000001000000000) > 0 else 0
 
-        return True
-
-    def read_cell_data(self):
-        cell_volt_data = self.read_serial_data_felicity(self.command_cell_voltages)
-        if cell_volt_data is False:
-            logger.error("read_cell_data(): error serial read")
-            return False
-
-        if len(cell_volt_data) != 32:
-            logger.error(">>> INFO: Cell Data size are wrong: %s", len(cell_volt_data))
-            return False
-
+    def decode_cells(self, data):
         cell_max_voltage = 0 
         cell_min_voltage = 0xffff
-        for c in range(self.cell_count):
-            cell_volts = unpack_from(">H", cell_volt_data, c * 2)
-            v = cell_volts[0] / 1000
+        for c, mv in enumerate(felicity_cells(self.cell_count).unpack(data)):
+            v = mv / 1000
             self.cells[c].voltage = v
             cell_max_voltage = max(v, cell_max_voltage)
             cell_min_voltage = min(v, cell_min_voltage)
@@ -262,90 +189,89 @@ class Felicity(Battery):
 
         self.cell_max_voltage = cell_max_voltage
         self.cell_min_voltage = cell_min_voltage
-        return True
 
-    def read_temperature_data(self):
-        tempBms_data = self.read_serial_data_felicity(self.command_bms_temperature_1)
-        if tempBms_data is False:
-            logger.error("read_temperature_data(): error serial read tempBms_data")
-            return False
+    def decode_bms_temperature(self, data):
+        self.temperature_mos = FELICITY_S16.unpack(data)[0]
+        logger.debug(">>> INFO: Battery TempMos: %f C", self.temperature_mos)
 
-        if len(tempBms_data) != 2:
-            logger.error(">>> INFO: BMS Temp Data size are wrong: %s", len(tempBms_data))
-            return False
+    def decode_temperatures(self, data):
+        self.temperatures[0:3] = FELICITY_TEMPERATURES.unpack(data)[1:4]
 
-        self.temperature_mos = unpack(">h", tempBms_data)[0]
+        logger.debug(">>> INFO: Battery Temperature_1: %f C", self.temperatures[0])
+        logger.debug(">>> INFO: Battery Temperature_2: %f C", self.temperatures[1])
+        logger.debug(">>> INFO: Battery Temperature_3: %f C", self.temperatures[2])
 
-        temperature_1_3_data = self.read_serial_data_felicity(self.command_bms_temperature_1_3)
-        if temperature_1_3_data is False:
-            logger.error("read_temperature_data(): error serial read temperature_1_3_data")
-            return False
+    def read_plan(self, plan):
+        # Poll generator: read the registers of a read plan
+        for read in list(plan.reads):
+            result = yield from self.read_registers(read)
+            if result:
+                read.failures = 0
+                continue
+            if len(read.blocks) == 1:
+                return False
 
-        if len(temperature_1_3_data) != 10:
-            logger.error(">>> INFO: Temp Data size are wrong: %s", len(temperature_1_3_data))
-            return False
+            # A merged read covers unused registers, some BMS reject it
+            # (exception reply) or don't answer at all. A single timeout or
+            # crc error is a glitch of the line, the read is retried with
+            # the next poll.
+            if result is not None:
+                read.failures += 1
+                if read.failures < FELICITY_SPLIT_ERRORS:
+                    return False
+
+            parts = plan.parts(read)
+            for part in parts:
+                result = yield from self.read_registers(part)
+                if not result:
+                    return False
+
+            reason = "rejected" if read.failures == 0 else f"failed {read.failures} times"
+            logger.warning(f"Felicity: read of registers {read} {reason}, reading the blocks one by one")
+            plan.split(read, parts)
 
-        self.temperatures[0] = unpack_from(">h", temperature_1_3_data, 1 * 2)[0]
-        self.temperatures[1] = unpack_from(">h", temperature_1_3_data, 2 * 2)[0]
-        self.temperatures[2] = unpack_from(">h", temperature_1_3_data, 3 * 2)[0]
+        return True
 
-        logger.debug(">>> INFO: Battery TempMos: %f C", self.temperature_mos)
-        logger.debug(">>> INFO: Battery Temperature_1: %f C", self.temperatures[0])
-        logger.debug(">>> INFO: Battery Temperature_2: %f C", self.temperatures[1])
-        logger.debug(">>> INFO: Battery Temperature_3: %f C", self.temperatures[2])
+    def read_registers(self, read):
+        # returns None if the BMS rejects the read
+        data = yield from self.read_serial_data_felicity(read.command)
+        if not data:
+            if data is False:
+                logger.error(f"read_registers(): error reading registers {read}")
+            return data
 
+        if len(data) != read.count * 2:
+            logger.error(f">>> INFO: registers {read}: data size are wrong: {len(data)}")
+            return False
+
+        read.decode(data)
         return True
 
     def read_bms_config(self):
         return True
 
-    def calc_crc(self, data):
-        crc = 0xFFFF
-        for pos in data:
-            crc ^= pos
-            for i in range(8):
-                if (crc & 1) != 0:
-                    crc >>= 1
-                    crc ^= 0xA001
-                else:
-                    crc >>= 1
-        return struct.pack("<H", crc)
-
     def generate_command(self, command):
-        buffer = bytearray(self.command_address)
-        buffer += self.command_read
-        buffer += command
-        buffer += self.calc_crc(buffer)
-
-        return buffer
+        return modbus_command(self.command_address, self.command_read, command) # prebuilt
 
     def read_serial_data_felicity(self, command):
-        # use the read_serialport_data() function to read the data and then do BMS spesific checks (crc, start bytes, etc)
-        data = read_serialport_data(
-            self.ser,
-            self.generate_command(command),
-            self.LENGTH_POS,
-            self.LENGTH_CHECK
-        )
+        # read the data with the transport (the decoder checks the crc) and then do BMS spesific checks
+        data = yield request(self.generate_command(command), match=self.command_address)
         # logger.debug(">>> INFO: Query: %s",self.generate_command(command))
         # logger.debug(">>> INFO: Result All: %s", data)
         if data is False:
             logger.error(f">>> ERROR: Felicity error reading serialport, ser: {self.ser}")
             return False
 
-        start, flag, length = unpack_from("BBB", data)
-        crc_calced = self.calc_crc(data[0 : length + 3])
-        crc_transfered = data[length + 3 : length + 5]
+        start, flag, length = FELICITY_HEADER.unpack_from(data)
 
-        logger.debug(">>> INFO: Result Data: %s", data[3 : length + 3])
-        logger.debug(">>> INFO: Result CRC: %s %s", crc_transfered, crc_calced)
-
-        if crc_transfered != crc_calced:
-            logger.error(">>> ERROR: Felicity Incorrect Checksum")
-            return False
+        logger.debug(">>> INFO: Result Data: %s", data[3 : length + 3].hex())
 
         if flag == 3:
-            return data[3 : length + 3]
+            return memoryview(data)[3 : length + 3]
+
+        if flag == 0x83:
+            logger.warning(f">>> ERROR: Felicity exception reply, code: {data[2]}")
+            return None
 
         logger.error(">>> ERROR: Felicity Incorrect Reply")
         return False
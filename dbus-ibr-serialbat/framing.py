@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental frame decoders of the BMS protocols.
+
+The transport feeds the bytes as they arrive, the decoder returns the
+complete, checked frames. Garbage (noise, a partial or late frame) is
+skipped: if the bytes at the start of the buffer are not a valid frame,
+one byte is dropped and the decoder syncs on the next start byte.
+"""
+
+from utils import logger
+from codec import crc16_modbus, CRC16
+
+# Result of decoder.check() if the frame is not complete yet
+NEED = 0
+# Result of decoder.check() if the buffer does not start with a valid frame
+BAD = -1
+
+class decoder(object):
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.dropped = 0 # number of skipped bytes
+
+    def reset(self):
+        self.buf.clear()
+
+    def feed(self, data):
+        """ Add the received bytes, returns the list of complete frames. """
+
+        self.buf.extend(data)
+        frames = []
+        while self.buf:
+            n = self.check(self.buf)
+            if n == NEED:
+                break
+            if n == BAD:
+                self.resync()
+                continue
+            frames.append(self.buf[:n])
+            del self.buf[:n]
+        return frames
+
+    def resync(self):
+        # Drop the first byte and everything up to the next start byte
+        i = self.buf.find(self.START, 1)
+        n = i if i > 0 else len(self.buf)
+        logger.debug("%s: skipping %d bytes", self.__class__.__name__, n)
+        self.dropped += n
+        del self.buf[:n]
+
+    # Returns the length of the frame at the start of buf, NEED or BAD
+    def check(self, buf):
+        raise NotImplementedError()
+
+class dalydecoder(decoder):
+    """
+    Daly frames: [A5][Address=01][Command][Length=08][8 data bytes][Checksum].
+    The checksum is the sum of the first 12 bytes, except for the cell
+    voltage frames (0x95): these carry the same checksum in all frames of
+    a reply, it is checked by the driver.
+    """
+
+    START = b"\xA5"
+    LENGTH = 13
+
+    def check(self, buf):
+        if buf[0] != 0xA5:
+            return BAD
+        if len(buf) > 1 and buf[1] != 0x01:
+            return BAD
+        if len(buf) > 3 and buf[3] != 0x08:
+            return BAD
+        if len(buf) < self.LENGTH:
+            return NEED
+        if buf[2] != 0x95 and (sum(buf[:12]) & 0xFF) != buf[12]:
+            return BAD
+        return self.LENGTH
+
+class modbusdecoder(decoder):
+    """
+    Modbus RTU replies to 'read registers' (function 03):
+    [Address][03][Byte count][Data][CRC16 little endian],
+    and exception replies: [Address][83][Exception code][CRC16].
+    """
+
+    def __init__(self, address):
+        super(modbusdecoder, self).__init__()
+        self.START = bytes(address)
+
+    def check(self, buf):
+        if buf[0] != self.START[0]:
+            return BAD
+        if len(buf) < 3:
+            return NEED
+        if buf[1] == 0x03:
+            n = buf[2] + 5
+        elif buf[1] == 0x83:
+            n = 5
+        else:
+            return BAD
+        if len(buf) < n:
+            return NEED
+        if crc16_modbus(buf[:n-2]) != CRC16.unpack_from(buf, n-2)[0]:
+            return BAD
+        return n
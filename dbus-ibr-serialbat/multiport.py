@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-port mode: one process drives the batteries of several serial ports
+on a shared main loop, instead of one process per port.
+
+Every port still exports its own com.victronenergy.battery.<tty> service,
+on a private bus connection (a connection exports the object tree of one
+service only). The DbusMonitor of com.victronenergy.ibrsystem is shared.
+
+The ports are probed without blocking the main loop. On a communication
+error only the failed port is stopped and probed again after
+MULTIPORT_RECONNECT seconds, the other ports keep running.
+"""
+
+from gi.repository import GLib
+
+import time
+import serial
+
+import probecache
+from config import *
+from utils import logger, open_serial_port
+from transport import transport
+from dbushelper import DbusHelper, get_bus
+
+class porthost(object):
+
+    # battery_types(port): the battery objects to test on a port
+    def __init__(self, port, battery_types, dbusmon):
+        self.port = port
+        self.battery_types = battery_types
+        self.dbusmon = dbusmon
+
+        self.candidates = []
+        self.ser = None # port handle of the probes
+        self.started = None
+        self.probe = None # transport of the running probe
+        self.helper = None
+        self.bus = None
+
+    def start(self):
+        logger.info(f"{self.port}: probing")
+        self.started = time.monotonic()
+        self.candidates = probecache.order(self.port, self.battery_types(self.port))
+        try:
+            self.ser = open_serial_port(self.port, self.candidates[0].baud_rate)
+        except (serial.SerialException, OSError) as e:
+            logger.error(f"{self.port}: can't open port: {e}")
+            self.candidates = []
+        self.probeNext()
+        return False
+
+    def probeNext(self):
+        if not self.candidates:
+            if self.ser is not None:
+                self.ser.close()
+                self.ser = None
+            logger.error(f"{self.port}: no battery connection, retrying in {MULTIPORT_RECONNECT}s")
+            self.reconnect()
+            return
+
+        battery = self.candidates.pop(0)
+        logger.info(f"{self.port}: testing {battery.__class__.__name__}")
+        self.ser.baudrate = battery.baud_rate
+        self.ser.reset_input_buffer()
+        battery.ser = self.ser
+
+        self.probe = transport(battery.ser, battery.decoder, lambda e: self.probed(battery, False))
+        self.probe.run(battery.probe(), lambda success: self.probed(battery, success))
+
+    def probed(self, battery, success):
+        self.probe.close()
+        self.probe = None
+
+        if not success:
+            battery.ser = None # the port stays open for the next candidate
+            self.probeNext()
+            return
+
+        # The battery owns the port now
+        self.ser = None
+        logger.info(f"{self.port}: connection established to {battery.__class__.__name__}")
+        probecache.store(self.port, battery)
+        battery.log_settings()
+
+        try:
+            self.bus = get_bus(private=True)
+            self.helper = DbusHelper(battery, self.failed, self.bus, self.dbusmon, self.started)
+            ok = self.helper.setup_vedbus()
+        except Exception as e:
+            logger.exception(e)
+            ok = False
+
+        if not ok:
+            logger.error(f"{self.port}: problem with battery set up")
+            self.stop(battery)
+            self.reconnect()
+            return
+
+        self.helper.start_polling()
+
+    def failed(self):
+        # Called from the transport callbacks, stop the port outside of them
+        GLib.idle_add(self.restart)
+
+    def restart(self):
+        if self.helper is None:
+            return False # already stopped
+        logger.warning(f"{self.port}: stopped, reconnect in {MULTIPORT_RECONNECT}s")
+        self.stop(self.helper.battery)
+        self.reconnect()
+        return False
+
+    def stop(self, battery):
+        if self.helper:
+            self.helper.stop()
+            self.helper = None
+        if self.bus:
+            self.bus.close()
+            self.bus = None
+        battery.close()
+
+    def reconnect(self):
+        GLib.timeout_add_seconds(MULTIPORT_RECONNECT, self.start)
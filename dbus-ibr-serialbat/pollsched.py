@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Poll scheduler: every command of a battery (a poll generator, see
+transport.py) has its own target period and priority.
+
+The next command is started as soon as the previous one is complete, so
+the scheduler fills the available serial bandwidth: of the due commands
+the one with the highest priority (lowest number) runs first, the longest
+overdue one of the same priority. If no command is due, the poll waits
+until the next one gets due.
+
+The achieved rates are logged every POLL_STATS_INTERVAL seconds.
+
+Failures are counted per command: a command that failed POLL_MAX_ERRORS
+times in a row and for at least POLL_ERROR_TIME seconds is reported by
+failing() (the port is restarted then), the successful polls of the other
+commands don't hide it.
+"""
+
+import time
+
+from config import *
+from utils import logger
+
+class pollcommand(object):
+
+    def __init__(self, name, method, period, priority):
+        self.name = name
+        self.method = method # returns a poll generator
+        self.period = period / 1000.0 # [s]
+        self.priority = priority
+        self.due = 0
+
+        # Consecutive failures, see pollscheduler.failing()
+        self.errors = 0
+        self.failingSince = None
+
+        # Statistics
+        self.count = 0
+        self.failed = 0
+        self.busy = 0.0 # time spent [s]
+        self.started = None
+
+class pollscheduler(object):
+    """
+    commands: iterable of (name, method, period [ms], priority).
+    """
+
+    def __init__(self, commands, clock=time.monotonic):
+        self.clock = clock
+        self.commands = [ pollcommand(*c) for c in commands ]
+        self.statsStart = clock()
+
+    def next(self):
+        """ Returns the command to run or (None, time until the next one gets due [s]). """
+
+        now = self.clock()
+        if now - self.statsStart >= POLL_STATS_INTERVAL:
+            self.logStats(now)
+
+        due = [ c for c in self.commands if c.due <= now ]
+        if not due:
+            return None, min(c.due for c in self.commands) - now
+
+        cmd = min(due, key=lambda c: (c.priority, c.due))
+        cmd.due = now + cmd.period
+        cmd.started = now
+        return cmd, 0
+
+    def finished(self, cmd, success):
+        now = self.clock()
+        cmd.count += 1
+        if success:
+            cmd.errors = 0
+            cmd.failingSince = None
+        else:
+            cmd.failed += 1
+            cmd.errors += 1
+            if cmd.failingSince is None:
+                cmd.failingSince = cmd.started
+        cmd.busy += now - cmd.started
+
+    def failing(self, now=None):
+        """ Returns a command that fails for too long (see POLL_MAX_ERRORS, POLL_ERROR_TIME) or None. """
+
+        now = now or self.clock()
+        for c in self.commands:
+            if c.errors >= POLL_MAX_ERRORS and now - c.failingSince >= POLL_ERROR_TIME:
+                return c
+        return None
+
+    def stats(self, now=None):
+        """ { name: (achieved rate [Hz], target rate [Hz], failed, avg. time [ms]) } since the last reset. """
+
+        dt = max((now or self.clock()) - self.statsStart, 1e-3)
+        return { c.name: (c.count / dt, 1 / c.period, c.failed, (c.busy / c.count * 1000) if c.count else 0)
+                for c in self.commands }
+
+    def logStats(self, now):
+        s = ", ".join(f"{name} {rate:.2f}/{target:.2f} Hz ({failed} failed, {ms:.0f} ms)"
+                for name, (rate, target, failed, ms) in self.stats(now).items())
+        logger.info(f"poll rates: {s}")
+
+        for c in self.commands:
+            c.count = c.failed = 0
+            c.busy = 0.0
+        self.statsStart = now
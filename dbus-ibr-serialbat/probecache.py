@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the detected battery type and address per serial adapter.
+
+The adapter is identified by its udev serial ID (map_serialdev_to_id,
+built at boot by dbus-ibr-system), ttyUSB numbers change between
+boots. After a restart the cached candidate is probed first, the full
+probe of all battery types is the fallback.
+
+One file per adapter in PROBE_CACHE_DIR, the drivers of the ports run
+in separate processes.
+"""
+
+import sys, os, re, json
+
+from config import PROBE_CACHE_DIR
+from utils import logger
+
+sys.path.append("/data/var/lib")
+try:
+    from map_serialdev_to_id import SerialToId
+except ImportError:
+    SerialToId = {}
+
+def key(battery):
+    return f"{battery.__class__.__name__}@{battery.command_address.hex()}"
+
+def _filename(port):
+    serialid = SerialToId.get(port)
+    if not serialid:
+        return None
+    return os.path.join(PROBE_CACHE_DIR, re.sub(r"[^\w.-]", "_", serialid) + ".json")
+
+def lookup(port):
+    """ Cached key of the battery at port or None. """
+
+    filename = _filename(port)
+    if filename is None:
+        return None
+    try:
+        with open(filename) as f:
+            return json.load(f).get("battery")
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"probe cache: can't read {filename}: {e}")
+        return None
+
+def order(port, candidates):
+    """ The candidates, the cached one first. """
+
+    cached = lookup(port)
+    first = [ c for c in candidates if key(c) == cached ]
+    if first:
+        logger.info(f"{port}: cached battery {cached}")
+    return first + [ c for c in candidates if key(c) != cached ]
+
+def store(port, battery):
+    """ Remember the battery found at port (written only if it changed). """
+
+    filename = _filename(port)
+    if filename is None or lookup(port) == key(battery):
+        return
+
+    try:
+        os.makedirs(PROBE_CACHE_DIR, exist_ok=True)
+        tmp = filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({ "battery": key(battery) }, f)
+        os.replace(tmp, filename)
+    except OSError as e:
+        logger.warning(f"probe cache: can't write {filename}: {e}")
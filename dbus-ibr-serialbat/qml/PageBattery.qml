@@ -12,7 +12,7 @@ MbPage {
 	property VBusItem dcCurrent: VBusItem { bind: service.path("/Dc/0/Current") }
 	property VBusItem midVoltage: VBusItem { bind: service.path("/Dc/0/MidVoltage") }
 	property VBusItem productId: VBusItem { bind: service.path("/ProductId") }
-	property VBusItem cell1: VBusItem { bind: service.path("/Voltages/Cell1") }
+	property VBusItem cells: VBusItem { bind: service.path("/Voltages/Cells") }
 
 	property bool isFiamm48TL: productId.value === 0xB012
 
@@ -196,7 +196,7 @@ MbPage {
 
 		MbSubMenu {
 			description: qsTr("Cell Voltages")
-			show: cell1.valid
+			show: cells.valid
 			subpage: Component {
 				PageBatteryCellVoltages {
 					bindPrefix: service.path("")
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Register map and read planner of Modbus RTU BMS (function 03, read
+holding registers).
+
+The register map is a list of blocks (a value or a group of values at a
+register address). A poll command needs some blocks, the planner merges
+blocks that are at most maxgap registers apart into one read of at most
+maxcount registers, so a poll takes the fewest request/response round
+trips. Every block of the map inside a read is decoded, not only the
+requested ones.
+
+Some devices reject reads that cover unused registers, a read that is
+rejected (exception reply), or that fails repeatedly while its blocks can
+be read one by one, is split into the reads of its blocks (for the
+lifetime of the plan).
+"""
+
+import struct
+
+HEADER = struct.Struct(">HH") # register address, count
+
+class block(object):
+
+    # decode(data): decodes the registers of the block (memoryview, 2 bytes per register)
+    def __init__(self, name, address, count, decode):
+        self.name = name
+        self.address = address
+        self.count = count
+        self.end = address + count
+        self.decode = decode
+
+class read(object):
+    """ One read of the registers of blocks, decodes the blocks of regmap inside it. """
+
+    def __init__(self, blocks, regmap):
+        self.blocks = blocks
+        self.address = blocks[0].address
+        self.end = max(b.end for b in blocks)
+        self.count = self.end - self.address
+        self.command = HEADER.pack(self.address, self.count)
+        self.decoded = [ b for b in regmap if b.address >= self.address and b.end <= self.end ]
+        self.failures = 0 # consecutive failures (no valid reply)
+
+    def decode(self, data):
+        for b in self.decoded:
+            ofs = (b.address - self.address) * 2
+            b.decode(data[ofs:ofs + b.count * 2])
+
+    def __str__(self):
+        return f"{self.address}-{self.end - 1} ({'/'.join(b.name for b in self.blocks)})"
+
+class readplan(object):
+
+    def __init__(self, regmap, names, maxgap, maxcount):
+        self.regmap = regmap
+
+        blocks = sorted((b for b in regmap if b.name in names), key=lambda b: b.address)
+        self.reads = []
+        group = []
+        for b in blocks:
+            if group and (b.address - max(g.end for g in group) > maxgap or b.end - group[0].address > maxcount):
+                self.reads.append(read(group, regmap))
+                group = []
+            group.append(b)
+        if group:
+            self.reads.append(read(group, regmap))
+
+    def parts(self, r):
+        """ The reads of the blocks of read r. """
+        return [ read([b], self.regmap) for b in r.blocks ]
+
+    def split(self, r, parts=None):
+        """ Replace a rejected read by the reads of its blocks (parts), returns them. """
+        parts = parts or self.parts(r)
+        i = self.reads.index(r)
+        self.reads[i:i+1] = parts
+        return parts
+
+    def __str__(self):
+        return ", ".join(str(r) for r in self.reads)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""
+Parser benchmark of the Daly and Felicity drivers over recorded frames.
+
+ * poll: cost of one poll of all commands (command frame, decoder, parse)
+   of the Daly and Felicity drivers, the replies are fed from the
+   recorded frames (Daly) and registers (Felicity) below instead of the
+   serial port.
+ * codec: the building blocks of codec.py against the code they replaced
+   (bitwise CRC, command frames built per call, cell voltage parsing with
+   format strings on copied buffers), checks that the results are equal.
+
+Needs the modules of the driver (gi, pyserial), run it on the GX:
+
+    python3 bench_codec.py [iterations]
+"""
+
+import sys, os, time, math, struct, logging
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+
+import codec
+from utils import logger
+from daly import Daly
+from felicity import Felicity
+
+# Recorded replies, Daly (address 0x40), 16 cells
+DALY_REPLIES = {
+    b"\x90": "a501900802140000767a032067",
+    b"\x91": "a50191080d02030cf80700005c",
+    b"\x92": "a501920841013c0200000000c0",
+    b"\x93": "a50193080001010500030d4098",
+    b"\x94": "a5019408100100000000050058",
+    b"\x95": "a5019508010cf80cf90cfa0053a5019508020cf90cfa0cfb0053a5019508030cfa0cfb0cfc0053"
+             "a5019508040cfb0cfc0cfd0053a5019508050cfc0cfd0cfe0053a5019508060cfd0cfe0cff0053",
+    b"\x98": "a5019808000000000000000046",
+    }
+
+# Recorded registers, Felicity (address 0x01): start register, data
+FELICITY_REGISTERS = (
+    (4866, "000500000000"),                     # status
+    (4870, "14c9ff85"),                         # voltage, current
+    (4874, "001b032f"),                         # bms temperature, soc
+    (4906, "0cf60cf70cf80cf90cfa0cf60cf70cf80cf90cfa0cf60cf70cf80cf90cfa0cf6"), # cells
+    (4929, "00000015001600170000"),             # temperatures
+    (63492, "07e7000b000504d2002a"),            # serial number
+    (63499, "0070"),                            # firmware
+    )
+
+def replies(battery):
+    """ command frame -> recorded reply """
+    if isinstance(battery, Daly):
+        res = { codec.daly_command(battery.command_address, c): bytes.fromhex(r) for c, r in DALY_REPLIES.items() }
+        res[codec.daly_cells_command(battery.command_address, battery.command_cell_volts)] = bytes.fromhex(DALY_REPLIES[b"\x95"])
+        return res.__getitem__
+
+    registers = {}
+    for start, data in FELICITY_REGISTERS:
+        data = bytes.fromhex(data)
+        for i in range(0, len(data), 2):
+            registers[start + i // 2] = data[i:i+2]
+
+    def reply(command):
+        address, count = struct.unpack_from(">HH", command, 2)
+        frame = bytes([command[0], 3, count * 2]) + b"".join(registers.get(r, b"\0\0") for r in range(address, address + count))
+        return frame + codec.CRC16.pack(codec.crc16_modbus(frame))
+    return reply
+
+def run(battery, gen, frames):
+    """ Run a poll generator, the replies are fed through the decoder like the transport does. """
+    reply = None
+    while True:
+        try:
+            req = gen.send(reply)
+        except StopIteration as e:
+            return e.value
+        battery.decoder.reset()
+        if not req.add(battery.decoder.feed(frames(req.command))):
+            raise RuntimeError(f"incomplete reply to {req.command.hex()}")
+        reply = req.result()
+
+def benchpoll(battery, n):
+    frames = replies(battery)
+    assert run(battery, battery.probe(), frames)
+    battery.get_settings()
+    commands = battery.poll_commands()
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        for name, method, period, priority in commands:
+            assert run(battery, method(), frames), name
+    return (time.perf_counter() - t0) / n
+
+#
+# The replaced code
+#
+def legacy_crc(data):
+    crc = 0xFFFF
+    for pos in data:
+        crc ^= pos
+        for i in range(8):
+            if (crc & 1) != 0:
+                crc >>= 1
+                crc ^= 0xA001
+            else:
+                crc >>= 1
+    return struct.pack("<H", crc)
+
+def legacy_daly_command(address, command):
+    buffer = bytearray(b"\xA5\x40\x94\x08\x00\x00\x00\x00\x00\x00\x00\x00\x81")
+    buffer[1] = address[0]
+    buffer[2] = command[0]
+    buffer[12] = sum(buffer[:12]) & 0xFF
+    return buffer
+
+def legacy_felicity_command(address, command):
+    buffer = bytearray(address)
+    buffer += b"\x03"
+    buffer += command
+    buffer += legacy_crc(buffer)
+    return buffer
+
+def legacy_cells(data, cell_count):
+    data = bytearray(data)
+    cellVoltages = cell_count * [0]
+    frameCell = [0, 0, 0]
+    cellno = 0
+    for f in range(math.ceil(cell_count / 3)):
+        sb, adr, cmd, leng, frame, frameCell[0], frameCell[1], frameCell[2], cs = struct.unpack_from('>BBBBBhhhB', data, f * 13)
+        for fi in range(3):
+            cellVoltages[cellno] = frameCell[fi] / 1000.0
+            cellno += 1
+            if cellno == cell_count:
+                break
+    return cellVoltages
+
+def codec_cells(data, cell_count):
+    cellVoltages = cell_count * [0]
+    cellno = 0
+    for sb, adr, cmd, leng, frame, *frameCell, cs in codec.DALY_CELL_FRAME.iter_unpack(memoryview(data)):
+        for v in frameCell:
+            cellVoltages[cellno] = v / 1000.0
+            cellno += 1
+            if cellno == cell_count:
+                break
+    return cellVoltages
+
+def timeit(f, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        f()
+    return (time.perf_counter() - t0) / n
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    logger.setLevel(logging.WARNING)
+
+    print(f"{n} iterations")
+    print("poll (all commands):")
+    daly = Daly(port="/dev/ttyBENCH0", baud=9600, address=b"\x40")
+    felicity = Felicity(port="/dev/ttyBENCH0", baud=9600, address=b"\x01")
+    print(f"  daly      {benchpoll(daly, n)*1e6:8.1f} us")
+    print(f"  felicity  {benchpoll(felicity, n)*1e6:8.1f} us")
+
+    cells = bytes.fromhex(DALY_REPLIES[b"\x95"])
+    frame = codec.modbus_command(b"\x01", b"\x03", b"\x13\x2a\x00\x10")[:-2]
+    reply = replies(felicity)(frame)[:-2]
+    tests = (
+        ("crc16 (6 bytes)", lambda: legacy_crc(frame), lambda: codec.CRC16.pack(codec.crc16_modbus(frame))),
+        ("crc16 (35 bytes)", lambda: legacy_crc(reply), lambda: codec.CRC16.pack(codec.crc16_modbus(reply))),
+        ("daly command", lambda: legacy_daly_command(b"\x40", b"\x90"), lambda: codec.daly_command(b"\x40", b"\x90")),
+        ("felicity command", lambda: legacy_felicity_command(b"\x01", b"\x13\x0b\x00\x01"),
+            lambda: codec.modbus_command(b"\x01", b"\x03", b"\x13\x0b\x00\x01")),
+        ("daly cells (16)", lambda: legacy_cells(cells, 16), lambda: codec_cells(cells, 16)),
+        )
+
+    print("codec:")
+    print(f"  {'':18}  {'old':>8}  {'codec':>8}  {'speedup':>7}  equal")
+    for name, old, new in tests:
+        a, b = old(), new()
+        equal = (a == b) if isinstance(a, list) else (bytes(a) == bytes(b))
+        told = timeit(old, n)
+        tnew = timeit(new, n)
+        print(f"  {name:18}  {told*1e6:5.1f} us  {tnew*1e6:5.1f} us  {told/tnew:6.1f}x  {'yes' if equal else 'NO'}")
+
+if __name__ == "__main__":
+    main()
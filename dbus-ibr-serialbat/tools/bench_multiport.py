@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""
+RAM/CPU comparison of dbus-ibr-serialbat with one process per port against
+the multi-port mode (one process for all ports).
+
+Creates <n> simulated Daly BMS on pseudo terminals, runs the driver on them
+in both modes and measures the memory (RSS and PSS, summed over the
+processes) and the cpu load of the driver processes.
+
+The driver needs the com.victronenergy.settings service (device instance),
+run it on the GX with the system services stopped that use the same
+settings, e.g.:
+
+    python3 bench_multiport.py 4
+
+The simulated batteries show up as com.victronenergy.battery.ttyBENCH<n>
+(device instance settings /Settings/Devices/ibrserialbat_ttyBENCH<n>).
+"""
+
+import sys, os, time, pty, tty, select, struct, signal, subprocess, tempfile
+from argparse import ArgumentParser
+
+DRIVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dbus-ibr-serialbat.py')
+
+CELLS = 16
+
+def dalyframe(cmd, data):
+    frame = bytes([0xA5, 0x01, cmd, 0x08]) + bytes(data).ljust(8, b"\0")
+    return frame + bytes([sum(frame) & 0xFF])
+
+def dalyreply(cmd, t):
+    """ Reply to a Daly command, slowly changing values. """
+
+    if cmd == 0x90: # voltage, current, soc
+        return dalyframe(cmd, struct.pack(">hhhh", 532, 0, 30000 + int(100 * (t % 10)), 800))
+    if cmd == 0x91: # min/max cell voltage
+        return dalyframe(cmd, struct.pack(">hbhb", 3330, 3, 3320, 7))
+    if cmd == 0x92: # min/max temperature
+        return dalyframe(cmd, struct.pack(">bbbb", 65, 1, 60, 2))
+    if cmd == 0x93: # fet status
+        return dalyframe(cmd, struct.pack(">b??BL", 0, True, True, 5, 200000))
+    if cmd == 0x94: # status
+        return dalyframe(cmd, struct.pack(">bb??bhx", CELLS, 1, False, False, 0, 5))
+    if cmd == 0x95: # cell voltages, 3 per frame, same checksum in all frames
+        frames = []
+        for f in range((CELLS + 2) // 3):
+            frames.append(bytearray(dalyframe(cmd, struct.pack(">Bhhh", f + 1, 3320 + f, 3321 + f, 3322 + f))))
+        for frame in frames:
+            frame[12] = frames[0][12]
+        return b"".join(frames)
+    if cmd == 0x98: # alarms
+        return dalyframe(cmd, b"")
+    return None
+
+def simulate(masters):
+    """ Serve the Daly commands on the pty masters, runs until killed. """
+
+    bufs = { fd: bytearray() for fd in masters }
+    while True:
+        r, w, x = select.select(masters, [], [])
+        for fd in r:
+            buf = bufs[fd]
+            buf.extend(os.read(fd, 1024))
+            while True:
+                # Sync on the start byte, skips the padding of the cell voltage command
+                i = buf.find(b"\xA5")
+                if i < 0:
+                    buf.clear()
+                    break
+                del buf[:i]
+                if len(buf) < 13:
+                    break
+                reply = dalyreply(buf[2], time.time())
+                del buf[:13]
+                if reply:
+                    os.write(fd, reply)
+
+def cputime(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def memory(pid):
+    """ RSS and PSS [kB] of a process. """
+
+    rss = pss = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    pss = int(line.split()[1])
+    except OSError:
+        pss = rss
+    return rss, pss
+
+def measure(cmds, warmup, duration):
+    procs = [ subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for cmd in cmds ]
+    try:
+        time.sleep(warmup)
+        for p in procs:
+            if p.poll() is not None:
+                raise RuntimeError(f"{' '.join(p.args)}: exited with {p.returncode}")
+
+        cpu0 = sum(cputime(p.pid) for p in procs)
+        t0 = time.monotonic()
+        time.sleep(duration)
+        cpu = (sum(cputime(p.pid) for p in procs) - cpu0) / (time.monotonic() - t0)
+
+        mem = [ memory(p.pid) for p in procs ]
+        return len(procs), sum(m[0] for m in mem), sum(m[1] for m in mem), cpu
+    finally:
+        for p in procs:
+            p.send_signal(signal.SIGINT)
+        for p in procs:
+            try:
+                p.wait(5)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+def main():
+    parser = ArgumentParser(description="RAM/CPU of one process per port against the multi-port mode")
+    parser.add_argument("packs", type=int, nargs="?", default=4)
+    parser.add_argument("--warmup", type=float, default=20, help="time to probe and settle [s]")
+    parser.add_argument("--duration", type=float, default=60, help="measurement time [s]")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_multiport")
+    masters = []
+    ports = []
+    for n in range(args.packs):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        masters.append(master)
+        port = os.path.join(tmpdir, f"ttyBENCH{n}")
+        os.symlink(os.ttyname(slave), port)
+        ports.append(port)
+
+    sim = os.fork()
+    if sim == 0:
+        try:
+            simulate(masters)
+        finally:
+            os._exit(0)
+
+    try:
+        results = {
+            "per port": measure([ [sys.executable, DRIVER, port] for port in ports ], args.warmup, args.duration),
+            "multi-port": measure([ [sys.executable, DRIVER] + ports ], args.warmup, args.duration),
+            }
+    finally:
+        os.kill(sim, signal.SIGKILL)
+        for port in ports:
+            os.unlink(port)
+        os.rmdir(tmpdir)
+
+    print(f"{args.packs} packs, {args.duration:.0f}s")
+    print(f"{'mode':>10}  {'procs':>5}  {'RSS':>8}  {'PSS':>8}  {'cpu':>6}")
+    for mode, (nprocs, rss, pss, cpu) in results.items():
+        print(f"{mode:>10}  {nprocs:5d}  {rss/1024:5.1f} MB  {pss/1024:5.1f} MB  {cpu*100:5.1f}%")
+
+if __name__ == "__main__":
+    main()
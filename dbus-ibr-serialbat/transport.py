@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Non-blocking serial transport.
+
+The battery drivers describe a poll as a generator: it yields a request
+(command and the expected reply frames) and gets the reply (or False on a
+timeout) sent back, e.g.:
+
+    def read_soc_data(self):
+        data = yield request(command, match=b"\xA5\x01\x90")
+        if data is False:
+            return False
+        ...
+        return True
+
+    def refresh_data(self):
+        return (yield from self.read_soc_data())
+
+transport runs these generators from the GLib main loop: the requests are
+queued and written one at a time, the received bytes are fed to the
+frame decoder of the battery (see framing.py) on data-ready events (io watch
+on the port fd) and every request has a deadline. The main loop is never
+blocked by the serial communication, a poll takes the wire time of its
+requests and replies.
+
+runblocking() runs a generator with blocking reads, for the connection test
+before the main loop runs.
+"""
+
+import select, time
+
+from gi.repository import GLib
+
+import serial
+from utils import logger
+
+# Default deadline of a request (write to complete reply)
+TIMEOUT = 0.75 # [s]
+
+class request(object):
+    """
+    A command and its reply: the number of frames, the reply is their
+    concatenation. Frames not starting with match (e.g. a late reply to
+    an earlier request) are dropped.
+    """
+
+    def __init__(self, command, match=b"", frames=1, timeout=TIMEOUT):
+        self.command = bytes(command)
+        self.match = match
+        self.frames = frames
+        self.timeout = timeout
+
+        self.reply = []
+
+    # Add the decoded frames, returns True if the reply is complete
+    def add(self, frames):
+        for frame in frames:
+            if not frame.startswith(self.match):
+                logger.debug("transport: dropping unexpected frame %s", frame.hex())
+                continue
+            if len(self.reply) == self.frames:
+                logger.debug("transport: dropping extra frame %s", frame.hex())
+                continue
+            self.reply.append(frame)
+        return len(self.reply) == self.frames
+
+    def result(self):
+        if len(self.reply) == 1:
+            return self.reply[0]
+        return b"".join(self.reply)
+
+def runblocking(ser, decoder, gen):
+    """ Run a poll generator with blocking reads, returns its result. """
+
+    reply = None
+    while True:
+        try:
+            req = gen.send(reply)
+        except StopIteration as e:
+            return e.value
+        reply = readblocking(ser, decoder, req)
+
+def readblocking(ser, decoder, req):
+
+    ser.reset_input_buffer()
+    decoder.reset()
+    ser.write(req.command)
+    ser.flush()
+
+    deadline = time.monotonic() + req.timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        r, w, x = select.select([ser.fileno()], [], [], remaining)
+        if r and req.add(decoder.feed(ser.read(ser.in_waiting or 1))):
+            return req.result()
+
+class transport(object):
+    """
+    Runs poll generators on a serial port from the GLib main loop.
+    onerror(exception): called on a read/write error of the port or an
+    exception of a poll generator, the pending requests are dropped.
+    """
+
+    def __init__(self, ser, decoder, onerror):
+        self.ser = ser
+        self.ser.timeout = 0 # non-blocking reads
+        self.decoder = decoder
+        self.onerror = onerror
+
+        self.queue = [] # (request, callback)
+        self.current = None # (request, callback) in progress
+        self.timer = None
+
+        self.watch = GLib.io_add_watch(ser.fileno(), GLib.PRIORITY_DEFAULT,
+                GLib.IO_IN | GLib.IO_ERR | GLib.IO_HUP, self._readable)
+
+    def close(self):
+        if self.watch:
+            GLib.source_remove(self.watch)
+            self.watch = None
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
+
+    def busy(self):
+        return self.current is not None or bool(self.queue)
+
+    def run(self, gen, done):
+        """
+        Run a poll generator, done(result) is called with its return value,
+        onerror(exception) if it raised an exception.
+        """
+
+        def step(reply):
+            try:
+                req = gen.send(reply)
+            except StopIteration as e:
+                done(e.value)
+                return
+            except Exception as e:
+                self._error(e)
+                return
+            self.submit(req, step)
+
+        step(None)
+
+    def submit(self, req, callback):
+        """ Queue a request, callback(reply) is called with the reply or False. """
+        self.queue.append((req, callback))
+        if self.current is None:
+            self._next()
+
+    def _next(self):
+        if not self.queue:
+            return
+
+        self.current = self.queue.pop(0)
+        req = self.current[0]
+
+        # Drop a late reply to an earlier request
+        self.decoder.reset()
+        try:
+            self.ser.reset_input_buffer()
+            self.ser.write(req.command)
+        except (serial.SerialException, OSError) as e:
+            self._error(e)
+            return
+
+        self.timer = GLib.timeout_add(int(req.timeout * 1000), self._timeout)
+
+    def _readable(self, fd, condition):
+        try:
+            if condition & (GLib.IO_ERR | GLib.IO_HUP):
+                raise OSError(5, "serial port error/hangup")
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except (serial.SerialException, OSError) as e:
+            self.watch = None # removed by returning False
+            self._error(e)
+            return False
+
+        frames = self.decoder.feed(data)
+        if self.current is None:
+            if frames:
+                logger.debug("transport: dropping %d frames, no request", len(frames))
+            return True
+
+        req = self.current[0]
+        if req.add(frames):
+            self._complete(req.result())
+        return True
+
+    def _timeout(self):
+        self.timer = None
+        logger.debug("transport: timeout, got %d frames, %d bytes", len(self.current[0].reply), len(self.decoder.buf))
+        self._complete(False)
+        return False
+
+    def _complete(self, reply):
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        req, callback = self.current
+        self.current = None
+        callback(reply)
+        if self.current is None:
+            self._next()
+
+    def _error(self, e):
+        self.current = None
+        self.queue = []
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        self.onerror(e)
@@ -0,0 +1,113 @@
+import os, sys, importlib
+
+from mod_bms import bms
+
+# dbus-ibr-bms und seine Abhängigkeiten (velib_python braucht python3-dbus/gi,
+# ein dbus-daemon ist aber nicht nötig).
+_base = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for _p in ('common/velib_python', 'common/python', 'dbus-ibr-bms'):
+    sys.path.insert(1, os.path.join(_base, _p))
+
+import fakebus
+
+class ibrbms(bms):
+    """
+    Der echte dbus-ibr-bms Dienst (DbusAggBatService) als BMS, über einen
+    In-Process Fake-Bus (dbus-ibr-bms/fakebus.py) mit virtueller Uhr.
+
+    Die Batterien der Simulation werden als com.victronenergy.battery.ttyUSB<n>
+    Dienste veröffentlicht, dazu ein Solarcharger (Busspannung) und ein
+    Inverter. Pro Simulationsschritt läuft die virtuelle Uhr um time_step
+    weiter, /Info/MaxChargeVoltage und /Info/MaxChargeCurrent des Dienstes
+    gehen als DVCC Limits zurück ins System.
+
+    Config:
+      batteries: Namen der Batterie-Module (Default: alle)
+      max_charge_current: /Info/MaxChargeCurrent der Batterien [A]
+      tick_mode: timer oder event (siehe dbus-ibr-bms/config.py)
+    """
+    def __init__(self, name, config, time_step):
+        super().__init__(name, config, time_step)
+
+        self.battery_names = [b.strip() for b in config.get('batteries', '').split(',') if b.strip()]
+        self.max_charge_current = float(config.get('max_charge_current', 100.0))
+        self.tick_mode = config.get('tick_mode', None)
+
+        self.bus = fakebus.fakebus()
+        self.service = None
+        self.services = {} # Batterie-Modul -> Dienstname
+        self.soc = 0.0
+        self.chgmode = ""
+
+    def _start(self):
+        """Dienste anlegen und dbus-ibr-bms starten (beim ersten Schritt, wenn alle Module registriert sind)."""
+        batteries = self.system.get_modules_by_type('battery')
+        if self.battery_names:
+            batteries = [b for b in batteries if b.name in self.battery_names]
+
+        for n, bat in enumerate(batteries):
+            name = f"com.victronenergy.battery.ttyUSB{n}"
+            self.services[bat] = name
+            values = self._battery_values(bat)
+            values.update({
+                '/InstalledCapacity': bat.capacity,
+                '/Info/MaxChargeCurrent': self.max_charge_current,
+                '/DeviceInstance': n,
+                '/Io/AllowToCharge': 1,
+                '/Io/AllowToDischarge': 1,
+                '/Io/AllowToBalance': 1,
+            })
+            self.bus.add_service(name, values)
+
+        self.bus.add_service("com.victronenergy.solarcharger.sim", {
+            '/Dc/0/Voltage': self.system.voltage, '/DeviceInstance': 100 })
+        self.bus.add_service("com.victronenergy.inverter.sim", {
+            '/Dc/0/Voltage': self.system.voltage, '/Dc/0/Current': 0, '/DeviceInstance': 101 })
+
+        svc = importlib.import_module("dbus-ibr-bms")
+        if self.tick_mode:
+            svc.TICK_MODE = self.tick_mode
+        self.service = svc.DbusAggBatService(backend=self.bus)
+
+    def _battery_values(self, bat):
+        m = bat.get_metrics()
+        return {
+            '/Soc': round(m['soc'], 1),
+            '/Dc/0/Voltage': round(m['u_bus'], 2),
+            '/Dc/0/Current': round(m['i'], 2),
+            '/System/MaxCellVoltage': round(m['u_max'], 3),
+            '/System/MinCellVoltage': round(m['u_min'], 3),
+            '/Voltages/Diff': round(m['u_diff'], 3),
+        }
+
+    def step(self):
+        if not self.system: return
+
+        if self.service is None:
+            self._start()
+
+        # Messwerte der Batterien und des Laders veröffentlichen
+        for bat, name in self.services.items():
+            for path, value in self._battery_values(bat).items():
+                self.bus.set_value(name, path, value)
+        self.bus.set_value("com.victronenergy.solarcharger.sim", '/Dc/0/Voltage', round(self.system.voltage, 2))
+
+        self.bus.clock.advance(self.time_step)
+
+        # Limits des Dienstes als DVCC Sollwerte
+        out = self.service._dbusservice
+        self.cvl = out['/Info/MaxChargeVoltage']
+        self.ccl = out['/Info/MaxChargeCurrent']
+        self.soc = out['/Soc']
+        self.chgmode = out['/Ess/Chgmode']
+
+        self.system.set_value('/Info/MaxChargeVoltage', self.cvl)
+        self.system.set_value('/Info/MaxChargeCurrent', self.ccl)
+        self.system.set_value('/Info/MaxDischargeCurrent', self.dcl)
+
+    def get_metrics(self):
+        m = super().get_metrics()
+        m['soc'] = self.soc
+        m['chgmode'] = self.chgmode
+        m['throttling'] = int(bool(self.service and self.service._dbusservice['/Ess/Throttling']))
+        return m
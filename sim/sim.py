@@ -1,14 +1,13 @@
 import argparse
 import configparser
-import time, sys, os
+import time, sys, os, csv
 import traceback
 from system import System
-from sim_gui import SimulationGui
 
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..', 'common', 'python'))
 
 class SimulationRunner:
-    def __init__(self, config_file):
+    def __init__(self, config_file, gui=True):
         self.config = configparser.ConfigParser()
         self.config.read(config_file)
         
@@ -24,16 +23,20 @@ class SimulationRunner:
         self.modules = []
         self._init_modules()
         
-        # GUI initialisieren mit Parametern
-        sim_params = {
-            'n_steps': self.n_steps,
-            'time_step': self.time_step,
-            't_simulation': self.n_steps * self.time_step
-        }
-        self.gui = SimulationGui(self.title, self.modules, sim_params)
-        
-        # Log-Anbindung
-        self.system.set_log_callback(self.gui.log)
+        self.gui = None
+        if gui:
+            from sim_gui import SimulationGui
+
+            # GUI initialisieren mit Parametern
+            sim_params = {
+                'n_steps': self.n_steps,
+                'time_step': self.time_step,
+                't_simulation': self.n_steps * self.time_step
+            }
+            self.gui = SimulationGui(self.title, self.modules, sim_params)
+
+            # Log-Anbindung
+            self.system.set_log_callback(self.gui.log)
         self.system.log(f"Simulation initialisiert: {self.title}")
 
     def _init_modules(self):
@@ -116,9 +119,46 @@ class SimulationRunner:
         # GUI starten (blockiert hier)
         self.gui.show()
 
+    def run_headless(self, outfile=None):
+        """
+        Ohne GUI, so schnell wie möglich. Schreibt die (numerischen) Metriken
+        aller Module als csv (Spalten: t_hours, Modul.metrik) und gibt die
+        Metriken des letzten Schritts aus.
+        """
+        print(f"Simulation startet (headless): {self.title}, {self.n_steps} Schritte")
+        t = time.perf_counter()
+
+        writer = None
+        f = open(outfile, 'w', newline='') if outfile else None
+        try:
+            all_metrics = {}
+            for t_hours, all_metrics in self.run_generator():
+                if not f:
+                    continue
+                row = {'t_hours': round(t_hours, 4)}
+                for mod, metrics in all_metrics.items():
+                    for key, value in metrics.items():
+                        if isinstance(value, (int, float)) and ':' not in key:
+                            row[f"{mod}.{key}"] = round(value, 4)
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=list(row.keys()), extrasaction='ignore')
+                    writer.writeheader()
+                writer.writerow(row)
+        finally:
+            if f:
+                f.close()
+
+        t = time.perf_counter() - t
+        print(f"Simulation beendet: {self.n_steps * self.time_step / 3600:.1f}h in {t:.1f}s")
+        for mod, metrics in all_metrics.items():
+            print(f"  {mod}: " + ", ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}"
+                for k, v in metrics.items() if ':' not in k and not k.startswith('cell_')))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', default='basic_charge.ini')
+    parser.add_argument('--headless', action='store_true', help='ohne GUI, so schnell wie möglich')
+    parser.add_argument('-o', '--out', default=None, help='csv Datei der Metriken (headless)')
     args = parser.parse_args()
     
     config_path = args.config
@@ -130,4 +170,7 @@ if __name__ == "__main__":
             print(f"Fehler: Konfigurationsdatei {config_path} nicht gefunden.")
             sys.exit(1)
 
-    SimulationRunner(config_path).run()
\ No newline at end of file
+    if args.headless:
+        SimulationRunner(config_path, gui=False).run_headless(args.out)
+    else:
+        SimulationRunner(config_path).run()
\ No newline at end of file